@@ -0,0 +1,257 @@
+"""
+Drives the whole order flow of the bot against local Moltin, Yandex geocoder and Telegram stubs:
+every user goes /start -> menu page -> product -> cart -> payment -> delivery, all users make
+each step concurrently. For every step prints handler time p50/p95/p99, failed handlers and
+calls to each external service per user, cart writes and sends finished by the background
+queues are counted in the step that caused them.
+Needs a running redis and an empty database in --redis-url, a database with keys is flushed
+only with --flush.
+
+    python -m benchmarks.bot_flow --users 200 --concurrency 32 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+from telegram import Update
+from telegram.ext import Defaults, ExtBot
+from telegram.utils.request import Request
+
+from benchmarks.redis_db import add_redis_arguments, connect_redis
+from benchmarks.report import ms, percentile
+from benchmarks.stubs import MoltinStub, TelegramStub, YandexGeocoderStub
+from bot import build_dispatcher, close_bot_data
+from elastic_api import MoltinClient
+from menu_pages import MenuPages
+
+TOKEN = '123456:stub-token'
+FIRST_USER_ID = 100000
+
+
+class FlowUser:
+    """Builds the updates one user sends to the bot"""
+
+    def __init__(self, user_id, update_ids, message_ids):
+        self.user_id = user_id
+        self.update_ids = update_ids
+        self.message_ids = message_ids
+
+    def _user(self):
+        return {'id': self.user_id, 'is_bot': False, 'first_name': f'User {self.user_id}'}
+
+    def _chat_message(self, **fields):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': self.user_id, 'type': 'private'},
+        }
+        message.update(fields)
+        return message
+
+    def message(self, text=None, **fields):
+        if text is not None:
+            fields['text'] = text
+            if text.startswith('/'):
+                fields['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        message = self._chat_message(**fields)
+        message['from'] = self._user()
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def callback(self, data, photo=False, text=MenuPages.text, message=None):
+        if message:
+            message = dict(message)
+        elif photo:
+            message = self._chat_message(photo=[{'file_id': 'photo', 'file_unique_id': 'photo',
+                                                 'width': 800, 'height': 800}], caption='Пицца')
+        else:
+            message = self._chat_message(text=text)
+        return {
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.update_ids)),
+                'from': self._user(),
+                'chat_instance': str(self.user_id),
+                'message': message,
+                'data': data,
+            },
+        }
+
+    def pre_checkout(self, total_amount, invoice_payload):
+        return {
+            'update_id': next(self.update_ids),
+            'pre_checkout_query': {
+                'id': str(next(self.update_ids)),
+                'from': self._user(),
+                'currency': 'RUB',
+                'total_amount': total_amount,
+                'invoice_payload': invoice_payload,
+            },
+        }
+
+    def successful_payment(self, total_amount, invoice_payload):
+        return self.message(successful_payment={
+            'currency': 'RUB',
+            'total_amount': total_amount,
+            'invoice_payload': invoice_payload,
+            'telegram_payment_charge_id': f'charge-{self.user_id}-{time.time_ns()}',
+            'provider_payment_charge_id': f'provider-{self.user_id}',
+        })
+
+
+def get_product_ids(dispatcher, page):
+    _, reply_markup = dispatcher.bot_data['menu_pages'].get_page(page)
+    return [
+        button.callback_data
+        for row in reply_markup.inline_keyboard for button in row
+        if button.callback_data not in ('Назад', 'Вперед', 'Корзина')
+    ]
+
+
+def get_first_cart_item(dispatcher, user):
+    cart_id = dispatcher.bot_data['redis_base'].hget(user.user_id, 'cart')
+    items = dispatcher.bot_data['cart_mirror'].get(cart_id)['items'] if cart_id else []
+    return items[0]['id'] if items else 'no-item'
+
+
+def get_invoice_amount(invoice):
+    prices = invoice['prices']
+    if isinstance(prices, str):
+        prices = json.loads(prices)
+    return sum(price['amount'] for price in prices)
+
+
+def get_invoice(telegram, user):
+    """Returns the amount and the payload of the invoice sent to the user"""
+    call = telegram.wait_for_call(user.user_id, {'sendInvoice'}, since=0, timeout=0)
+    if not call:
+        return 0, 'no-invoice'
+    _, invoice, _ = call
+    return get_invoice_amount(invoice), invoice['payload']
+
+
+def build_steps(dispatcher, telegram):
+    products = get_product_ids(dispatcher, 1)
+    first_product, second_product = products[0], products[-1]
+    return [
+        ('/start', lambda user: user.message('/start')),
+        ('Вперед', lambda user: user.callback('Вперед')),
+        ('product', lambda user: user.callback(first_product)),
+        ('add to cart', lambda user: user.callback('Добавить в корзину', photo=True)),
+        ('В меню', lambda user: user.callback('В меню', photo=True)),
+        ('product 2', lambda user: user.callback(second_product)),
+        ('add to cart 2', lambda user: user.callback('Добавить в корзину', photo=True)),
+        ('Корзина', lambda user: user.callback('Корзина', photo=True)),
+        ('remove item', lambda user: user.callback(get_first_cart_item(dispatcher, user), text='Корзина')),
+        ('Оплатить', lambda user: user.callback('Оплатить', text='Корзина')),
+        ('email', lambda user: user.message(f'user{user.user_id}@example.com')),
+        ('address', lambda user: user.message(f'Москва, улица Тестовая, {user.user_id}')),
+        ('Доставка', lambda user: user.callback('Доставка', text='Доставка')),
+        ('pre_checkout', lambda user: user.pre_checkout(*get_invoice(telegram, user))),
+        ('payment', lambda user: user.successful_payment(*get_invoice(telegram, user))),
+    ]
+
+
+def wait_for_background(dispatcher, users):
+    for user in users:
+        cart_id = dispatcher.bot_data['redis_base'].hget(user.user_id, 'cart')
+        if cart_id:
+            dispatcher.bot_data['cart_queue'].flush(cart_id, timeout=30)
+    dispatcher.bot_data['send_scheduler'].join(timeout=60)
+
+
+def run_step(dispatcher, users, build_update, executor):
+    def process(user):
+        update = Update.de_json(build_update(user), dispatcher.bot)
+        started_at = time.perf_counter()
+        dispatcher.process_update(update)
+        return time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    durations = list(executor.map(process, users))
+    wait_for_background(dispatcher, users)
+    return durations, time.perf_counter() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the bot handlers along the order flow')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.05, help='latency of every stub in seconds')
+    parser.add_argument('--moltin-latency', type=float, help='overrides --latency for Moltin')
+    parser.add_argument('--geocoder-latency', type=float, help='overrides --latency for the geocoder')
+    parser.add_argument('--telegram-latency', type=float, help='overrides --latency for Telegram')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of stub calls answered with 503')
+    add_redis_arguments(parser)
+    args = parser.parse_args()
+
+    redis_base = connect_redis(args)
+
+    def latency(override):
+        return args.latency if override is None else override
+
+    moltin_stub = MoltinStub(latency=latency(args.moltin_latency), error_rate=args.error_rate)
+    geocoder_stub = YandexGeocoderStub(latency=latency(args.geocoder_latency), error_rate=args.error_rate)
+    telegram = TelegramStub(latency=latency(args.telegram_latency), error_rate=args.error_rate)
+    with moltin_stub, geocoder_stub, telegram:
+        bot = ExtBot(TOKEN,
+                     base_url=telegram.bot_url,
+                     defaults=Defaults(run_async=False),
+                     request=Request(con_pool_size=args.concurrency + 12))
+        moltin = MoltinClient(token='stub-token', base_url=moltin_stub.url, pool_maxsize=args.concurrency + 8)
+        dispatcher = build_dispatcher(bot,
+                                      redis_base,
+                                      moltin,
+                                      yandex_geo_api='stub-key',
+                                      payment_token='stub-payment-token',
+                                      workers=1,
+                                      send_rate=10000,
+                                      chat_send_rate=1000,
+                                      geocoder_url=geocoder_stub.geocoder_url)
+        errors = []
+        dispatcher.add_error_handler(lambda update, context: errors.append(context.error))
+
+        dispatcher.bot_data['catalog'].refresh()
+        steps = build_steps(dispatcher, telegram)
+        for stub in (moltin_stub, geocoder_stub, telegram):
+            stub.reset_calls()
+
+        update_ids = count(1)
+        message_ids = count(1)
+        users = [FlowUser(FIRST_USER_ID + number, update_ids, message_ids) for number in range(args.users)]
+
+        header = (f'{"step":<14} {"p50":>10} {"p95":>10} {"p99":>10} {"step time":>10} {"errors":>7} '
+                  f'{"moltin":>7} {"yandex":>7} {"telegram":>8}')
+        print(header)
+        print('-' * len(header))
+        totals = {'moltin': 0, 'yandex': 0, 'telegram': 0, 'errors': 0}
+        flow_started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for name, build_update in steps:
+                errors.clear()
+                durations, elapsed = run_step(dispatcher, users, build_update, executor)
+                calls = {
+                    'moltin': moltin_stub.reset_calls(),
+                    'yandex': geocoder_stub.reset_calls(),
+                    'telegram': telegram.reset_calls(),
+                }
+                for service, service_calls in calls.items():
+                    totals[service] += service_calls
+                totals['errors'] += len(errors)
+                print(f'{name:<14} {ms(percentile(durations, 50)):>10} {ms(percentile(durations, 95)):>10} '
+                      f'{ms(percentile(durations, 99)):>10} {elapsed:>9.2f}s {len(errors):>7} '
+                      f'{calls["moltin"] / len(users):>7.2f} {calls["yandex"] / len(users):>7.2f} '
+                      f'{calls["telegram"] / len(users):>8.2f}')
+        flow_elapsed = time.perf_counter() - flow_started_at
+
+        print('-' * len(header))
+        print(f'{"whole flow":<14} {"":>10} {"":>10} {"":>10} {flow_elapsed:>9.2f}s {totals["errors"]:>7} '
+              f'{totals["moltin"] / len(users):>7.2f} {totals["yandex"] / len(users):>7.2f} '
+              f'{totals["telegram"] / len(users):>8.2f}')
+        print(f'couriers queue: {redis_base.xlen(dispatcher.bot_data["courier_dispatch"].stream_key)} orders')
+        close_bot_data(dispatcher.bot_data)
+
+
+if __name__ == '__main__':
+    main()
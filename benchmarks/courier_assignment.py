@@ -0,0 +1,92 @@
+"""
+Assigns orders to couriers of CourierRegistry from many threads at once: thousands of couriers
+share positions around Moscow, orders come from pizzerias all over the city. Prints assignment
+time p50/p95/p99, throughput, orders left without a courier, the distance to the chosen couriers
+and checks that no courier got more than --max-load orders. With --deliver a share of assigned
+orders is marked delivered while the benchmark runs, so couriers become free again.
+Needs a running redis and an empty database in --redis-url, a database with keys is flushed
+only with --flush.
+
+    python -m benchmarks.courier_assignment --couriers 5000 --orders 20000 --concurrency 32
+"""
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.redis_db import add_redis_arguments, connect_redis
+from benchmarks.report import ms, percentile
+from courier_registry import CourierRegistry
+from delivery_zones import get_haversine_distance
+
+CENTER = (55.75, 37.62)
+# about 20 km around the center
+SPREAD = (0.18, 0.3)
+FIRST_COURIER_ID = 500000
+
+
+def get_random_location(rng):
+    return CENTER[0] + rng.uniform(-SPREAD[0], SPREAD[0]), CENTER[1] + rng.uniform(-SPREAD[1], SPREAD[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of courier assignment with redis GEO')
+    parser.add_argument('--couriers', type=int, default=5000)
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--pizzerias', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--max-load', type=int, default=3)
+    parser.add_argument('--candidates', type=int, default=20)
+    parser.add_argument('--deliver', type=float, default=0.5, help='share of orders marked delivered')
+    parser.add_argument('--seed', type=int, default=1)
+    add_redis_arguments(parser)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    redis_base = connect_redis(args, max_connections=args.concurrency + 4)
+    registry = CourierRegistry(redis_base, max_load=args.max_load, candidates=args.candidates)
+
+    couriers = {FIRST_COURIER_ID + number: get_random_location(rng) for number in range(args.couriers)}
+    started_at = time.perf_counter()
+    registry.register(couriers)
+    for courier_id, (latitude, longitude) in couriers.items():
+        registry.update_location(courier_id, latitude, longitude)
+    print(f'{args.couriers} couriers registered in {time.perf_counter() - started_at:.2f} s')
+
+    pizzerias = [get_random_location(rng) for _ in range(args.pizzerias)]
+    orders = [(f'order-{number}', rng.choice(pizzerias), rng.random() < args.deliver)
+              for number in range(args.orders)]
+
+    def assign(order):
+        order_id, coordinates, delivered = order
+        order_started_at = time.perf_counter()
+        courier_id = registry.assign(order_id, coordinates)
+        duration = time.perf_counter() - order_started_at
+        if courier_id is not None and delivered:
+            registry.release(order_id)
+        return duration, courier_id, coordinates
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(assign, orders))
+    elapsed = time.perf_counter() - started_at
+
+    durations = [duration for duration, _, _ in results]
+    assigned = [(courier_id, coordinates) for _, courier_id, coordinates in results if courier_id is not None]
+    distances = [get_haversine_distance(couriers[courier_id], coordinates) for courier_id, coordinates in assigned]
+    loads = {courier_id: registry.get_load(courier_id) for courier_id in couriers}
+    max_load = max(loads.values())
+
+    print(f'{args.orders} orders, {args.concurrency} threads: {args.orders / elapsed:.0f} orders/s, '
+          f'assignment p50 {ms(percentile(durations, 50))}, p95 {ms(percentile(durations, 95))}, '
+          f'p99 {ms(percentile(durations, 99))}')
+    print(f'assigned {len(assigned)}, without a courier {args.orders - len(assigned)}, '
+          f'couriers used {len(set(courier_id for courier_id, _ in assigned))}')
+    print(f'distance to the courier: p50 {percentile(distances, 50):.2f} km, '
+          f'p95 {percentile(distances, 95):.2f} km')
+    print(f'active orders now: {sum(loads.values())}, max per courier {max_load} '
+          f'({"ok" if max_load <= args.max_load else "OVERLOADED"})')
+
+
+if __name__ == '__main__':
+    main()
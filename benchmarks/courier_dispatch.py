@@ -0,0 +1,122 @@
+"""
+Compares the payment-success path that delivers an order to the courier inline with
+the one that only puts the order into the courier-dispatch stream, and measures
+throughput and end-to-end latency of the courier workers and the lag of customer
+addresses written to Moltin by the CMS write buffer.
+Needs a running redis and an empty database in --redis-url, a database with keys is flushed
+only with --flush.
+
+    python -m benchmarks.courier_dispatch --orders 2000 --workers 4 --latency 0.02
+"""
+import argparse
+import os
+import tempfile
+import time
+import uuid
+
+from telegram.ext import ExtBot
+from telegram.utils.request import Request
+
+from benchmarks.redis_db import add_redis_arguments, connect_redis
+from benchmarks.report import ms, percentile
+from benchmarks.stubs import MoltinStub, TelegramStub
+from cms_buffer import CmsWriteBuffer
+from courier_dispatch import CourierDispatch, CourierWorker, start_workers, stop_workers
+from elastic_api import MoltinClient
+
+TOKEN = '123456:stub-token'
+
+
+def build_order(number):
+    return {
+        'order_id': str(uuid.uuid4()),
+        'deliveryman_id': 1000 + number % 10,
+        'coordinates': [55.75, 37.62],
+        'email': f'customer{number}@example.com',
+        'text': f'Заказ {number}',
+    }
+
+
+def bot_sender(bot):
+    def send(method, **kwargs):
+        return getattr(bot, method)(**kwargs)
+    return send
+
+
+def bench_inline(orders, send, moltin):
+    worker = CourierWorker(None, send, None)
+    durations = []
+    for order in orders:
+        started_at = time.perf_counter()
+        worker._send_location(order)
+        worker._send_message(order)
+        # without the CMS buffer the address was written to Moltin right away
+        moltin.create_entry(['longitude', 'latitude', 'email'], [*order['coordinates'], order['email']],
+                            'customer-address')
+        durations.append(time.perf_counter() - started_at)
+    return durations
+
+
+def bench_queued(redis_base, orders, send, cms_buffer, workers):
+    dispatch = CourierDispatch(redis_base)
+    durations = []
+    started_at = time.perf_counter()
+    courier_workers, threads, stop_event = start_workers(dispatch, send, cms_buffer, workers=workers, block_ms=100)
+    for order in orders:
+        enqueued_at = time.perf_counter()
+        dispatch.enqueue(order)
+        durations.append(time.perf_counter() - enqueued_at)
+
+    while sum(worker.delivered for worker in courier_workers) < len(orders):
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started_at
+    stop_workers(threads, stop_event)
+
+    latencies = [latency for worker in courier_workers for latency in worker.latencies]
+    return durations, latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the courier-dispatch stream')
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.02, help='Telegram and Moltin stub latency in seconds')
+    parser.add_argument('--cms-concurrency', type=int, default=4, help='parallel writes of the CMS buffer')
+    add_redis_arguments(parser)
+    args = parser.parse_args()
+
+    redis_base = connect_redis(args)
+
+    with TelegramStub(latency=args.latency) as telegram, MoltinStub(latency=args.latency) as moltin_stub:
+        bot = ExtBot(TOKEN, base_url=telegram.bot_url, request=Request(con_pool_size=args.workers + 4))
+        moltin = MoltinClient(token='stub-token', base_url=moltin_stub.url, pool_maxsize=args.workers + args.cms_concurrency + 4)
+        send = bot_sender(bot)
+
+        inline_orders = [build_order(number) for number in range(min(args.orders, 200))]
+        inline = bench_inline(inline_orders, send, moltin)
+
+        with tempfile.TemporaryDirectory() as spill_dir:
+            cms_buffer = CmsWriteBuffer(moltin, os.path.join(spill_dir, 'cms_buffer.jsonl'),
+                                        concurrency=args.cms_concurrency).start()
+            cms_started_at = time.perf_counter()
+            orders = [build_order(number) for number in range(args.orders)]
+            enqueue, latencies, elapsed = bench_queued(redis_base, orders, send, cms_buffer, args.workers)
+            cms_buffer.flush()
+            cms_elapsed = time.perf_counter() - cms_started_at
+            cms_buffer.close()
+
+    print(f'inline delivery in the payment handler: p50 {ms(percentile(inline, 50))}, '
+          f'p95 {ms(percentile(inline, 95))}')
+    print(f'enqueue in the payment handler:         p50 {ms(percentile(enqueue, 50))}, '
+          f'p95 {ms(percentile(enqueue, 95))}')
+    print(f'{args.workers} workers: {args.orders / elapsed:.0f} orders/s, end-to-end latency '
+          f'p50 {ms(percentile(latencies, 50))}, p95 {ms(percentile(latencies, 95))}, '
+          f'p99 {ms(percentile(latencies, 99))}')
+    print(f'CMS buffer, {args.cms_concurrency} writers: {cms_buffer.written} addresses, '
+          f'{cms_buffer.written / cms_elapsed:.0f} addresses/s, {cms_buffer.failures} failures, flush lag '
+          f'p50 {ms(percentile(cms_buffer.lags, 50))}, p95 {ms(percentile(cms_buffer.lags, 95))}, '
+          f'p99 {ms(percentile(cms_buffer.lags, 99))}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""
+Load test of one bot process. Virtual customers talk to the bot through a local Telegram stub
+the bot polls for updates, Moltin and the Yandex geocoder are stubbed too. Every customer waits
+for the answer of the bot to each update, thinks for a while and goes on along a path picked
+from the mix: browsing the menu, abandoning the cart, ordering for pickup or for delivery.
+Concurrency levels run one after another, for each of them the throughput, the answer latency
+by conversation state and the saturation point are printed.
+Needs a running redis and an empty database in --redis-url, a database with keys is flushed
+only with --flush.
+
+    python -m benchmarks.load --users 10 50 100 200 --duration 60 --think 1.0 \\
+        --mix delivery=0.4,pickup=0.2,browse=0.3,abandon=0.1
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from itertools import count
+
+from telegram.ext import Defaults, ExtBot, Updater
+from telegram.utils.request import Request
+
+from benchmarks.bot_flow import FlowUser, get_invoice_amount
+from benchmarks.redis_db import add_redis_arguments, connect_redis
+from benchmarks.report import ms, percentile
+from benchmarks.stubs import MoltinStub, TelegramStub, YandexGeocoderStub
+from bot import build_dispatcher, close_bot_data
+from courier_dispatch import CourierDispatch
+from elastic_api import MoltinClient
+
+TOKEN = '123456:stub-token'
+NAVIGATION_BUTTONS = {'Назад', 'Вперед', 'Корзина', 'Добавить в корзину', 'В меню', 'Оплатить'}
+
+
+class StepFailed(Exception):
+    pass
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        path, weight = part.split('=')
+        if path.strip() not in PATHS:
+            raise argparse.ArgumentTypeError(f'Unknown path {path}, choose from {", ".join(PATHS)}')
+        weights[path.strip()] = float(weight)
+    return weights
+
+
+def get_buttons(message):
+    reply_markup = (message or {}).get('reply_markup') or {}
+    return [button.get('callback_data') for row in reply_markup.get('inline_keyboard', []) for button in row]
+
+
+class LoadStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.steps = 0
+        self.sessions = Counter()
+        self.failures = Counter()
+
+    def add_step(self, state, latency):
+        with self.lock:
+            self.latencies[state].append(latency)
+            self.steps += 1
+
+    def add_session(self, path, failure=None):
+        with self.lock:
+            if failure:
+                self.failures[failure] += 1
+            else:
+                self.sessions[path] += 1
+
+
+class VirtualCustomer:
+    """One customer session: sends an update, waits until the bot answers it and thinks"""
+
+    def __init__(self, load_test, user_id):
+        self.load_test = load_test
+        self.telegram = load_test.telegram
+        self.updates = FlowUser(user_id, load_test.update_ids, load_test.message_ids)
+        self.user_id = user_id
+        self.message = None
+        self.invoice = None
+
+    def think(self):
+        if self.load_test.think_time:
+            time.sleep(self.load_test.rnd.expovariate(1 / self.load_test.think_time))
+
+    def step(self, name, state, update, methods, key=None, accept=None):
+        self.think()
+        sent_at = time.perf_counter()
+        self.telegram.push_update(update)
+        call = self.telegram.wait_for_call(key or self.user_id, methods, sent_at, self.load_test.timeout, accept)
+        if call is None:
+            raise StepFailed(f'no answer to {name}')
+        self.load_test.stats.add_step(state, time.perf_counter() - sent_at)
+
+        method, body, result = call
+        if isinstance(result, dict):
+            reply_markup = body.get('reply_markup')
+            if isinstance(reply_markup, str):
+                reply_markup = json.loads(reply_markup)
+            self.message = dict(result, reply_markup=reply_markup) if reply_markup else result
+        return body
+
+    def callback(self, name, state, data, methods):
+        update = self.updates.callback(data, message=self.message)
+        callback_query_id = update['callback_query']['id']
+        if 'answerCallbackQuery' in methods:
+            body = self.step(name, state, update, methods, key=callback_query_id)
+        else:
+            body = self.step(name, state, update, methods)
+        self.telegram.forget_calls(callback_query_id)
+        return body
+
+    def start(self):
+        self.step('/start', 'START', self.updates.message('/start'), {'sendMessage'})
+
+    def next_page(self):
+        self.callback('Вперед', 'HANDLE_DESCRIPTION', 'Вперед', {'editMessageReplyMarkup', 'editMessageText'})
+
+    def open_product(self):
+        products = [button for button in get_buttons(self.message) if button not in NAVIGATION_BUTTONS]
+        if not products:
+            raise StepFailed('no products in the menu')
+        self.callback('product', 'HANDLE_DESCRIPTION', self.load_test.rnd.choice(products), {'sendPhoto'})
+
+    def add_to_cart(self):
+        self.callback('add to cart', 'HANDLE_DESCRIPTION', 'Добавить в корзину', {'answerCallbackQuery'})
+
+    def back_to_menu(self):
+        self.callback('В меню', 'HANDLE_DESCRIPTION', 'В меню', {'sendMessage'})
+
+    def open_cart(self):
+        self.callback('Корзина', 'HANDLE_DESCRIPTION', 'Корзина', {'sendMessage'})
+
+    def remove_item(self):
+        items = [button for button in get_buttons(self.message) if button not in NAVIGATION_BUTTONS]
+        # the last pizza isn't removed, an empty cart can't be paid
+        if len(items) > 1:
+            self.callback('remove item', 'HANDLE_CART', items[0], {'sendMessage'})
+
+    def checkout(self):
+        self.callback('Оплатить', 'HANDLE_CART', 'Оплатить', {'editMessageText'})
+        self.step('email', 'WAITING_EMAIL', self.updates.message(f'user{self.user_id}@example.com'),
+                  {'sendMessage'})
+        self.step('address', 'WAITING_GEO', self.updates.message(f'Москва, улица Нагрузочная, {self.user_id}'),
+                  {'sendMessage'})
+        if 'Доставка' not in get_buttons(self.message):
+            raise StepFailed('address is too far')
+
+    def pay(self, delivery_type):
+        self.invoice = self.callback(delivery_type, 'PROCESS_DELIVERY', delivery_type, {'sendInvoice'})
+        total_amount = get_invoice_amount(self.invoice)
+        payload = self.invoice['payload']
+
+        update = self.updates.pre_checkout(total_amount, payload)
+        query_id = update['pre_checkout_query']['id']
+        self.step('pre_checkout', 'PRECHECKOUT', update, {'answerPreCheckoutQuery'}, key=query_id)
+        self.telegram.forget_calls(query_id)
+
+        update = self.updates.successful_payment(total_amount, payload)
+        if delivery_type == 'Самовывоз':
+            self.step('payment', 'SUCCESS_PAYMENT', update, {'sendMessage'},
+                      accept=lambda body: 'самовывоза' in body.get('text', ''))
+        else:
+            self.think()
+            sent_at = time.perf_counter()
+            self.telegram.push_update(update)
+            charge_id = update['message']['successful_payment']['telegram_payment_charge_id']
+            if not self.load_test.wait_for_order(charge_id, sent_at + self.load_test.timeout):
+                raise StepFailed('order was not queued for the courier')
+            self.load_test.stats.add_step('SUCCESS_PAYMENT', time.perf_counter() - sent_at)
+
+
+def browse(customer):
+    customer.start()
+    customer.next_page()
+    customer.open_product()
+    customer.back_to_menu()
+
+
+def abandon(customer):
+    customer.start()
+    customer.open_product()
+    customer.add_to_cart()
+    customer.open_cart()
+
+
+def order(customer, delivery_type):
+    customer.start()
+    customer.next_page()
+    customer.open_product()
+    customer.add_to_cart()
+    customer.back_to_menu()
+    customer.open_product()
+    customer.add_to_cart()
+    customer.open_cart()
+    if customer.load_test.rnd.random() < 0.3:
+        customer.remove_item()
+    customer.checkout()
+    customer.pay(delivery_type)
+
+
+def pickup(customer):
+    order(customer, 'Самовывоз')
+
+
+def delivery(customer):
+    order(customer, 'Доставка')
+
+
+PATHS = {'browse': browse, 'abandon': abandon, 'pickup': pickup, 'delivery': delivery}
+
+
+class LoadTest:
+    def __init__(self, telegram, redis_base, mix, think_time, timeout, seed=None):
+        self.telegram = telegram
+        self.redis_base = redis_base
+        self.mix = mix
+        self.think_time = think_time
+        self.timeout = timeout
+        self.rnd = random.Random(seed)
+        self.update_ids = count(1)
+        self.message_ids = count(1)
+        self.user_ids = count(100000)
+        self.stats = LoadStats()
+
+    def wait_for_order(self, order_id, deadline):
+        order_key = f'{CourierDispatch.order_prefix}{order_id}'
+        while time.perf_counter() < deadline:
+            if self.redis_base.exists(order_key):
+                return True
+            time.sleep(0.005)
+        return False
+
+    def run_customer(self, stop_at):
+        paths = list(self.mix)
+        weights = [self.mix[path] for path in paths]
+        while time.perf_counter() < stop_at:
+            path = self.rnd.choices(paths, weights)[0]
+            customer = VirtualCustomer(self, next(self.user_ids))
+            try:
+                PATHS[path](customer)
+            except StepFailed as error:
+                self.stats.add_session(path, failure=str(error))
+            else:
+                self.stats.add_session(path)
+            finally:
+                self.telegram.forget_calls(customer.user_id)
+
+    def run_level(self, users, duration):
+        self.stats = LoadStats()
+        started_at = time.perf_counter()
+        threads = [
+            threading.Thread(target=self.run_customer, args=(started_at + duration,), daemon=True)
+            for _ in range(users)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.stats, time.perf_counter() - started_at
+
+
+def find_saturation(levels, slo):
+    """Returns the first level where the throughput stops growing with users or p95 breaks the SLO"""
+    previous = None
+    for level in levels:
+        if level['p95'] > slo:
+            return level['users'], f'p95 {ms(level["p95"])} is over {ms(slo)}'
+        if previous:
+            users_growth = level['users'] / previous['users']
+            throughput_growth = level['throughput'] / previous['throughput'] if previous['throughput'] else 0
+            if throughput_growth - 1 < (users_growth - 1) / 2:
+                return level['users'], (f'{users_growth:.1f}x users gave only {throughput_growth:.2f}x '
+                                        f'throughput')
+        previous = level
+    return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the bot with virtual customers')
+    parser.add_argument('--users', type=int, nargs='+', default=[10, 25, 50, 100, 200],
+                        help='concurrency levels, virtual customers at a time')
+    parser.add_argument('--duration', type=float, default=60, help='seconds per concurrency level')
+    parser.add_argument('--think', type=float, default=1.0, help='mean think time between steps in seconds')
+    parser.add_argument('--mix', type=parse_mix, default='delivery=0.4,pickup=0.2,browse=0.3,abandon=0.1')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for an answer of the bot')
+    parser.add_argument('--slo', type=float, default=2.0, help='p95 answer latency in seconds still acceptable')
+    parser.add_argument('--latency', type=float, default=0.05, help='latency of every stub in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of stub calls answered with 503')
+    parser.add_argument('--workers', type=int, default=32, help='BOT_WORKERS of the bot')
+    parser.add_argument('--send-rate', type=float, default=30, help='TG_SEND_RATE of the bot')
+    parser.add_argument('--chat-send-rate', type=float, default=1, help='TG_CHAT_SEND_RATE of the bot')
+    parser.add_argument('--seed', type=int)
+    add_redis_arguments(parser)
+    args = parser.parse_args()
+
+    redis_base = connect_redis(args)
+
+    moltin_stub = MoltinStub(latency=args.latency, error_rate=args.error_rate)
+    geocoder_stub = YandexGeocoderStub(latency=args.latency, error_rate=args.error_rate)
+    telegram = TelegramStub(latency=args.latency, error_rate=args.error_rate)
+    with moltin_stub, geocoder_stub, telegram:
+        bot = ExtBot(TOKEN,
+                     base_url=telegram.bot_url,
+                     defaults=Defaults(run_async=True),
+                     request=Request(con_pool_size=args.workers + 12))
+        moltin = MoltinClient(token='stub-token', base_url=moltin_stub.url, pool_maxsize=args.workers + 8)
+        dispatcher = build_dispatcher(bot,
+                                      redis_base,
+                                      moltin,
+                                      yandex_geo_api='stub-key',
+                                      payment_token='stub-payment-token',
+                                      workers=args.workers,
+                                      send_rate=args.send_rate,
+                                      chat_send_rate=args.chat_send_rate,
+                                      geocoder_url=geocoder_stub.geocoder_url)
+        updater = Updater(dispatcher=dispatcher, workers=None)
+        updater.start_polling(poll_interval=0, timeout=1)
+
+        load_test = LoadTest(telegram, redis_base, args.mix, args.think, args.timeout, args.seed)
+        levels = []
+        states = ['START', 'HANDLE_DESCRIPTION', 'HANDLE_CART', 'WAITING_EMAIL', 'WAITING_GEO',
+                  'PROCESS_DELIVERY', 'PRECHECKOUT', 'SUCCESS_PAYMENT']
+        for users in args.users:
+            stats, elapsed = load_test.run_level(users, args.duration)
+            all_latencies = [latency for latencies in stats.latencies.values() for latency in latencies]
+            level = {
+                'users': users,
+                'throughput': stats.steps / elapsed,
+                'p95': percentile(all_latencies, 95),
+            }
+            levels.append(level)
+
+            print(f'\n{users} customers, {elapsed:.0f} s: {level["throughput"]:.1f} updates/s, '
+                  f'{sum(stats.sessions.values()) / elapsed * 60:.1f} sessions/min '
+                  f'({", ".join(f"{path} {qty}" for path, qty in sorted(stats.sessions.items()))}), '
+                  f'{sum(stats.failures.values())} failed sessions')
+            for failure, qty in stats.failures.most_common(5):
+                print(f'  failed: {failure} x{qty}')
+            print(f'  {"state":<20} {"answers":>8} {"p50":>10} {"p95":>10} {"p99":>10}')
+            for state in states:
+                latencies = stats.latencies.get(state)
+                if latencies:
+                    print(f'  {state:<20} {len(latencies):>8} {ms(percentile(latencies, 50)):>10} '
+                          f'{ms(percentile(latencies, 95)):>10} {ms(percentile(latencies, 99)):>10}')
+
+        saturated_at, reason = find_saturation(levels, args.slo)
+        print()
+        if saturated_at:
+            print(f'saturation at {saturated_at} customers: {reason}')
+        else:
+            print(f'no saturation up to {args.users[-1]} customers')
+
+        updater.stop()
+        close_bot_data(dispatcher.bot_data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Compares per-call `requests` functions with the pooled MoltinClient against a local Moltin stub.
+
+    python -m benchmarks.moltin_client --calls 2000 --threads 4
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.stubs import MoltinStub
+from elastic_api import MoltinClient
+
+
+def get_product_info_per_call(base_url, token, product_id):
+    headers = {
+        'Authorization': f'Bearer {token}',
+    }
+
+    response = requests.get(f'{base_url}/v2/products/{product_id}',
+                            headers=headers)
+    response.raise_for_status()
+
+    return response.json()
+
+
+def run(call, calls, threads):
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda _: call(), range(calls)))
+    elapsed = time.perf_counter() - started_at
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of Moltin client against a local stub')
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0, help='stub latency in seconds')
+    args = parser.parse_args()
+
+    with MoltinStub(latency=args.latency) as stub:
+        product_id = next(iter(stub.products))
+        client = MoltinClient('token', base_url=stub.url, pool_maxsize=args.threads)
+
+        results = {
+            'requests per call': run(lambda: get_product_info_per_call(stub.url, 'token', product_id),
+                                     args.calls, args.threads),
+            'MoltinClient': run(lambda: client.get_product_info(product_id), args.calls, args.threads),
+        }
+        client.close()
+
+    for name, elapsed in results.items():
+        print(f'{name:>20}: {elapsed:.2f} s, {args.calls / elapsed:.0f} calls/s, '
+              f'{elapsed / args.calls * 1000:.2f} ms/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Compares the linear geodesic scan of show_nearest_pizzeria with PizzeriaIndex on random sites.
+
+    python -m benchmarks.pizzeria_index --sizes 10 100 1000 10000 100000
+"""
+import argparse
+import random
+import time
+
+from geo_api import PizzeriaIndex, show_nearest_pizzeria
+
+LINEAR_SCAN_LIMIT = 10000
+
+
+def generate_pizzerias(qty, rnd):
+    return [
+        {
+            'address': f'Адрес {num}',
+            'coordinates': (rnd.uniform(43.0, 68.0), rnd.uniform(28.0, 135.0)),
+            'deliveryman-telegram-id': num,
+        }
+        for num in range(qty)
+    ]
+
+
+def generate_locations(qty, pizzerias, rnd):
+    locations = []
+    for _ in range(qty):
+        latitude, longitude = rnd.choice(pizzerias)['coordinates']
+        locations.append((latitude + rnd.uniform(-0.3, 0.3), longitude + rnd.uniform(-0.3, 0.3)))
+    return locations
+
+
+def measure(find_nearest, locations):
+    started_at = time.perf_counter()
+    results = [find_nearest(location) for location in locations]
+    return (time.perf_counter() - started_at) / len(locations), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the nearest pizzeria lookup')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    print(f'{"sites":>8} {"build, ms":>10} {"index, ms":>10} {"linear, ms":>11} {"match":>6}')
+    for size in args.sizes:
+        pizzerias = generate_pizzerias(size, rnd)
+        locations = generate_locations(args.queries, pizzerias, rnd)
+
+        started_at = time.perf_counter()
+        index = PizzeriaIndex(pizzerias)
+        build_time = time.perf_counter() - started_at
+        index_time, index_results = measure(index.nearest, locations)
+
+        linear_time, matched = None, '-'
+        if size <= LINEAR_SCAN_LIMIT:
+            linear_locations = locations[:max(1, args.queries * 100 // size)]
+            linear_time, linear_results = measure(
+                lambda location: show_nearest_pizzeria(pizzerias, location),
+                linear_locations,
+            )
+            matched = all(
+                linear['address'] == indexed['address'] and abs(linear['distance'] - indexed['distance']) < 1e-9
+                for linear, indexed in zip(linear_results, index_results)
+            )
+
+        linear_ms = f'{linear_time * 1000:11.3f}' if linear_time is not None else f'{"-":>11}'
+        print(f'{size:>8} {build_time * 1000:10.1f} {index_time * 1000:10.3f} {linear_ms} {str(matched):>6}')
+
+
+if __name__ == '__main__':
+    main()
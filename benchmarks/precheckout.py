@@ -0,0 +1,152 @@
+"""
+Bursts of pre-checkout queries: all users get an invoice through the order flow, then answer
+it at once, several times in a row. Compares the check of the signed order snapshot with
+the old way of re-reading the cart from Moltin, `--changed` users add a pizza after the invoice
+and must be refused. Prints p50/p95/p99 of the answer time, refused queries and Moltin calls
+per query, and the time of one snapshot verification.
+Needs a running redis and an empty database in --redis-url, a database with keys is flushed
+only with --flush.
+
+    python -m benchmarks.precheckout --users 200 --bursts 5 --concurrency 64 --latency 0.05 --changed 0.1
+"""
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+from telegram.ext import ConversationHandler, Defaults, ExtBot
+from telegram.utils.request import Request
+
+from benchmarks.bot_flow import (FIRST_USER_ID, TOKEN, FlowUser, build_steps, get_invoice, get_product_ids,
+                                 run_step)
+from benchmarks.redis_db import add_redis_arguments, connect_redis
+from benchmarks.report import ms, percentile
+from benchmarks.stubs import MoltinStub, TelegramStub, YandexGeocoderStub
+from bot import BotStates, build_dispatcher, close_bot_data
+from elastic_api import MoltinClient
+from order_snapshot import OrderSigner
+
+
+def benchmark_verify(rounds=10000):
+    signer = OrderSigner('benchmark-key')
+    items = [{'product_id': f'product-{number}', 'quantity': number} for number in range(1, 6)]
+    payload = signer.sign(FIRST_USER_ID, 'f4a3e1c2-8b7d-4e5f-9a1b-2c3d4e5f6a7b', items, 250000, 30000)
+    durations = []
+    for _ in range(rounds):
+        started_at = time.perf_counter()
+        signer.verify(FIRST_USER_ID, payload)
+        durations.append(time.perf_counter() - started_at)
+    return durations, len(payload.encode())
+
+
+def get_conversation(dispatcher):
+    return next(handler for handler in dispatcher.handlers[0] if isinstance(handler, ConversationHandler))
+
+
+def is_refused(telegram, query_id):
+    call = telegram.wait_for_call(query_id, {'answerPreCheckoutQuery'}, since=0, timeout=5)
+    if not call:
+        return True
+    _, body, _ = call
+    telegram.forget_calls(query_id)
+    return str(body.get('ok')).lower() != 'true'
+
+
+def run_burst(dispatcher, telegram, users, invoices, executor):
+    # the conversation state is read from redis before every update
+    name = get_conversation(dispatcher).name
+    for user in users:
+        dispatcher.persistence.update_conversation(name, (user.user_id,), BotStates.PRECHECKOUT)
+
+    updates = {user.user_id: user.pre_checkout(*invoices[user.user_id]) for user in users}
+    durations, _ = run_step(dispatcher, users, lambda user: updates[user.user_id], executor)
+    refused = sum(is_refused(telegram, updates[user.user_id]['pre_checkout_query']['id']) for user in users)
+    return durations, refused
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of pre-checkout answers under bursts')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--bursts', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.05, help='latency of every stub in seconds')
+    parser.add_argument('--changed', type=float, default=0.1, help='share of users changing the cart after the invoice')
+    parser.add_argument('--seed', type=int, default=1)
+    add_redis_arguments(parser)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    durations, payload_bytes = benchmark_verify()
+    print(f'snapshot verification: p50 {percentile(durations, 50) * 1e6:.1f} µs, '
+          f'p99 {percentile(durations, 99) * 1e6:.1f} µs, payload {payload_bytes} bytes')
+
+    redis_base = connect_redis(args)
+
+    moltin_stub = MoltinStub(latency=args.latency)
+    geocoder_stub = YandexGeocoderStub(latency=args.latency)
+    telegram = TelegramStub(latency=args.latency)
+    with moltin_stub, geocoder_stub, telegram:
+        bot = ExtBot(TOKEN,
+                     base_url=telegram.bot_url,
+                     defaults=Defaults(run_async=False),
+                     request=Request(con_pool_size=args.concurrency + 12))
+        moltin = MoltinClient(token='stub-token', base_url=moltin_stub.url, pool_maxsize=args.concurrency + 8)
+        dispatcher = build_dispatcher(bot,
+                                      redis_base,
+                                      moltin,
+                                      yandex_geo_api='stub-key',
+                                      payment_token='stub-payment-token',
+                                      workers=1,
+                                      send_rate=10000,
+                                      chat_send_rate=1000,
+                                      geocoder_url=geocoder_stub.geocoder_url)
+        errors = []
+        dispatcher.add_error_handler(lambda update, context: errors.append(context.error))
+        dispatcher.bot_data['catalog'].refresh()
+
+        update_ids = count(1)
+        message_ids = count(1)
+        users = [FlowUser(FIRST_USER_ID + number, update_ids, message_ids) for number in range(args.users)]
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for name, build_update in build_steps(dispatcher, telegram):
+                if name == 'pre_checkout':
+                    break
+                run_step(dispatcher, users, build_update, executor)
+            invoices = {user.user_id: get_invoice(telegram, user) for user in users}
+            users = [user for user in users if invoices[user.user_id][1] != 'no-invoice']
+            print(f'{len(users)} users got an invoice, {len(errors)} handlers failed on the way')
+
+            cart_mirror = dispatcher.bot_data['cart_mirror']
+            product_id = get_product_ids(dispatcher, 1)[0]
+            changed_users = random.sample(users, int(len(users) * args.changed))
+            for user in changed_users:
+                cart_mirror.add(dispatcher.user_data[user.user_id]['cart_id'], product_id)
+
+            header = (f'{"check":<10} {"p50":>10} {"p95":>10} {"p99":>10} {"max":>10} {"refused":>8} '
+                      f'{"expected":>8} {"errors":>7} {"moltin":>7}')
+            print(header)
+            print('-' * len(header))
+            # without the snapshot the cart has to be re-read from Moltin before answering
+            modes = [('snapshot', cart_mirror.peek), ('moltin', cart_mirror.reload)]
+            for mode, read_cart in modes:
+                cart_mirror.peek = read_cart
+                moltin_stub.reset_calls()
+                errors.clear()
+                durations = []
+                refused = 0
+                for _ in range(args.bursts):
+                    burst_durations, burst_refused = run_burst(dispatcher, telegram, users, invoices, executor)
+                    durations += burst_durations
+                    refused += burst_refused
+                queries = len(users) * args.bursts
+                print(f'{mode:<10} {ms(percentile(durations, 50)):>10} {ms(percentile(durations, 95)):>10} '
+                      f'{ms(percentile(durations, 99)):>10} {ms(max(durations)):>10} {refused:>8} '
+                      f'{len(changed_users) * args.bursts:>8} {len(errors):>7} '
+                      f'{moltin_stub.reset_calls() / queries:>7.2f}')
+            del cart_mirror.peek
+        close_bot_data(dispatcher.bot_data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+import redis
+
+
+def add_redis_arguments(parser):
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15', help='database the benchmark writes to')
+    parser.add_argument('--flush', action='store_true', help='delete the keys of a database that is not empty')
+
+
+def connect_redis(args, **kwargs):
+    """Connects to --redis-url, a database with keys is flushed only with --flush"""
+    redis_base = redis.Redis.from_url(args.redis_url, decode_responses=True, **kwargs)
+    keys = redis_base.dbsize()
+    if keys and not args.flush:
+        raise SystemExit(f'{args.redis_url} has {keys} keys, choose an empty database or pass --flush to delete them')
+    redis_base.flushdb()
+    return redis_base
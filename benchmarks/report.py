@@ -0,0 +1,9 @@
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def ms(seconds):
+    return f'{seconds * 1000:.2f} ms'
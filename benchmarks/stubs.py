@@ -0,0 +1,433 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # bursts of new connections overflow the default backlog of 5 and get reset
+    request_queue_size = 1024
+
+
+class StubServer:
+    """
+    Local HTTP/1.1 keep-alive server. Routes are (method, regex, callback) tuples,
+    a callback gets the match, the query params and the parsed body and returns (status, payload).
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.routes = []
+        self.calls = 0
+        self._calls_lock = threading.Lock()
+        self.server = StubHTTPServer((host, port), self._build_handler())
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def route(self, method, pattern, callback):
+        self.routes.append((method, re.compile(f'^{pattern}$'), callback))
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_calls(self):
+        with self._calls_lock:
+            calls, self.calls = self.calls, 0
+        return calls
+
+    def dispatch(self, method, path, query, body):
+        with self._calls_lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return 503, {'errors': [{'status': 503, 'title': 'Stub error'}]}
+        for route_method, pattern, callback in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                return callback(match, query, body)
+        return 404, {'errors': [{'status': 404, 'title': 'Not found'}]}
+
+    def _build_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                raw_body = self.rfile.read(length) if length else b''
+                content_type = self.headers.get('Content-Type') or ''
+                if raw_body and content_type.startswith('application/json'):
+                    body = json.loads(raw_body)
+                elif raw_body and content_type.startswith('application/x-www-form-urlencoded'):
+                    body = {key: values[0] for key, values in parse_qs(raw_body.decode()).items()}
+                else:
+                    body = raw_body
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+                status, payload = stub.dispatch(self.command, url.path, query, body)
+                encoded = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+        return Handler
+
+
+def format_price(amount):
+    return f'{amount / 100:.2f}'
+
+
+class MoltinStub(StubServer):
+    """In-memory imitation of the api.moltin.com endpoints used by elastic_api.py"""
+
+    def __init__(self, products_qty=8, pizzerias_qty=5, **kwargs):
+        super().__init__(**kwargs)
+        self.lock = threading.Lock()
+        self.products = {}
+        self.files = {}
+        self.carts = {}
+        self.entries = {'pizzeria': {}, 'customer-address': {}}
+
+        for num in range(products_qty):
+            file_id = str(uuid.uuid4())
+            self.files[file_id] = {
+                'id': file_id,
+                'type': 'file',
+                'link': {'href': f'https://files.example.com/pizza-{num}.jpg'},
+            }
+            product_id = str(uuid.uuid4())
+            self.products[product_id] = {
+                'id': product_id,
+                'type': 'product',
+                'name': f'Пицца {num}',
+                'slug': f'pizza-{num}',
+                'description': 'Тесто, томатный соус, моцарелла',
+                'price': [{'amount': 400 + num * 50, 'currency': 'RUB', 'includes_tax': True}],
+                'relationships': {'main_image': {'data': {'type': 'main_image', 'id': file_id}}},
+            }
+        for num in range(pizzerias_qty):
+            entry_id = str(uuid.uuid4())
+            self.entries['pizzeria'][entry_id] = {
+                'id': entry_id,
+                'type': 'entry',
+                'address': f'Москва, улица Пиццерийная, {num + 1}',
+                'alias': f'Пиццерия {num + 1}',
+                'latitude': 55.75 + num * 0.01,
+                'longitude': 37.61 + num * 0.01,
+                'deliveryman-telegram-id': 1000 + num,
+            }
+
+        self.route('POST', '/oauth/access_token', self.access_token)
+        self.route('GET', '/v2/products', self.list_products)
+        self.route('GET', '/v2/products/(?P<product_id>[^/]+)', self.get_product)
+        self.route('GET', '/v2/files', self.list_files)
+        self.route('GET', '/v2/files/(?P<file_id>[^/]+)', self.get_file)
+        self.route('GET', '/v2/fields', self.list_fields)
+        self.route('GET', '/v2/flows/(?P<flow_slug>[^/]+)/fields', self.list_flow_fields)
+        self.route('GET', '/v2/flows/(?P<flow_slug>[^/]+)/entries', self.list_entries)
+        self.route('POST', '/v2/flows/(?P<flow_slug>[^/]+)/entries', self.create_entry)
+        self.route('POST', '/v2/carts', self.create_cart)
+        self.route('GET', '/v2/carts/(?P<cart_id>[^/]+)', self.get_cart)
+        self.route('GET', '/v2/carts/(?P<cart_id>[^/]+)/items', self.get_cart_items)
+        self.route('POST', '/v2/carts/(?P<cart_id>[^/]+)/items', self.add_cart_item)
+        self.route('DELETE', '/v2/carts/(?P<cart_id>[^/]+)/items/(?P<item_id>[^/]+)', self.remove_cart_item)
+
+    @staticmethod
+    def paginate(items, query):
+        limit = int(query.get('page[limit]', 100))
+        offset = int(query.get('page[offset]', 0))
+        total_pages = max(1, -(-len(items) // limit))
+        return 200, {
+            'data': items[offset:offset + limit],
+            'meta': {
+                'page': {'limit': limit, 'offset': offset, 'current': offset // limit + 1, 'total': total_pages},
+                'results': {'total': len(items)},
+            },
+        }
+
+    def access_token(self, match, query, body):
+        return 200, {'access_token': uuid.uuid4().hex, 'expires_in': 3600, 'token_type': 'Bearer'}
+
+    def list_products(self, match, query, body):
+        return self.paginate(list(self.products.values()), query)
+
+    def get_product(self, match, query, body):
+        product = self.products.get(match['product_id'])
+        if not product:
+            return 404, {'errors': [{'status': 404, 'title': 'Product not found'}]}
+        return 200, {'data': product}
+
+    def list_files(self, match, query, body):
+        return self.paginate(list(self.files.values()), query)
+
+    def get_file(self, match, query, body):
+        file = self.files.get(match['file_id'])
+        if not file:
+            return 404, {'errors': [{'status': 404, 'title': 'File not found'}]}
+        return 200, {'data': file}
+
+    def list_fields(self, match, query, body):
+        return self.paginate([], query)
+
+    def list_flow_fields(self, match, query, body):
+        flow_id = match['flow_slug']
+        fields = [
+            {'slug': slug, 'relationships': {'flow': {'data': {'type': 'flow', 'id': flow_id}}}}
+            for slug in ('address', 'alias', 'longitude', 'latitude')
+        ]
+        return 200, {'data': fields}
+
+    def list_entries(self, match, query, body):
+        entries = list(self.entries.setdefault(match['flow_slug'], {}).values())
+        return self.paginate(entries, query)
+
+    def create_entry(self, match, query, body):
+        entry = dict(body['data'], id=str(uuid.uuid4()))
+        with self.lock:
+            self.entries.setdefault(match['flow_slug'], {})[entry['id']] = entry
+        return 201, {'data': entry}
+
+    def create_cart(self, match, query, body):
+        cart_id = str(uuid.uuid4())
+        with self.lock:
+            self.carts[cart_id] = {}
+        return 201, {'data': {'id': cart_id, 'type': 'cart', 'name': body['data']['name']}}
+
+    def cart_items_payload(self, cart_id):
+        items = []
+        total = 0
+        for item_id, (product_id, quantity) in self.carts.get(cart_id, {}).items():
+            product = self.products[product_id]
+            unit_price = product['price'][0]['amount']
+            total += unit_price * quantity
+            items.append({
+                'id': item_id,
+                'type': 'cart_item',
+                'product_id': product_id,
+                'name': product['name'],
+                'quantity': quantity,
+                'meta': {'display_price': {
+                    'with_tax': {
+                        'unit': {'amount': unit_price, 'formatted': format_price(unit_price)},
+                        'value': {'amount': unit_price * quantity, 'formatted': format_price(unit_price * quantity)},
+                    },
+                    'without_tax': {
+                        'unit': {'amount': unit_price, 'formatted': format_price(unit_price)},
+                        'value': {'amount': unit_price * quantity, 'formatted': format_price(unit_price * quantity)},
+                    },
+                }},
+            })
+        display_price = {'with_tax': {'amount': total, 'currency': 'RUB', 'formatted': format_price(total)}}
+        return items, display_price
+
+    def get_cart(self, match, query, body):
+        _, display_price = self.cart_items_payload(match['cart_id'])
+        return 200, {'data': {'id': match['cart_id'], 'type': 'cart', 'meta': {'display_price': display_price}}}
+
+    def get_cart_items(self, match, query, body):
+        items, display_price = self.cart_items_payload(match['cart_id'])
+        return 200, {'data': items, 'meta': {'display_price': display_price}}
+
+    def add_cart_item(self, match, query, body):
+        product_id = body['data']['id']
+        quantity = int(body['data'].get('quantity', 1))
+        if product_id not in self.products:
+            return 404, {'errors': [{'status': 404, 'title': 'Product not found'}]}
+        with self.lock:
+            cart = self.carts.setdefault(match['cart_id'], {})
+            for item_id, (item_product_id, item_quantity) in cart.items():
+                if item_product_id == product_id:
+                    cart[item_id] = (product_id, item_quantity + quantity)
+                    break
+            else:
+                cart[str(uuid.uuid4())] = (product_id, quantity)
+            items, display_price = self.cart_items_payload(match['cart_id'])
+        return 201, {'data': items, 'meta': {'display_price': display_price}}
+
+    def remove_cart_item(self, match, query, body):
+        with self.lock:
+            self.carts.get(match['cart_id'], {}).pop(match['item_id'], None)
+            items, display_price = self.cart_items_payload(match['cart_id'])
+        return 200, {'data': items, 'meta': {'display_price': display_price}}
+
+
+class TelegramStub(StubServer):
+    """
+    Imitation of the Telegram Bot API: sent messages are counted by method, updates pushed
+    with `push_update` are given out by getUpdates. A Bot should be created with `base_url=stub.bot_url`.
+    Calls are also remembered by chat, callback query and pre-checkout query, so a client
+    can wait for the answer to its update with `wait_for_call`.
+    """
+
+    reply_keys = ('chat_id', 'callback_query_id', 'pre_checkout_query_id')
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.lock = threading.Lock()
+        self.methods = Counter()
+        self.sent = []
+        self._message_id = 0
+        self._updates = []
+        self._update_id = 0
+        self._updates_condition = threading.Condition()
+        self._calls_by_key = {}
+        self._calls_condition = threading.Condition()
+        self.route('POST', '/bot(?P<token>[^/]+)/(?P<method>\\w+)', self.call_method)
+
+    @property
+    def bot_url(self):
+        return f'{self.url}/bot'
+
+    def push_update(self, update):
+        """Queues an update for getUpdates, update ids are given in the order of pushing like Telegram does"""
+        with self._updates_condition:
+            self._update_id += 1
+            update['update_id'] = self._update_id
+            self._updates.append(update)
+            self._updates_condition.notify_all()
+
+    def get_updates(self, body):
+        offset = int(body.get('offset') or 0)
+        limit = int(body.get('limit') or 100)
+        timeout = min(float(body.get('timeout') or 0), 1.0)
+        with self._updates_condition:
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            if not self._updates and timeout:
+                self._updates_condition.wait(timeout)
+            return self._updates[:limit]
+
+    def _remember_call(self, method, body, result):
+        called_at = time.perf_counter()
+        with self._calls_condition:
+            for key in self.reply_keys:
+                if body.get(key) is not None:
+                    calls = self._calls_by_key.setdefault(str(body[key]), [])
+                    calls.append((called_at, method, body, result))
+                    del calls[:-20]
+            self._calls_condition.notify_all()
+
+    def wait_for_call(self, key, methods, since, timeout, accept=None):
+        """Returns (method, body, result) of the first call of `methods` for `key` made after `since`"""
+        deadline = time.perf_counter() + timeout
+
+        def find_call():
+            for called_at, method, body, result in self._calls_by_key.get(str(key), ()):
+                if called_at > since and method in methods and (accept is None or accept(body)):
+                    return method, body, result
+            return None
+
+        with self._calls_condition:
+            call = find_call()
+            while call is None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                self._calls_condition.wait(remaining)
+                call = find_call()
+        return call
+
+    def forget_calls(self, key):
+        with self._calls_condition:
+            self._calls_by_key.pop(str(key), None)
+
+    def build_message(self, body):
+        with self.lock:
+            self._message_id += 1
+            message_id = self._message_id
+        chat_id = int(body.get('chat_id') or 0)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }
+        if 'text' in body:
+            message['text'] = body['text']
+        if 'caption' in body:
+            message['caption'] = body['caption']
+        if 'photo' in body or not isinstance(body, dict):
+            message['photo'] = [{
+                'file_id': f'photo-{message_id}',
+                'file_unique_id': f'unique-{message_id}',
+                'width': 800,
+                'height': 800,
+            }]
+        return message
+
+    def call_method(self, match, query, body):
+        method = match['method']
+        if not isinstance(body, dict):
+            body = {'photo': True}
+        with self.lock:
+            self.methods[method] += 1
+            self.sent.append((method, body))
+            del self.sent[:-1000]
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Pizzeria', 'username': 'pizzeria_bot'}
+        elif method == 'getUpdates':
+            result = self.get_updates(body)
+        elif method in ('sendMessage', 'sendPhoto', 'sendLocation', 'sendInvoice', 'editMessageText',
+                        'editMessageReplyMarkup'):
+            result = self.build_message(body)
+        else:
+            result = True
+        self._remember_call(method, body, result)
+        return 200, {'ok': True, 'result': result}
+
+
+class YandexGeocoderStub(StubServer):
+    """
+    Imitation of the Yandex geocoder: every address is found near the center of Moscow,
+    the same address always at the same point. Addresses containing `unknown` aren't found.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.route('GET', '/1.x/?', self.geocode)
+
+    @property
+    def geocoder_url(self):
+        return f'{self.url}/1.x'
+
+    def geocode(self, match, query, body):
+        address = query.get('geocode', '')
+        found_places = []
+        if 'unknown' not in address.lower():
+            jitter = random.Random(address)
+            latitude = 55.75 + jitter.uniform(-0.05, 0.05)
+            longitude = 37.61 + jitter.uniform(-0.05, 0.05)
+            found_places.append({'GeoObject': {'Point': {'pos': f'{longitude:.6f} {latitude:.6f}'}}})
+        return 200, {'response': {'GeoObjectCollection': {'featureMember': found_places}}}
@@ -0,0 +1,121 @@
+"""
+Compares update intake throughput of long polling and of the webhook mode.
+Updates are produced by a fake Telegram: the Telegram stub for polling and sender
+processes posting to the webhook concurrently.
+
+    python -m benchmarks.webhook --updates 5000 --senders 8 --queue-size 1000
+"""
+import argparse
+import threading
+import time
+from multiprocessing import Pool
+from queue import Queue
+
+import requests
+from telegram.ext import Dispatcher, ExtBot, JobQueue, TypeHandler, Updater
+from telegram.utils.request import Request
+
+from benchmarks.stubs import TelegramStub
+from webhook import BotHTTPServer, start_webhook
+
+TOKEN = '123456:stub-token'
+
+
+def build_update(update_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': update_id % 1000, 'type': 'private'},
+            'from': {'id': update_id % 1000, 'is_bot': False, 'first_name': 'Покупатель'},
+            'text': '/start',
+        },
+    }
+
+
+class UpdateCounter:
+    def __init__(self, expected):
+        self.expected = expected
+        self.handled = 0
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, update, context):
+        with self._lock:
+            self.handled += 1
+            if self.handled >= self.expected:
+                self.done.set()
+
+
+def send_updates(url, update_ids):
+    session = requests.Session()
+    rejected = 0
+    for update_id in update_ids:
+        while session.post(url, json=build_update(update_id)).status_code == 429:
+            rejected += 1
+            time.sleep(0.01)
+    return rejected
+
+
+def build_updater(telegram, queue_size, counter):
+    bot = ExtBot(TOKEN, base_url=telegram.bot_url, request=Request(con_pool_size=8))
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(bot, Queue(maxsize=queue_size), workers=4, job_queue=job_queue)
+    job_queue.set_dispatcher(dispatcher)
+    dispatcher.add_handler(TypeHandler(object, counter))
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def bench_polling(updates_qty, queue_size):
+    with TelegramStub() as telegram:
+        counter = UpdateCounter(updates_qty)
+        updater = build_updater(telegram, queue_size, counter)
+        for update_id in range(1, updates_qty + 1):
+            telegram.push_update(build_update(update_id))
+
+        started_at = time.perf_counter()
+        updater.start_polling(poll_interval=0, timeout=1)
+        counter.done.wait(120)
+        elapsed = time.perf_counter() - started_at
+        updater.stop()
+    return elapsed, 0
+
+
+def bench_webhook(updates_qty, queue_size, senders):
+    with TelegramStub() as telegram:
+        counter = UpdateCounter(updates_qty)
+        updater = build_updater(telegram, queue_size, counter)
+        http_server = BotHTTPServer(('127.0.0.1', 0)).start()
+        host, port = http_server.server_address
+        start_webhook(updater, http_server, url_path='telegram', webhook_url=f'http://{host}:{port}')
+        url = f'http://{host}:{port}/telegram'
+
+        started_at = time.perf_counter()
+        with Pool(processes=senders) as pool:
+            chunks = [range(first, updates_qty + 1, senders) for first in range(1, senders + 1)]
+            rejected = sum(pool.starmap(send_updates, [(url, chunk) for chunk in chunks]))
+        counter.done.wait(120)
+        elapsed = time.perf_counter() - started_at
+        updater.stop()
+        http_server.shutdown()
+    return elapsed, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of update intake: polling vs webhook')
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--senders', type=int, default=8)
+    parser.add_argument('--queue-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    results = {
+        'polling': bench_polling(args.updates, args.queue_size),
+        'webhook': bench_webhook(args.updates, args.queue_size, args.senders),
+    }
+    for mode, (elapsed, rejected) in results.items():
+        print(f'{mode:>8}: {args.updates / elapsed:.0f} updates/s, {rejected} refused with 429')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,53 @@
+import json
+import logging
+import threading
+from functools import partial
+from queue import Queue
 from textwrap import dedent
 import redis
 from enum import Enum, auto
 from environs import Env
 from telegram.ext import (Updater,
+                          Dispatcher,
+                          JobQueue,
+                          ExtBot,
+                          Defaults,
                           CallbackQueryHandler,
                           CommandHandler,
                           MessageHandler,
                           Filters,
-                          ConversationHandler, PreCheckoutQueryHandler)
+                          ConversationHandler, PreCheckoutQueryHandler, DispatcherHandlerStop)
 from telegram import (InlineKeyboardButton,
                       InlineKeyboardMarkup,
                       ReplyKeyboardRemove,
                       KeyboardButton,
                       ReplyKeyboardMarkup,
                       LabeledPrice)
-from more_itertools import chunked
-from elastic_api import (get_all_products,
-                         get_product_info,
-                         get_image_link,
-                         get_cart,
-                         add_product_to_cart,
-                         create_cart,
-                         get_cart_total_price,
-                         remove_product_from_cart,
-                         renew_token,
-                         fetch_pizzerias_with_coordinates,
-                         create_entry)
-
-from bot_tools import (BidirectionalIterator,
-                       format_cart,
-                       format_product_description,
+from telegram.utils.request import Request
+from elastic_api import MoltinClient
+from catalog import CatalogCache, refresh_catalog
+from product_cards import ProductCardStore
+from menu_pages import MenuPages
+from cart_mirror import CartMirror
+from cart_queue import CartWriteQueue
+
+from bot_tools import (format_cart,
                        build_menu)
-from geo_api import show_nearest_pizzeria, fetch_coordinates
+from geo_api import GeocodingCache, YANDEX_GEOCODER_URL
+from delivery_zones import SCOOTER_MAX_DISTANCE, DeliveryZones, load_pizzerias
+from webhook import BotHTTPServer, get_webhook_secret, start_webhook
+from persistence import RedisPersistence
+from token_manager import TokenManager
+from send_scheduler import SendScheduler, URGENT, COSMETIC
+from cms_buffer import CmsWriteBuffer, get_spill_path
+from courier_dispatch import CourierDispatch, start_workers, stop_workers
+from courier_registry import CourierRegistry
+from delayed_jobs import DelayedJobs, get_job_handlers, start_job_workers, stop_job_workers
+from metrics import BotMetrics
+from order_snapshot import InvalidSnapshot, OrderSigner, get_items_hash
+from resilience import UPSTREAM_ERRORS
+
+logger = logging.getLogger(__name__)
 
 
 class BotStates(Enum):
@@ -55,141 +71,153 @@ def take_payment(update, context):
     if context.user_data['delivery_type'] == 'Самовывоз':
         context.user_data['delivery_price'] = 0
 
-    price = context.user_data['delivery_price'] + float(context.user_data['order_price']) * 100
-    price = int(price)
+    cart = get_cart(context)
+    delivery_price = context.user_data['delivery_price']
+    price = cart['total'] + delivery_price
     user_id = update.effective_user.id
-    context.bot.send_message(
-        chat_id=user_id,
-        text='Формирую счет...'
-    )
+    sender = context.bot_data['send_scheduler']
+    # the invoice is urgent, the message before it must not be overtaken by it
+    sender.submit('send_message', priority=URGENT, chat_id=user_id, text='Формирую счет...')
     payment_token = context.bot_data['payment_token']
     title = 'Ваш заказ'
     description = f'Оплата заказа стоимостью {price} рублей'
-    payload = 'Custom-Payload'
+    payload = context.bot_data['order_signer'].sign(user_id, context.user_data['cart_id'], cart['items'],
+                                                    cart['total'], delivery_price)
     currency = 'RUB'
     prices = [LabeledPrice('Стоимость', price * 100)]
 
-    context.bot.send_invoice(
-        user_id, title, description, payload, payment_token, currency, prices
-    )
+    sender.submit('send_invoice', priority=URGENT, chat_id=user_id, title=title, description=description,
+                  payload=payload, provider_token=payment_token, currency=currency, prices=prices)
     return BotStates.PRECHECKOUT
 
 
-def precheckout(update, _):
+def is_cart_changed(context, order):
+    if context.bot_data['cart_queue'].is_pending(order.cart_id):
+        return True
+    cart = context.bot_data['cart_mirror'].peek(order.cart_id)
+    return not cart or get_items_hash(cart['items']) != order.items_hash
+
+
+def precheckout(update, context):
     query = update.pre_checkout_query
-    if query.invoice_payload != 'Custom-Payload':
+    try:
+        order = context.bot_data['order_signer'].verify(query.from_user.id, query.invoice_payload)
+    except InvalidSnapshot:
         query.answer(ok=False, error_message='Что-то пошло не так...')
-    else:
-        query.answer(ok=True)
+        return BotStates.PRECHECKOUT
+
+    if query.currency != 'RUB' or query.total_amount != (order.total + order.delivery_fee) * 100:
+        query.answer(ok=False, error_message='Что-то пошло не так...')
+        return BotStates.PRECHECKOUT
+    if is_cart_changed(context, order):
+        query.answer(ok=False, error_message='Корзина изменилась после выставления счета, оформите заказ заново')
+        return BotStates.PRECHECKOUT
 
+    query.answer(ok=True)
     return BotStates.SUCCESS_PAYMENT
 
 
 def cancel(update, context):
     text = 'Пока'
 
-    update.message.reply_text(
-        text,
+    context.bot_data['send_scheduler'].submit(
+        'send_message',
+        chat_id=update.message.chat_id,
+        text=text,
         reply_markup=ReplyKeyboardRemove()
     )
     return ConversationHandler.END
 
 
 def handle_menu(update, context):
-    bot = context.bot
+    sender = context.bot_data['send_scheduler']
     redis_base = context.bot_data['redis_base']
-    token = context.bot_data['token']
+    moltin = context.bot_data['moltin']
     user_id = update.effective_user.id
 
-    products = get_all_products(token).get('data')
-    pizzas_qty = 3
-    chunked_products = list(chunked(products, pizzas_qty))
-    iterable_products = BidirectionalIterator(chunked_products)
-    context.user_data['iterable_products'] = iterable_products
-    context.user_data['products_pack'] = next(iter(chunked_products))
+    menu_page, reply_markup = context.bot_data['menu_pages'].get_page(0)
+    context.user_data['menu_page'] = menu_page
 
     cart_id = redis_base.hget(user_id, 'cart')
 
     if not cart_id:
-        cart_id = create_cart(token, str(user_id))['data']['id']
+        cart_id = moltin.create_cart(str(user_id))['data']['id']
         redis_base.hset(user_id, 'cart', cart_id)
     context.user_data['cart_id'] = cart_id
 
-    keyboard = build_menu(
-        [InlineKeyboardButton(product.get('name'),
-                              callback_data=product.get('id')) for product in context.user_data['products_pack']],
-        n_cols=3,
-        footer_buttons=[[InlineKeyboardButton('Назад', callback_data='Назад')],
-                        [InlineKeyboardButton('Вперед', callback_data='Вперед')],
-                        [InlineKeyboardButton('Корзина', callback_data='Корзина')]])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    bot.send_message(text='Смотри, какая пицца!',
-                     chat_id=user_id,
-                     reply_markup=reply_markup)
+    sender.submit('send_message',
+                  text=MenuPages.text,
+                  chat_id=user_id,
+                  reply_markup=reply_markup)
 
     return BotStates.HANDLE_DESCRIPTION
 
 
 def handle_products(update, context):
-    user_id = update.effective_user.id
     callback_query = update.callback_query
-    iterable_products = context.user_data['iterable_products']
-
+    message = callback_query.message
+    menu_page = context.user_data.get('menu_page', 0)
     if callback_query.data == 'Назад':
-        products_pack = iterable_products.prev()
-        context.user_data['products_pack'] = products_pack
-
+        menu_page -= 1
     elif callback_query.data == 'Вперед':
-        products_pack = iterable_products.next()
-        context.user_data['products_pack'] = products_pack
-
-    keyboard = build_menu(
-        [InlineKeyboardButton(product.get('name'),
-                              callback_data=product.get('id')) for product in context.user_data['products_pack']],
-        n_cols=3,
-        footer_buttons=[[InlineKeyboardButton('Назад', callback_data='Назад')],
-                        [InlineKeyboardButton('Вперед', callback_data='Вперед')],
-                        [InlineKeyboardButton('Корзина', callback_data='Корзина')]])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    context.bot.send_message(text=f'Смотри, какая пицца!',
-                             chat_id=user_id,
-                             reply_markup=reply_markup)
-    context.bot.delete_message(chat_id=callback_query.message.chat_id,
-                               message_id=callback_query.message.message_id)
+        menu_page += 1
+    menu_page, reply_markup = context.bot_data['menu_pages'].get_page(menu_page)
+    context.user_data['menu_page'] = menu_page
+    sender = context.bot_data['send_scheduler']
+
+    if message.photo:
+        # a product card can't be turned into a text message
+        sender.submit('send_message',
+                      text=MenuPages.text,
+                      chat_id=message.chat_id,
+                      reply_markup=reply_markup)
+        sender.submit('delete_message', priority=COSMETIC,
+                      chat_id=message.chat_id,
+                      message_id=message.message_id)
+    elif message.text != MenuPages.text:
+        sender.submit('edit_message_text',
+                      text=MenuPages.text,
+                      chat_id=message.chat_id,
+                      message_id=message.message_id,
+                      reply_markup=reply_markup)
+    elif message.reply_markup != reply_markup:
+        # the new page is the answer to the click, not a cosmetic
+        sender.submit('edit_message_reply_markup',
+                      chat_id=message.chat_id,
+                      message_id=message.message_id,
+                      reply_markup=reply_markup)
+    else:
+        callback_query.answer()
     return BotStates.HANDLE_DESCRIPTION
 
 
 def handle_description(update, context):
-    bot = context.bot
+    sender = context.bot_data['send_scheduler']
 
-    token = context.bot_data['token']
+    product_cards = context.bot_data['product_cards']
     callback_query = update.callback_query
     product_id = callback_query.data
     context.user_data['product_id'] = product_id
 
-    product_description = get_product_info(token, product_id)
-    product_image_id = product_description['data']['relationships']['main_image']['data']['id']
-    image_link = get_image_link(token, product_image_id)
-    formatted_product_description = format_product_description(product_description)
-
-    keyboard = [[
-        InlineKeyboardButton('В меню', callback_data='В меню'),
-        InlineKeyboardButton('Добавить в корзину', callback_data='Добавить в корзину'),
-        InlineKeyboardButton('Корзина', callback_data='Корзина')
-    ]]
+    product_card = product_cards.get_card(product_id)
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    bot.send_photo(
+    sent_photo = sender.submit(
+        'send_photo',
         chat_id=callback_query.message.chat_id,
-        photo=image_link,
-        caption=formatted_product_description,
-        reply_markup=reply_markup,
+        photo=product_card.photo,
+        caption=product_card.caption,
+        reply_markup=product_card.reply_markup,
     )
 
-    bot.delete_message(
+    def remember_file_id(future):
+        if not future.exception():
+            product_cards.remember_file_id(product_id, future.result())
+
+    sent_photo.add_done_callback(remember_file_id)
+
+    sender.submit(
+        'delete_message',
+        priority=COSMETIC,
         chat_id=callback_query.message.chat_id,
         message_id=callback_query.message.message_id,
     )
@@ -198,47 +226,61 @@ def handle_description(update, context):
 
 
 def update_cart(update, context):
-    token = context.bot_data['token']
     cart_id = context.user_data['cart_id']
     product_id = context.user_data['product_id']
-    add_product_to_cart(token, cart_id, product_id)
+    context.bot_data['cart_queue'].add(cart_id, product_id, chat_id=update.effective_user.id)
+    update.callback_query.answer('Пицца добавлена в корзину')
 
     return BotStates.HANDLE_DESCRIPTION
 
 
-def handle_cart(update, context):
-    bot = context.bot
+def report_dropped_addition(send_scheduler, catalog, chat_id, product_id, quantity):
+    product_name = catalog.get_product_info(product_id)['data']['name']
+    send_scheduler.submit(
+        'send_message',
+        chat_id=chat_id,
+        text=f'Не получилось добавить в корзину пиццу {product_name} ({quantity} шт.), попробуйте еще раз',
+    )
 
-    token = context.bot_data['token']
+
+def get_cart(context):
     cart_id = context.user_data['cart_id']
+    context.bot_data['cart_queue'].flush(cart_id)
+    return context.bot_data['cart_mirror'].get(cart_id)
+
+
+def handle_cart(update, context):
+    sender = context.bot_data['send_scheduler']
+
     callback_query = update.callback_query
-    cart_items = get_cart(token, cart_id)
+    cart = get_cart(context)
 
-    context.user_data['cart_items'] = [item.get('id') for item in cart_items['data']]
-    if callback_query.data in context.user_data.get('cart_items'):
-        product_id = callback_query.data
-        remove_product_from_cart(token, cart_id, product_id)
-        cart_items = get_cart(token, cart_id)
+    cart_items_ids = [item['id'] for item in cart['items']]
+    if callback_query.data in cart_items_ids:
+        cart = context.bot_data['cart_mirror'].remove(context.user_data['cart_id'], callback_query.data)
 
     keyboard = build_menu(
-        [InlineKeyboardButton(f"Убрать пиццу {item.get('name')}",
-                              callback_data=item.get('id')) for item in cart_items['data']], n_cols=1,
+        [InlineKeyboardButton(f"Убрать пиццу {item['name']}",
+                              callback_data=item['id']) for item in cart['items']], n_cols=1,
         footer_buttons=[[InlineKeyboardButton('Оплатить',
                                               callback_data='Оплатить')],
                         [InlineKeyboardButton('В меню',
                                               callback_data='В меню')]])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
-    order_price = get_cart_total_price(token, cart_id)['data']['meta']['display_price']['with_tax']['formatted']
+    order_price = cart['total_formatted']
 
     context.user_data['order_price'] = order_price
 
-    bot.delete_message(
+    sender.submit(
+        'delete_message',
+        priority=COSMETIC,
         chat_id=callback_query.message.chat_id,
         message_id=callback_query.message.message_id,
     )
-    bot.send_message(
-        text=format_cart(cart_items, order_price),
+    sender.submit(
+        'send_message',
+        text=format_cart(cart['items'], order_price),
         chat_id=update.callback_query.message.chat_id,
         reply_markup=reply_markup,
     )
@@ -247,14 +289,16 @@ def handle_cart(update, context):
 
 
 def get_user_email(update, context):
-    bot = context.bot
+    sender = context.bot_data['send_scheduler']
     callback_query = update.callback_query
 
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton('Назад',
                                                            callback_data='Назад')]])
 
-    if context.user_data['order_price'] == '0':
-        bot.edit_message_text(
+    cart = get_cart(context)
+    if not cart['items']:
+        sender.submit(
+            'edit_message_text',
             text='Похоже, что в корзине нет товаров.',
             chat_id=callback_query.message.chat_id,
             message_id=callback_query.message.message_id,
@@ -262,7 +306,8 @@ def get_user_email(update, context):
         )
         return BotStates.HANDLE_MENU
 
-    bot.edit_message_text(
+    sender.submit(
+        'edit_message_text',
         text='Введите, пожалуйста, свой e-mail в формате username@email.com',
         chat_id=callback_query.message.chat_id,
         message_id=callback_query.message.message_id,
@@ -281,8 +326,10 @@ def get_user_address(update, context):
 
     reply_markup = ReplyKeyboardMarkup(buttons, resize_keyboard=True)
 
-    update.message.reply_text(
-        'Пожалуйста, отправьте нам свой адрес или разрешите определить его автоматически',
+    context.bot_data['send_scheduler'].submit(
+        'send_message',
+        chat_id=update.message.chat_id,
+        text='Пожалуйста, отправьте нам свой адрес или разрешите определить его автоматически',
         reply_markup=reply_markup
     )
 
@@ -295,78 +342,101 @@ def process_user_address(update, context):
 
     elif update.message.text:
         address = update.message.text
-        coordinates = fetch_coordinates(context.bot_data['yandex_geo_api'], address)
+        try:
+            coordinates = context.bot_data['geocoder'].fetch_coordinates(address)
+        except UPSTREAM_ERRORS:
+            context.bot_data['send_scheduler'].submit(
+                'send_message',
+                chat_id=update.message.chat_id,
+                text='Не получается найти адрес, попробуйте чуть позже или отправьте гео-точку'
+            )
+            return BotStates.WAITING_GEO
         if not coordinates:
-            update.message.reply_text(
-                'Адрес некорректен. Проверьте то, что вы ввели, или отправьте гео-точку'
+            context.bot_data['send_scheduler'].submit(
+                'send_message',
+                chat_id=update.message.chat_id,
+                text='Адрес некорректен. Проверьте то, что вы ввели, или отправьте гео-точку'
             )
             return BotStates.WAITING_GEO
 
         context.user_data['coordinates'] = coordinates
 
-    pizzerias = fetch_pizzerias_with_coordinates(context.bot_data['token'],
-                                                 context.bot_data['flow_slug'])
-
-    nearest_pizzeria = show_nearest_pizzeria(pizzerias, context.user_data['coordinates'])
-    distance = nearest_pizzeria.get('distance')
-    address = nearest_pizzeria.get('address')
-    context.user_data['nearest_pizzeria'] = nearest_pizzeria
+    quote = get_delivery_zones(context.bot_data).quote(context.user_data['coordinates'])
+    if not quote:
+        context.bot_data['send_scheduler'].submit(
+            'send_message',
+            chat_id=update.effective_user.id,
+            text='Сейчас мы не можем принять заказ, ни одна пиццерия не работает. Попробуйте чуть позже'
+        )
+        return BotStates.WAITING_GEO
+    distance = quote.distance
+    address = quote.pizzeria.get('address')
+    context.user_data['nearest_pizzeria'] = {
+        'address': address,
+        'coordinates': quote.pizzeria.get('coordinates'),
+        'deliveryman-telegram-id': quote.pizzeria.get('deliveryman-telegram-id'),
+    }
 
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton('Назад', callback_data='Назад')],
                                      [InlineKeyboardButton('Самовывоз', callback_data='Самовывоз')],
                                      [InlineKeyboardButton('Доставка', callback_data='Доставка')]])
 
-    if distance < 0.5:
+    if quote.fee is None:
         reply_text = dedent(f'''
-        Может, заберете пиццу из нашей пиццерии неподалеку? Она всего в {round(distance * 1000, 1)} метрах от вас.
-        Адрес пиццерии {address}.
-        А можем и бесплатно доставить, нам не сложно :)
+        Простите, но так далеко мы пиццу не доставляем. Ближайшая пиццерия аж в {round(distance, 1)} километрах от вас.
+        <остроумная шутка, которую я не придумал>
         ''')
-        context.user_data['delivery_price'] = 0
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton('В корзину', callback_data='В корзину')]])
 
-    elif 0.5 < distance < 3:
+    elif quote.fee == 0:
         reply_text = dedent(f'''
-        Похоже, до вас придется ехать на самокате. Доставка будет стоить 100 рублей. Или все-таки самовывоз? :)
+        Может, заберете пиццу из нашей пиццерии неподалеку? Она всего в {round(distance * 1000, 1)} метрах от вас.
+        Адрес пиццерии {address}.
+        А можем и бесплатно доставить, нам не сложно :)
         ''')
-        context.user_data['delivery_price'] = 100
 
-    elif 3 <= distance < 20:
+    elif quote.max_distance <= SCOOTER_MAX_DISTANCE:
         reply_text = dedent(f'''
-        Похоже, до вас придется ехать на автомобиле. Доставка будет стоить 300 рублей. Или все-таки самовывоз? :)
+        Похоже, до вас придется ехать на самокате. Доставка будет стоить {quote.fee} рублей. Или все-таки самовывоз? :)
         ''')
-        context.user_data['delivery_price'] = 300
 
     else:
         reply_text = dedent(f'''
-        Простите, но так далеко мы пиццу не доставляем. Ближайшая пиццерия аж в {round(distance, 1)} километрах от вас.
-        <остроумная шутка, которую я не придумал>
+        Похоже, до вас придется ехать на автомобиле. Доставка будет стоить {quote.fee} рублей. Или все-таки самовывоз? :)
         ''')
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton('В корзину', callback_data='В корзину')]])
+    if quote.fee is not None:
+        context.user_data['delivery_price'] = quote.fee
 
-    context.bot.send_message(text=reply_text,
-                             chat_id=update.effective_user.id,
-                             reply_markup=keyboard)
+    context.bot_data['send_scheduler'].submit('send_message',
+                                              text=reply_text,
+                                              chat_id=update.effective_user.id,
+                                              reply_markup=keyboard)
 
     return BotStates.PROCESS_DELIVERY
 
 
-def send_notification(context):
-    text = "Приятного аппетита! *место для рекламы сообщение что делать если пицца не пришла"
-    job = context.job
-    context.bot.send_message(
-        job.context, text=text
-    )
+def load_delivery_zones(bot_data):
+    """Reloads pizzerias and applies them to the delivery zones, the caller holds the zones lock"""
+    pizzerias = load_pizzerias(bot_data['moltin'], bot_data['redis_base'], bot_data['flow_slug'])
+    bot_data['courier_registry'].register(pizzeria.get('deliveryman-telegram-id') for pizzeria in pizzerias)
+    if 'delivery_zones' in bot_data:
+        bot_data['delivery_zones'].sync(pizzerias)
+    else:
+        bot_data['delivery_zones'] = DeliveryZones(pizzerias)
 
 
-def add_customer_to_cms(update, context):
-    token = context.bot_data['token']
-    chat_id = update.effective_user.id
-    fields_slugs = ['longitude', 'latitude', 'email']
-    values = *context.user_data['coordinates'], context.user_data['email']
-    flow_slug = 'customer-address'
-    create_entry(token, fields_slugs, values, flow_slug)
-    send_message_after = 15
-    context.job_queue.run_once(send_notification, send_message_after, context=chat_id)
+def get_delivery_zones(bot_data):
+    """Returns the delivery zones, they are built here only if it failed at startup"""
+    if 'delivery_zones' not in bot_data:
+        with bot_data['delivery_zones_lock']:
+            if 'delivery_zones' not in bot_data:
+                load_delivery_zones(bot_data)
+    return bot_data['delivery_zones']
+
+
+def refresh_delivery_zones(context):
+    with context.bot_data['delivery_zones_lock']:
+        load_delivery_zones(context.bot_data)
 
 
 def success_payment(update, context):
@@ -382,63 +452,87 @@ def accept_pickup(update, context):
         Адрес пиццерии для самовывоза {pickup_address}        
         '''
                         )
-    context.bot.send_message(text=reply_text,
-                             chat_id=update.effective_user.id)
+    context.bot_data['send_scheduler'].submit('send_message',
+                                              priority=URGENT,
+                                              text=reply_text,
+                                              chat_id=update.effective_user.id)
 
     return ConversationHandler.END
 
 
 def accept_delivery(update, context):
-    deliveryman_telegram_id = context.user_data['nearest_pizzeria'].get('deliveryman-telegram-id')
-
-    token = context.bot_data['token']
-    cart_id = context.user_data['cart_id']
-    cart_items = get_cart(token, cart_id)
-    order_price = context.user_data['order_price']
-    reply_text = format_cart(cart_items, order_price)
-    latitude, longitude = context.user_data['coordinates']
-    context.bot.send_location(longitude=longitude,
-                              latitude=latitude,
-                              chat_id=deliveryman_telegram_id)
-    context.bot.send_message(
-        text=reply_text,
-        chat_id=deliveryman_telegram_id
-    )
+    cart = get_cart(context)
+    order = {
+        'order_id': update.message.successful_payment.telegram_payment_charge_id,
+        'deliveryman_id': context.user_data['nearest_pizzeria'].get('deliveryman-telegram-id'),
+        'pizzeria_coordinates': context.user_data['nearest_pizzeria'].get('coordinates'),
+        'coordinates': context.user_data['coordinates'],
+        'email': context.user_data['email'],
+        'text': format_cart(cart['items'], context.user_data['order_price']),
+    }
+    context.bot_data['courier_dispatch'].enqueue(order)
 
-    add_customer_to_cms(update, context)
+    send_message_after = 15
+    context.bot_data['delayed_jobs'].schedule('send_notification', send_message_after,
+                                              context=update.effective_user.id,
+                                              job_id=f'notification:{order["order_id"]}')
 
     return ConversationHandler.END
 
 
-def main():
-    env = Env()
-    env.read_env()
-    telegram_token = env.str('TG_TOKEN')
-    redis_host = env.str('REDIS_HOST')
-    redis_port = env.str('REDIS_PORT')
-    redis_password = env.str('REDIS_PASSWORD')
-    client_id = env.str('ELASTIC_CLIENT_ID')
-    client_secret = env.str('ELASTIC_CLIENT_SECRET')
-    yandex_geo_api = env.str('YANDEX_GEO_API')
-    payment_token = env.str('PAYMENT_TOKEN')
+def handle_courier_location(update, context):
+    message = update.edited_message or update.message
+    registry = context.bot_data['courier_registry']
+    if not registry.is_courier(message.from_user.id):
+        return
+    registry.update_location(message.from_user.id, message.location.latitude, message.location.longitude)
+    if update.message:
+        context.bot_data['send_scheduler'].submit(
+            'send_message',
+            chat_id=message.chat_id,
+            text='Вы на смене, заказы будут приходить сюда. Чтобы закончить смену, отправьте /end_shift'
+        )
+    # a courier sharing live location is not a customer sending the address
+    raise DispatcherHandlerStop
+
+
+def handle_end_shift(update, context):
+    registry = context.bot_data['courier_registry']
+    if not registry.is_courier(update.effective_user.id):
+        return
+    registry.leave(update.effective_user.id)
+    context.bot_data['send_scheduler'].submit(
+        'send_message',
+        chat_id=update.effective_chat.id,
+        text='Смена закончена, новые заказы вам не придут. Чтобы начать смену, поделитесь трансляцией геопозиции'
+    )
+    raise DispatcherHandlerStop
 
-    updater = Updater(telegram_token)
 
-    redis_base = redis.Redis(host=redis_host,
-                             port=redis_port,
-                             password=redis_password,
-                             decode_responses=True)
+def handle_delivered(update, context):
+    query = update.callback_query
+    order_id = query.data.split(':', 1)[1]
+    courier_registry = context.bot_data['courier_registry']
+    courier_id = courier_registry.get_courier(order_id)
+    if courier_id is not None and courier_id != query.from_user.id:
+        query.answer('Этот заказ назначен другому курьеру', show_alert=True)
+        raise DispatcherHandlerStop
+    courier_registry.release(order_id)
+    query.answer('Заказ отмечен как доставленный')
+    context.bot_data['send_scheduler'].submit('edit_message_reply_markup', priority=COSMETIC,
+                                              chat_id=query.message.chat_id,
+                                              message_id=query.message.message_id,
+                                              reply_markup=None)
+    raise DispatcherHandlerStop
+
+
+def serve_send_queue_stats(send_scheduler, headers, body):
+    payload = json.dumps(send_scheduler.stats()).encode()
+    return 200, {'Content-Type': 'application/json'}, payload
 
-    dispatcher = updater.dispatcher
-    job_queue = updater.job_queue
-    dispatcher.bot_data['redis_base'] = redis_base
-    dispatcher.bot_data['client_id'] = client_id
-    dispatcher.bot_data['client_secret'] = client_secret
-    dispatcher.bot_data['yandex_geo_api'] = yandex_geo_api
-    dispatcher.bot_data['flow_slug'] = 'pizzeria'
-    dispatcher.bot_data['payment_token'] = payment_token
 
-    fish_shop = ConversationHandler(
+def build_conversation_handler():
+    return ConversationHandler(
         entry_points=[
             CommandHandler('start', handle_menu),
             CommandHandler('cancel', cancel)
@@ -483,6 +577,8 @@ def main():
             ],
         },
 
+        name='pizzeria_conversation',
+        persistent=True,
         per_user=True,
         per_chat=False,
         allow_reentry=True,
@@ -490,10 +586,149 @@ def main():
             CommandHandler('cancel', cancel)],
     )
 
-    dispatcher.add_handler(fish_shop)
-    job_queue.run_once(renew_token, when=0.0)
-    updater.start_polling()
+
+def build_dispatcher(bot, redis_base, moltin, yandex_geo_api, payment_token, workers=32, update_queue_size=1000,
+                     catalog_ttl=600, cart_mirror_ttl=300, cart_merge_window=0.7, send_rate=30, chat_send_rate=1,
+                     geocoder_url=YANDEX_GEOCODER_URL, order_signing_key=None, courier_max_load=3):
+    """Creates the dispatcher with the conversation and the services the handlers find in bot_data"""
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(bot,
+                            Queue(maxsize=update_queue_size),
+                            workers=workers,
+                            job_queue=job_queue,
+                            persistence=RedisPersistence(redis_base, BotStates))
+    job_queue.set_dispatcher(dispatcher)
+
+    send_scheduler = SendScheduler(bot, global_rate=send_rate, chat_rate=chat_send_rate).start()
+    dispatcher.bot_data['send_scheduler'] = send_scheduler
+    dispatcher.bot_data['redis_base'] = redis_base
+    dispatcher.bot_data['moltin'] = moltin
+    catalog = CatalogCache(moltin, redis_base, ttl=catalog_ttl)
+    dispatcher.bot_data['catalog'] = catalog
+    dispatcher.bot_data['product_cards'] = ProductCardStore(catalog, redis_base)
+    dispatcher.bot_data['menu_pages'] = MenuPages(catalog)
+    cart_mirror = CartMirror(redis_base, moltin, catalog, max_age=cart_mirror_ttl)
+    cart_queue = CartWriteQueue(cart_mirror,
+                                window=cart_merge_window,
+                                on_dropped=partial(report_dropped_addition, send_scheduler, catalog)).start()
+    dispatcher.bot_data['cart_mirror'] = cart_mirror
+    dispatcher.bot_data['cart_queue'] = cart_queue
+    dispatcher.bot_data['yandex_geo_api'] = yandex_geo_api
+    geocoder = GeocodingCache(redis_base, yandex_geo_api, geocoder_url=geocoder_url)
+    dispatcher.bot_data['geocoder'] = geocoder
+    dispatcher.bot_data['flow_slug'] = 'pizzeria'
+    dispatcher.bot_data['delivery_zones_lock'] = threading.Lock()
+    courier_dispatch = CourierDispatch(redis_base)
+    courier_dispatch.create_group()
+    dispatcher.bot_data['courier_dispatch'] = courier_dispatch
+    dispatcher.bot_data['delayed_jobs'] = DelayedJobs(redis_base)
+    dispatcher.bot_data['courier_registry'] = CourierRegistry(redis_base, max_load=courier_max_load)
+    dispatcher.bot_data['payment_token'] = payment_token
+    dispatcher.bot_data['order_signer'] = OrderSigner(order_signing_key or bot.token)
+
+    metrics = BotMetrics(dispatcher)
+    dispatcher.bot_data['metrics'] = metrics
+    # courier updates are handled before the conversation and don't reach it, so they must not run async
+    dispatcher.add_handler(MessageHandler(Filters.location, handle_courier_location, run_async=False), group=-1)
+    dispatcher.add_handler(CallbackQueryHandler(handle_delivered, pattern='^delivered:', run_async=False), group=-1)
+    dispatcher.add_handler(CommandHandler('end_shift', handle_end_shift, run_async=False), group=-1)
+    dispatcher.add_handler(metrics.instrument_conversation(build_conversation_handler()))
+    return dispatcher
+
+
+def close_bot_data(bot_data):
+    bot_data['cart_queue'].close()
+    bot_data['send_scheduler'].stop()
+
+
+def main():
+    env = Env()
+    env.read_env()
+    telegram_token = env.str('TG_TOKEN')
+    redis_host = env.str('REDIS_HOST')
+    redis_port = env.str('REDIS_PORT')
+    redis_password = env.str('REDIS_PASSWORD')
+    client_id = env.str('ELASTIC_CLIENT_ID')
+    client_secret = env.str('ELASTIC_CLIENT_SECRET')
+    pizzerias_ttl = env.int('PIZZERIAS_TTL', 3600)
+    bot_workers = env.int('BOT_WORKERS', 32)
+    bot_mode = env.str('BOT_MODE', 'polling')
+    http_port = env.int('HTTP_PORT', 8000)
+    courier_workers = env.int('COURIER_WORKERS', 2)
+    delayed_job_workers = env.int('DELAYED_JOB_WORKERS', 1)
+
+    redis_base = redis.Redis(host=redis_host,
+                             port=redis_port,
+                             password=redis_password,
+                             decode_responses=True)
+
+    bot = ExtBot(telegram_token,
+                 defaults=Defaults(run_async=True),
+                 request=Request(con_pool_size=bot_workers + 4))
+    moltin = MoltinClient()
+    moltin.token_manager = TokenManager(redis_base, partial(moltin.get_client_auth, client_secret, client_id))
+    dispatcher = build_dispatcher(bot,
+                                  redis_base,
+                                  moltin,
+                                  yandex_geo_api=env.str('YANDEX_GEO_API'),
+                                  payment_token=env.str('PAYMENT_TOKEN'),
+                                  workers=bot_workers,
+                                  update_queue_size=env.int('UPDATE_QUEUE_SIZE', 1000),
+                                  catalog_ttl=env.int('CATALOG_TTL', 600),
+                                  cart_mirror_ttl=env.int('CART_MIRROR_TTL', 300),
+                                  cart_merge_window=env.float('CART_MERGE_WINDOW', 0.7),
+                                  send_rate=env.float('TG_SEND_RATE', 30),
+                                  chat_send_rate=env.float('TG_CHAT_SEND_RATE', 1),
+                                  order_signing_key=env.str('ORDER_SIGNING_KEY', None),
+                                  courier_max_load=env.int('COURIER_MAX_LOAD', 3))
+    updater = Updater(dispatcher=dispatcher, workers=None)
+    send_scheduler = dispatcher.bot_data['send_scheduler']
+
+    dispatcher.bot_data['courier_registry'].register(env.list('COURIER_IDS', [], subcast=int))
+    delayed_jobs = dispatcher.bot_data['delayed_jobs']
+    delayed_jobs.schedule('renew_token', 0, job_id='renew_token')
+    _, jobs_threads, jobs_stop_event = start_job_workers(delayed_jobs,
+                                                         get_job_handlers(send_scheduler, moltin.token_manager),
+                                                         workers=delayed_job_workers)
+
+    job_queue = dispatcher.job_queue
+    job_queue.run_repeating(refresh_catalog, interval=30, first=30)
+    try:
+        get_delivery_zones(dispatcher.bot_data)
+    except UPSTREAM_ERRORS as error:
+        logger.warning('Delivery zones will be built on the first address: %s', error)
+    job_queue.run_repeating(refresh_delivery_zones, interval=pizzerias_ttl, first=pizzerias_ttl)
+
+    courier_threads, courier_stop_event = [], None
+    if courier_workers:
+        cms_buffer = CmsWriteBuffer(moltin,
+                                    env.str('CMS_SPILL_PATH', None) or get_spill_path('cms_buffer'),
+                                    concurrency=env.int('CMS_WRITE_CONCURRENCY', 4)).start()
+        dispatcher.bot_data['cms_buffer'] = cms_buffer
+        _, courier_threads, courier_stop_event = start_workers(dispatcher.bot_data['courier_dispatch'],
+                                                               partial(send_scheduler.send, priority=URGENT),
+                                                               cms_buffer,
+                                                               courier_registry=dispatcher.bot_data['courier_registry'],
+                                                               workers=courier_workers)
+
+    http_server = BotHTTPServer(('0.0.0.0', http_port)).start()
+    http_server.route('GET', '/metrics', dispatcher.bot_data['metrics'].serve)
+    http_server.route('GET', '/send-queue', partial(serve_send_queue_stats, send_scheduler))
+    if bot_mode == 'webhook':
+        start_webhook(updater,
+                      http_server,
+                      url_path=env.str('WEBHOOK_PATH', telegram_token),
+                      webhook_url=env.str('WEBHOOK_URL'),
+                      secret_token=env.str('WEBHOOK_SECRET', get_webhook_secret(telegram_token)))
+    else:
+        updater.start_polling()
     updater.idle()
+    http_server.shutdown()
+    stop_job_workers(jobs_threads, jobs_stop_event)
+    if courier_stop_event:
+        stop_workers(courier_threads, courier_stop_event)
+        dispatcher.bot_data['cms_buffer'].close()
+    close_bot_data(dispatcher.bot_data)
 
 
 if __name__ == '__main__':
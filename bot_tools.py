@@ -16,12 +16,11 @@ def format_product_description(product_description):
 
 
 def format_cart(cart_items, total_price):
-    cart = cart_items['data']
     formatted_cart = 'В корзине:'
-    for item in cart:
+    for item in cart_items:
         product = item['name']
         quantity = item['quantity']
-        price = item['meta']['display_price']['without_tax']['value']['formatted']
+        price = item['formatted']
         formatted_cart += dedent(
             f'''
         Пицца {product}
@@ -36,31 +35,6 @@ def format_cart(cart_items, total_price):
     ''')
 
 
-class BidirectionalIterator(object):
-    def __init__(self, collection):
-        self.collection = collection
-        self.index = 0
-
-    def next(self):
-        try:
-            self.index += 1
-            result = self.collection[self.index]
-        except IndexError:
-            self.index -= 1
-            raise StopIteration
-        return result
-
-    def prev(self):
-        self.index -= 1
-        if self.index < 0:
-            self.index = 0
-            raise StopIteration
-        return self.collection[self.index]
-
-    def __iter__(self):
-        return self
-
-
 def build_menu(buttons, n_cols,
                header_buttons=None,
                footer_buttons=None):
@@ -0,0 +1,134 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ImportResult = namedtuple('ImportResult', ['key', 'status', 'attempts', 'error'])
+
+
+class RateLimiter:
+    """Token bucket: lets through `rate` calls per second with bursts up to `burst` calls."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def wait_time(self):
+        """Seconds until a call can be let through, 0 if it can be done right now"""
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self._tokens) / self.rate)
+
+    def try_acquire(self):
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class Checkpoint:
+    """
+    Append-only file with the progress of every imported item, the last line of an item wins.
+    A finished item is skipped on rerun, an unfinished one is resumed from its saved progress.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.items = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.items[record['key']] = record
+
+    def is_done(self, key):
+        return self.items.get(key, {}).get('done', False)
+
+    def get_progress(self, key):
+        return dict(self.items.get(key, {}).get('progress', {}))
+
+    def save(self, key, progress, done):
+        record = {'key': key, 'done': done, 'progress': progress}
+        with self._lock:
+            self.items[key] = record
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+class BulkImporter:
+    """
+    Runs `task(item, progress)` for every (key, item) pair in a bounded thread pool.
+    A task stores ids of what it has already created in `progress`, so a retry or a rerun
+    continues from the failed step. Failed attempts are retried with exponential backoff.
+    """
+
+    def __init__(self, checkpoint_path, workers=8, attempts=4, backoff=0.5, max_backoff=10):
+        self.checkpoint = Checkpoint(checkpoint_path)
+        self.workers = workers
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def _import_item(self, key, item, task):
+        if self.checkpoint.is_done(key):
+            return ImportResult(key, 'skipped', 0, None)
+
+        progress = self.checkpoint.get_progress(key)
+        for attempt in range(1, self.attempts + 1):
+            try:
+                task(item, progress)
+            except Exception as e:
+                self.checkpoint.save(key, progress, done=False)
+                if attempt == self.attempts:
+                    return ImportResult(key, 'failed', attempt, repr(e))
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.5, 1.5))
+            else:
+                self.checkpoint.save(key, progress, done=True)
+                return ImportResult(key, 'done', attempt, None)
+
+    def run(self, items, task):
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._import_item, key, item, task) for key, item in items]
+            results = [future.result() for future in futures]
+        elapsed = time.monotonic() - started_at
+
+        print_report(results, elapsed)
+        return results
+
+
+def print_report(results, elapsed):
+    statuses = Counter(result.status for result in results)
+    for result in results:
+        if result.status == 'failed':
+            print(f'{result.key}: failed after {result.attempts} attempts, {result.error}')
+    throughput = statuses['done'] / elapsed if elapsed else 0.0
+    print(
+        f'Done: {statuses["done"]}, skipped: {statuses["skipped"]}, failed: {statuses["failed"]}. '
+        f'{elapsed:.1f} s, {throughput:.1f} items/s'
+    )
@@ -0,0 +1,144 @@
+import json
+import logging
+import time
+from collections import Counter
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+def format_amount(amount):
+    return f'{amount / 100:.2f}'
+
+
+class MirrorNotUpdated(Exception):
+    """The cart is changed in Moltin, but its mirror couldn't be updated"""
+
+
+class CartMirror:
+    """
+    Write-through copy of Moltin carts in redis. Cart screens are rendered from the mirror,
+    mutations go to Moltin and the mirror is updated from their responses. The cart is re-read
+    from Moltin only when the mirror is older than `max_age` seconds or when a mutation response
+    doesn't match what the mirror and the catalog prices expect.
+    """
+
+    key_prefix = 'cart_mirror:'
+
+    def __init__(self, redis_base, moltin, catalog, max_age=300, expire=24 * 3600):
+        self.redis_base = redis_base
+        self.moltin = moltin
+        self.catalog = catalog
+        self.max_age = max_age
+        self.expire = expire
+        self.reloads = 0
+
+    def _key(self, cart_id):
+        return f'{self.key_prefix}{cart_id}'
+
+    def _unit_price(self, product_id):
+        product = self.catalog.get_product_info(product_id)['data']
+        return int(next(iter(product['price']))['amount'])
+
+    def _build_mirror(self, items_response):
+        items = []
+        for item in items_response['data']:
+            line_price = item['meta']['display_price']['without_tax']['value']
+            items.append({
+                'id': item['id'],
+                'product_id': item['product_id'],
+                'name': item['name'],
+                'quantity': item['quantity'],
+                'amount': line_price['amount'],
+                'formatted': line_price['formatted'],
+            })
+
+        total = sum(self._unit_price(item['product_id']) * item['quantity'] for item in items)
+        return {
+            'items': items,
+            'total': total,
+            'total_formatted': format_amount(total),
+            'synced_at': time.time(),
+        }
+
+    def _store(self, cart_id, mirror):
+        self.redis_base.set(self._key(cart_id), json.dumps(mirror, ensure_ascii=False), ex=self.expire)
+        return mirror
+
+    def _load(self, cart_id):
+        mirror = self.redis_base.get(self._key(cart_id))
+        return json.loads(mirror) if mirror else None
+
+    def reload(self, cart_id):
+        self.reloads += 1
+        items_response = self.moltin.get_cart(cart_id)
+        mirror = self._build_mirror(items_response)
+        remote_total = get_response_total(items_response)
+        if remote_total is not None and remote_total['amount'] != mirror['total']:
+            # catalog prices are outdated, Moltin knows better
+            mirror['total'] = remote_total['amount']
+            mirror['total_formatted'] = remote_total['formatted']
+        return self._store(cart_id, mirror)
+
+    def peek(self, cart_id):
+        """Returns the mirror as it is, without going to Moltin"""
+        return self._load(cart_id)
+
+    def get(self, cart_id):
+        """Returns the mirror, an outdated one is reloaded unless Moltin is unavailable"""
+        mirror = self._load(cart_id)
+        if not mirror or time.time() - mirror['synced_at'] > self.max_age:
+            try:
+                return self.reload(cart_id)
+            except requests.RequestException as error:
+                if not mirror:
+                    raise
+                logger.warning('Cart %s is shown from an outdated mirror: %s', cart_id, error)
+        return mirror
+
+    def _apply(self, cart_id, expected_quantities, items_response):
+        mirror = self._build_mirror(items_response)
+        remote_total = get_response_total(items_response)
+        if count_quantities(mirror['items']) != +expected_quantities:
+            return self.reload(cart_id)
+        if remote_total is not None and remote_total['amount'] != mirror['total']:
+            return self.reload(cart_id)
+        return self._store(cart_id, mirror)
+
+    def add(self, cart_id, product_id, quantity=1):
+        """Adds the product to the cart in Moltin, raises MirrorNotUpdated if only the mirror update failed"""
+        mirror = self._load(cart_id)
+        items_response = self.moltin.add_product_to_cart(cart_id, product_id, quantity)
+        try:
+            if not mirror:
+                return self.reload(cart_id)
+            expected_quantities = count_quantities(mirror['items'])
+            expected_quantities[product_id] += quantity
+            return self._apply(cart_id, expected_quantities, items_response)
+        except Exception as error:
+            raise MirrorNotUpdated(cart_id) from error
+
+    def invalidate(self, cart_id):
+        """Drops the mirror, the next `get` reads the cart from Moltin"""
+        self.redis_base.delete(self._key(cart_id))
+
+    def remove(self, cart_id, item_id):
+        mirror = self._load(cart_id)
+        items_response = self.moltin.remove_product_from_cart(cart_id, item_id)
+        if not mirror:
+            return self.reload(cart_id)
+        remaining_items = [item for item in mirror['items'] if item['id'] != item_id]
+        return self._apply(cart_id, count_quantities(remaining_items), items_response)
+
+
+def count_quantities(items):
+    quantities = Counter()
+    for item in items:
+        quantities[item['product_id']] += item['quantity']
+    return quantities
+
+
+def get_response_total(items_response):
+    display_price = items_response.get('meta', {}).get('display_price', {})
+    return display_price.get('with_tax')
@@ -0,0 +1,188 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from cart_mirror import MirrorNotUpdated
+from resilience import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# answers given before Moltin handles a request
+NOT_APPLIED_STATUSES = {429, 503}
+
+
+def is_not_applied(error):
+    """Tells whether a failed addition certainly didn't reach the cart, so it's safe to send it again"""
+    if isinstance(error, (CircuitOpenError, requests.ConnectTimeout, redis.RedisError)):
+        return True
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in NOT_APPLIED_STATUSES
+    if isinstance(error, requests.ConnectionError) and error.args:
+        # the connection wasn't established, so the request wasn't sent
+        return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+    return False
+
+
+def get_quantity(mirror, product_id):
+    return sum(item['quantity'] for item in mirror['items'] if item['product_id'] == product_id)
+
+
+class CartWriteQueue:
+    """
+    Sends additions to carts in the background. Taps on one cart made within `window` seconds
+    are merged into one request per product with the summed quantity. Batches of one cart are
+    sent one after another in the order of the taps, `flush` waits until a cart is written.
+    A request is sent again only when it certainly didn't reach Moltin, otherwise the cart is
+    re-read to find out whether the addition is there. A dropped addition is passed to
+    `on_dropped(chat_id, product_id, quantity)`.
+    """
+
+    def __init__(self, cart_mirror, window=0.7, workers=4, attempts=3, backoff=0.5, on_dropped=None):
+        self.cart_mirror = cart_mirror
+        self.window = window
+        self.attempts = attempts
+        self.backoff = backoff
+        self.on_dropped = on_dropped
+        self.taps = 0
+        self.requests = 0
+        self.failed = 0
+        self._pending = {}
+        self._chats = {}
+        self._sending = set()
+        self._deadlines = []
+        self._running = True
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cart-queue')
+        self._thread = threading.Thread(target=self._run, name='cart-queue', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def add(self, cart_id, product_id, quantity=1, chat_id=None):
+        with self._condition:
+            self.taps += 1
+            if chat_id is not None:
+                self._chats[cart_id] = chat_id
+            batch = self._pending.get(cart_id)
+            if batch is None:
+                batch = self._pending[cart_id] = {}
+                heapq.heappush(self._deadlines, (time.monotonic() + self.window, cart_id))
+                self._condition.notify_all()
+            batch[product_id] = batch.get(product_id, 0) + quantity
+
+    def is_pending(self, cart_id):
+        """Tells whether there are additions to the cart that haven't been written yet"""
+        with self._condition:
+            return cart_id in self._pending or cart_id in self._sending
+
+    def flush(self, cart_id, timeout=None):
+        self._drain(cart_id)
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: cart_id not in self._sending and cart_id not in self._pending,
+                timeout,
+            )
+
+    def close(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+            cart_ids = list(self._pending)
+        if self._thread.is_alive():
+            self._thread.join()
+        for cart_id in cart_ids:
+            self.flush(cart_id)
+        self._executor.shutdown()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and (not self._deadlines or self._deadlines[0][0] > time.monotonic()):
+                    timeout = self._deadlines[0][0] - time.monotonic() if self._deadlines else None
+                    self._condition.wait(timeout)
+                if not self._running:
+                    return
+                _, cart_id = heapq.heappop(self._deadlines)
+            self._executor.submit(self._drain, cart_id)
+
+    def _drain(self, cart_id):
+        with self._condition:
+            if cart_id in self._sending:
+                # the thread sending this cart picks up the new batch when it's done
+                return
+            self._sending.add(cart_id)
+
+        try:
+            while True:
+                with self._condition:
+                    batch = self._pending.pop(cart_id, None)
+                    if not batch:
+                        self._chats.pop(cart_id, None)
+                        return
+                    chat_id = self._chats.get(cart_id)
+                for product_id, quantity in batch.items():
+                    if not self._send(cart_id, product_id, quantity):
+                        self._drop(chat_id, cart_id, product_id, quantity)
+        finally:
+            with self._condition:
+                self._sending.discard(cart_id)
+                self._condition.notify_all()
+
+    def _send(self, cart_id, product_id, quantity):
+        """Returns False when the addition isn't in the cart"""
+        try:
+            mirror = self.cart_mirror.peek(cart_id)
+        except redis.RedisError:
+            mirror = None
+        quantity_before = get_quantity(mirror, product_id) if mirror else 0
+
+        for attempt in range(1, self.attempts + 1):
+            self.requests += 1
+            try:
+                self.cart_mirror.add(cart_id, product_id, quantity)
+                return True
+            except MirrorNotUpdated:
+                logger.warning('Mirror of cart %s is not updated after an addition', cart_id, exc_info=True)
+                self._invalidate(cart_id)
+                return True
+            except Exception as error:
+                if not is_not_applied(error):
+                    logger.warning('Addition of %s x%s to cart %s may have failed: %s', product_id, quantity,
+                                   cart_id, error)
+                    return self._is_applied(cart_id, product_id, quantity_before + quantity)
+                if attempt == self.attempts:
+                    logger.exception('Failed to add %s x%s to cart %s', product_id, quantity, cart_id)
+                    return False
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+    def _is_applied(self, cart_id, product_id, expected_quantity):
+        """Re-reads the cart from Moltin after a request that may have been applied"""
+        try:
+            mirror = self.cart_mirror.reload(cart_id)
+        except Exception:
+            logger.exception('Failed to re-read cart %s, the addition of %s is unknown', cart_id, product_id)
+            self._invalidate(cart_id)
+            return True
+        return get_quantity(mirror, product_id) >= expected_quantity
+
+    def _invalidate(self, cart_id):
+        try:
+            self.cart_mirror.invalidate(cart_id)
+        except redis.RedisError:
+            logger.exception('Failed to drop the mirror of cart %s', cart_id)
+
+    def _drop(self, chat_id, cart_id, product_id, quantity):
+        self.failed += 1
+        if not self.on_dropped or chat_id is None:
+            return
+        try:
+            self.on_dropped(chat_id, product_id, quantity)
+        except Exception:
+            logger.exception('Failed to report the dropped addition of %s to cart %s', product_id, cart_id)
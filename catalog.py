@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogCache:
+    """
+    Keeps products and their image links in memory. The cache is refreshed by `refresh_catalog`
+    job every `ttl` seconds or when the catalog version stored in redis is bumped by `invalidate`.
+    """
+
+    version_key = 'catalog_version'
+
+    def __init__(self, moltin, redis_base=None, ttl=600):
+        self.moltin = moltin
+        self.redis_base = redis_base
+        self.ttl = ttl
+        self.version = 0
+        self.refreshed_at = None
+        self.hits = 0
+        self.misses = 0
+        self._products = []
+        self._products_by_id = {}
+        self._image_links = {}
+        self._remote_version = None
+        self._lock = threading.Lock()
+
+    def _fetch_remote_version(self):
+        if not self.redis_base:
+            return None
+        return self.redis_base.get(self.version_key)
+
+    def refresh(self):
+        remote_version = self._fetch_remote_version()
+        products = self.moltin.get_all_products()['data']
+        images = {image['id']: image['link']['href'] for image in self.moltin.iter_images()}
+
+        image_links = {}
+        for product in products:
+            image_id = get_main_image_id(product)
+            if image_id in images:
+                image_links[product['id']] = images[image_id]
+
+        with self._lock:
+            if products != self._products or image_links != self._image_links:
+                self.version += 1
+            self._products = products
+            self._products_by_id = {product['id']: product for product in products}
+            self._image_links = image_links
+            self._remote_version = remote_version
+            self.refreshed_at = time.monotonic()
+
+    def is_stale(self):
+        if self.refreshed_at is None or time.monotonic() - self.refreshed_at >= self.ttl:
+            return True
+        return self._fetch_remote_version() != self._remote_version
+
+    def refresh_if_stale(self):
+        if self.is_stale():
+            self.refresh()
+
+    def invalidate(self):
+        if self.redis_base:
+            self.redis_base.incr(self.version_key)
+        self.refresh()
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get_all_products(self):
+        loaded = self.refreshed_at is not None
+        self._count(loaded)
+        if not loaded:
+            self.refresh()
+        return self._products
+
+    def get_product_info(self, product_id):
+        product = self._products_by_id.get(product_id)
+        self._count(product is not None)
+        if product is None:
+            product = self.moltin.get_product_info(product_id)['data']
+            with self._lock:
+                self._products_by_id[product_id] = product
+        return {'data': product}
+
+    def get_image_link(self, product_id):
+        image_link = self._image_links.get(product_id)
+        self._count(image_link is not None)
+        if image_link is None:
+            product = self.get_product_info(product_id)['data']
+            image_link = self.moltin.get_image_link(get_main_image_id(product))
+            with self._lock:
+                self._image_links[product_id] = image_link
+        return image_link
+
+    def stats(self):
+        requests_qty = self.hits + self.misses
+        return {
+            'version': self.version,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests_qty if requests_qty else 0.0,
+        }
+
+
+def get_main_image_id(product):
+    main_image = product.get('relationships', {}).get('main_image')
+    if not main_image:
+        return None
+    return main_image['data']['id']
+
+
+def refresh_catalog(bot_context):
+    """
+    :param bot_context: this is a context object passed to the callback called by :class:`telegram.ext.JobQueue`
+    :return: None
+    """
+    try:
+        bot_context.bot_data['catalog'].refresh_if_stale()
+    except requests.RequestException as error:
+        logger.warning('Catalog is not refreshed, the cached one is used: %s', error)
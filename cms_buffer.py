@@ -0,0 +1,240 @@
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from metrics import CMS_FLUSH_LAG_SECONDS
+from resilience import RETRIABLE_STATUSES
+
+logger = logging.getLogger(__name__)
+
+SPILL_DIR = '/var/tmp/pizzeria-bot'
+
+
+def get_spill_path(name, directory=SPILL_DIR):
+    """
+    Spill file of this instance outside the source tree. Replicas may share the directory,
+    so the file is named after the host, it is the same after a restart of the container.
+    """
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'{name}-{socket.gethostname()}.jsonl')
+
+
+class CmsWriteBuffer:
+    """
+    Write-behind buffer of Moltin flow entries. `add` appends an entry to a local spill file and
+    returns at once, a background thread creates buffered entries in Moltin in batches of up to
+    `batch_size` requests sent in parallel by `concurrency` threads. Entries left in the spill file
+    by a stopped or crashed process are sent after restart, so an entry created right before
+    a crash may be created twice. Failed entries are retried with backoff while Moltin is
+    unavailable, entries rejected by Moltin itself go to `<spill_path>.dead`. The spill file has its
+    own lock, so disk writes don't hold up the buffer state.
+    """
+
+    def __init__(self, moltin, spill_path, batch_size=20, concurrency=4, backoff=0.5, max_backoff=30,
+                 compact_every=1000):
+        self.moltin = moltin
+        self.spill_path = spill_path
+        self.dead_path = f'{spill_path}.dead'
+        self.batch_size = batch_size
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.compact_every = compact_every
+        self.written = 0
+        self.failures = 0
+        self.dead = 0
+        self.lags = deque(maxlen=10000)
+        self._entries = {}
+        self._in_flight = set()
+        self._finished_lines = 0
+        self._running = True
+        self._condition = threading.Condition()
+        # taken before `_condition` when both are needed
+        self._spill_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='cms-buffer')
+        self._thread = threading.Thread(target=self._run, name='cms-buffer', daemon=True)
+        self._load_spill()
+        self._spill = open(self.spill_path, 'a', encoding='utf-8')
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _load_spill(self):
+        if os.path.exists(self.spill_path):
+            with open(self.spill_path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line of a crashed process may be cut off
+                        continue
+                    if record['op'] == 'add':
+                        self._entries[record['entry']['id']] = dict(record['entry'], attempts=0, retry_at=0)
+                    else:
+                        self._entries.pop(record['id'], None)
+            if self._entries:
+                logger.info('%s CMS entries are restored from %s', len(self._entries), self.spill_path)
+        self._rewrite_spill(list(self._entries.values()))
+
+    def _rewrite_spill(self, entries):
+        """Leaves only unwritten `entries` in the spill file"""
+        temporary_path = f'{self.spill_path}.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            for entry in entries:
+                file.write(self._encode_line('add', entry))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.spill_path)
+        self._finished_lines = 0
+
+    def _encode_line(self, op, entry):
+        if op == 'add':
+            record = {'op': op, 'entry': {key: entry[key] for key in ('id', 'flow', 'fields', 'values', 'added_at')}}
+        else:
+            record = {'op': op, 'id': entry['id']}
+        return json.dumps(record, ensure_ascii=False) + '\n'
+
+    def _write_lines(self, lines):
+        # an entry counts as buffered only once it is on disk, not in the page cache
+        self._spill.write(''.join(lines))
+        self._spill.flush()
+        os.fsync(self._spill.fileno())
+
+    def add(self, fields_slugs, values, flow_slug):
+        """Buffers an entry with the arguments of MoltinClient.create_entry"""
+        entry = {
+            'id': uuid.uuid4().hex,
+            'flow': flow_slug,
+            'fields': list(fields_slugs),
+            'values': list(values),
+            'added_at': time.time(),
+            'attempts': 0,
+            'retry_at': 0,
+        }
+        with self._spill_lock:
+            self._write_lines([self._encode_line('add', entry)])
+            # still under the spill lock, so a compaction can't miss an entry already in the old file
+            with self._condition:
+                self._entries[entry['id']] = entry
+                self._condition.notify_all()
+        return entry['id']
+
+    def _get_ready(self):
+        now = time.time()
+        return [
+            entry for entry_id, entry in self._entries.items()
+            if entry_id not in self._in_flight and entry['retry_at'] <= now
+        ][:self.batch_size]
+
+    def _get_wait_time(self):
+        retry_times = [entry['retry_at'] for entry in self._entries.values()]
+        return max(0.0, min(retry_times) - time.time()) if retry_times else None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                batch = self._get_ready()
+                while self._running and not batch:
+                    self._condition.wait(self._get_wait_time())
+                    batch = self._get_ready()
+                if not self._running:
+                    return
+                self._in_flight.update(entry['id'] for entry in batch)
+
+            errors = list(self._executor.map(self._create, batch))
+            self._finish(batch, errors)
+
+    def _create(self, entry):
+        try:
+            self.moltin.create_entry(entry['fields'], entry['values'], entry['flow'])
+        except Exception as error:
+            return error
+        return None
+
+    def _is_rejected(self, error):
+        response = getattr(error, 'response', None)
+        return (isinstance(error, requests.HTTPError) and response is not None
+                and response.status_code not in RETRIABLE_STATUSES)
+
+    def _finish(self, batch, errors):
+        lines = []
+        dead_entries = []
+        now = time.time()
+        with self._condition:
+            for entry, error in zip(batch, errors):
+                self._in_flight.discard(entry['id'])
+                if error is None:
+                    self.written += 1
+                    self.lags.append(now - entry['added_at'])
+                    CMS_FLUSH_LAG_SECONDS.observe(now - entry['added_at'])
+                    lines.append(self._encode_line('done', entry))
+                    del self._entries[entry['id']]
+                    continue
+
+                self.failures += 1
+                entry['attempts'] += 1
+                if self._is_rejected(error):
+                    logger.error('Moltin rejected %s entry %s: %s', entry['flow'], entry['values'], error)
+                    self.dead += 1
+                    dead_entries.append(entry)
+                    lines.append(self._encode_line('dead', entry))
+                    del self._entries[entry['id']]
+                    continue
+                logger.warning('Failed to create %s entry, attempt %s: %s', entry['flow'], entry['attempts'], error)
+                delay = min(self.max_backoff, self.backoff * 2 ** (entry['attempts'] - 1))
+                entry['retry_at'] = now + delay * random.uniform(0.5, 1.5)
+
+            self._condition.notify_all()
+
+        # a crash before the lines are written only makes the entries be created again
+        with self._spill_lock:
+            if dead_entries:
+                with open(self.dead_path, 'a', encoding='utf-8') as file:
+                    file.writelines(self._encode_line('add', entry) for entry in dead_entries)
+            self._write_lines(lines)
+            self._finished_lines += len(lines)
+            if self._finished_lines >= self.compact_every:
+                with self._condition:
+                    entries = list(self._entries.values())
+                self._spill.close()
+                self._rewrite_spill(entries)
+                self._spill = open(self.spill_path, 'a', encoding='utf-8')
+
+    def flush(self, timeout=None):
+        """Waits until every buffered entry is written, returns False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._entries, timeout)
+
+    def close(self, timeout=10):
+        """Gives buffered entries `timeout` seconds to be written, the rest stay in the spill file"""
+        if self._thread.is_alive():
+            self.flush(timeout)
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._executor.shutdown()
+        with self._spill_lock:
+            self._spill.close()
+
+    def stats(self):
+        with self._condition:
+            added_at = [entry['added_at'] for entry in self._entries.values()]
+            return {
+                'pending': len(added_at),
+                'in_flight': len(self._in_flight),
+                'written': self.written,
+                'failures': self.failures,
+                'dead': self.dead,
+                'oldest_age': time.time() - min(added_at) if added_at else 0.0,
+            }
@@ -0,0 +1,261 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from functools import partial
+
+import redis
+from environs import Env
+from redis.exceptions import ResponseError
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ExtBot
+
+from cms_buffer import CmsWriteBuffer, get_spill_path
+from courier_registry import CourierRegistry
+from elastic_api import MoltinClient
+from send_scheduler import SendScheduler, URGENT
+from token_manager import TokenManager
+
+logger = logging.getLogger(__name__)
+
+# KEYS: order steps, stream. ARGV: order ttl, stream max length, order.
+# The marker, its ttl and the stream entry are written together, so a crash can't leave one without another
+ENQUEUE_SCRIPT = '''
+if redis.call('HSETNX', KEYS[1], 'queued', 1) == 0 then
+    return false
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*', 'order', ARGV[3])
+'''
+
+
+class CourierDispatch:
+    """
+    Durable queue of paid orders for couriers on a redis stream read by a consumer group.
+    An order stays pending until a worker acknowledges it, orders of a dead or stuck worker
+    are claimed by others. Every order has a hash of the finished delivery steps, so
+    a redelivered order doesn't repeat what has already been done.
+    """
+
+    stream_key = 'courier_orders'
+    group = 'couriers'
+    dead_letters_key = 'courier_orders:dead'
+    attempts_key = 'courier_orders:attempts'
+    order_prefix = 'courier_order:'
+
+    def __init__(self, redis_base, maxlen=100000, order_ttl=7 * 24 * 3600):
+        self.redis_base = redis_base
+        self.maxlen = maxlen
+        self.order_ttl = order_ttl
+        self._enqueue = redis_base.register_script(ENQUEUE_SCRIPT)
+
+    def create_group(self):
+        try:
+            self.redis_base.xgroup_create(self.stream_key, self.group, id='0', mkstream=True)
+        except ResponseError as error:
+            if 'BUSYGROUP' not in str(error):
+                raise
+
+    def _order_key(self, order_id):
+        return f'{self.order_prefix}{order_id}'
+
+    def enqueue(self, order):
+        """Puts the order into the stream once, returns the entry id or None for a duplicate"""
+        order_key = self._order_key(order['order_id'])
+        order = dict(order, enqueued_at=time.time())
+        entry_id = self._enqueue(keys=[order_key, self.stream_key],
+                                 args=[self.order_ttl, self.maxlen, json.dumps(order, ensure_ascii=False)])
+        return entry_id or None
+
+    def _decode(self, entries):
+        return [(entry_id, json.loads(fields['order'])) for entry_id, fields in entries if fields]
+
+    def read(self, consumer, count=10, block_ms=1000):
+        response = self.redis_base.xreadgroup(self.group, consumer, {self.stream_key: '>'},
+                                              count=count, block=block_ms)
+        if not response:
+            return []
+        _, entries = response[0]
+        return self._decode(entries)
+
+    def claim_stale(self, consumer, min_idle_ms, count=10):
+        entries = self.redis_base.xautoclaim(self.stream_key, self.group, consumer, min_idle_ms,
+                                             start_id='0-0', count=count)
+        return self._decode(entries)
+
+    def is_step_done(self, order_id, step):
+        return bool(self.redis_base.hexists(self._order_key(order_id), step))
+
+    def mark_step_done(self, order_id, step):
+        self.redis_base.hset(self._order_key(order_id), step, 1)
+
+    def ack(self, entry_id):
+        pipeline = self.redis_base.pipeline()
+        pipeline.xack(self.stream_key, self.group, entry_id)
+        pipeline.hdel(self.attempts_key, entry_id)
+        pipeline.execute()
+
+    def fail(self, entry_id, order, max_attempts):
+        """Leaves the order pending to be retried, after `max_attempts` moves it to dead letters"""
+        attempts = self.redis_base.hincrby(self.attempts_key, entry_id)
+        if attempts < max_attempts:
+            return False
+        self.redis_base.xadd(self.dead_letters_key, {'order': json.dumps(order, ensure_ascii=False)})
+        self.ack(entry_id)
+        return True
+
+    def pending(self):
+        return self.redis_base.xpending(self.stream_key, self.group)['pending']
+
+
+class CourierWorker:
+    """
+    Delivers orders from CourierDispatch: sends the location and the order to the courier
+    and puts the customer address into the CMS write buffer. The courier is picked by
+    `courier_registry` near the pizzeria, the pizzeria's own deliveryman gets the order when
+    nobody is available. A failed order is retried when it has been idle for `claim_idle_ms`.
+    """
+
+    steps = ('location', 'message', 'cms')
+
+    def __init__(self, dispatch, send, cms_buffer, courier_registry=None, consumer=None, batch_size=10,
+                 block_ms=1000, claim_idle_ms=30000, max_attempts=5):
+        self.dispatch = dispatch
+        self.send = send
+        self.cms_buffer = cms_buffer
+        self.courier_registry = courier_registry
+        self.consumer = consumer or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_attempts = max_attempts
+        self.delivered = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=10000)
+
+    def _send_location(self, order):
+        latitude, longitude = order['coordinates']
+        self.send('send_location', chat_id=order['deliveryman_id'], latitude=latitude, longitude=longitude)
+
+    def _send_message(self, order):
+        reply_markup = None
+        if order.get('assigned'):
+            reply_markup = InlineKeyboardMarkup([[
+                InlineKeyboardButton('Доставлен', callback_data=f'delivered:{order["order_id"]}')
+            ]])
+        self.send('send_message', chat_id=order['deliveryman_id'], text=order['text'], reply_markup=reply_markup)
+
+    def _save_to_cms(self, order):
+        fields_slugs = ['longitude', 'latitude', 'email']
+        values = *order['coordinates'], order['email']
+        self.cms_buffer.add(fields_slugs, values, 'customer-address')
+
+    def _assign_courier(self, order):
+        if not self.courier_registry or not order.get('pizzeria_coordinates'):
+            return order
+        # the assignment is kept in redis, so a retried order goes to the same courier
+        courier_id = self.courier_registry.assign(order['order_id'], order['pizzeria_coordinates'])
+        if courier_id is None:
+            logger.warning('No courier is available for order %s', order['order_id'])
+            return order
+        return dict(order, deliveryman_id=courier_id, assigned=True)
+
+    def handle(self, entry_id, order):
+        actions = {
+            'location': self._send_location,
+            'message': self._send_message,
+            'cms': self._save_to_cms,
+        }
+        try:
+            order = self._assign_courier(order)
+            for step in self.steps:
+                if self.dispatch.is_step_done(order['order_id'], step):
+                    continue
+                actions[step](order)
+                self.dispatch.mark_step_done(order['order_id'], step)
+        except Exception:
+            logger.exception('Failed to deliver order %s', order['order_id'])
+            self.failed += 1
+            self.dispatch.fail(entry_id, order, self.max_attempts)
+            return False
+
+        self.dispatch.ack(entry_id)
+        self.delivered += 1
+        self.latencies.append(time.time() - order['enqueued_at'])
+        return True
+
+    def run_once(self):
+        entries = self.dispatch.claim_stale(self.consumer, self.claim_idle_ms, self.batch_size)
+        entries += self.dispatch.read(self.consumer, self.batch_size, self.block_ms)
+        for entry_id, order in entries:
+            self.handle(entry_id, order)
+        return len(entries)
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('Courier worker %s failed', self.consumer)
+                stop_event.wait(1)
+
+
+def start_workers(dispatch, send, cms_buffer, workers=2, **worker_kwargs):
+    dispatch.create_group()
+    stop_event = threading.Event()
+    courier_workers = [CourierWorker(dispatch, send, cms_buffer, **worker_kwargs) for _ in range(workers)]
+    threads = [
+        threading.Thread(target=worker.run, args=(stop_event,), name=f'courier-worker-{number}', daemon=True)
+        for number, worker in enumerate(courier_workers)
+    ]
+    for thread in threads:
+        thread.start()
+    return courier_workers, threads, stop_event
+
+
+def stop_workers(threads, stop_event, timeout=10):
+    """Lets the workers finish their current orders, so nothing is added to the CMS buffer after it's closed"""
+    stop_event.set()
+    for thread in threads:
+        thread.join(timeout)
+
+
+def main():
+    env = Env()
+    env.read_env()
+    logging.basicConfig(level=logging.INFO)
+
+    redis_base = redis.Redis(host=env.str('REDIS_HOST'),
+                             port=env.str('REDIS_PORT'),
+                             password=env.str('REDIS_PASSWORD'),
+                             decode_responses=True)
+    moltin = MoltinClient()
+    moltin.token_manager = TokenManager(redis_base, partial(moltin.get_client_auth,
+                                                            env.str('ELASTIC_CLIENT_SECRET'),
+                                                            env.str('ELASTIC_CLIENT_ID')))
+    send_scheduler = SendScheduler(ExtBot(env.str('TG_TOKEN'))).start()
+    cms_buffer = CmsWriteBuffer(moltin,
+                                env.str('COURIER_CMS_SPILL_PATH', None) or get_spill_path('courier_cms_buffer'),
+                                concurrency=env.int('CMS_WRITE_CONCURRENCY', 4)).start()
+
+    _, threads, stop_event = start_workers(CourierDispatch(redis_base),
+                                           partial(send_scheduler.send, priority=URGENT),
+                                           cms_buffer,
+                                           courier_registry=CourierRegistry(redis_base,
+                                                                            max_load=env.int('COURIER_MAX_LOAD', 3)),
+                                           workers=env.int('COURIER_WORKERS', 4))
+    try:
+        stop_event.wait()
+    except KeyboardInterrupt:
+        pass
+    stop_workers(threads, stop_event)
+    send_scheduler.stop()
+    cms_buffer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import time
+
+# KEYS: positions, last seen times, active orders by courier, courier by order, assignment times.
+# ARGV: longitude, latitude, radius km, candidates, now, stale before, expired before, max load,
+# km per active order, order id
+ASSIGN_SCRIPT = '''
+-- orders not marked delivered in time stop counting
+local expired = redis.call('ZRANGEBYSCORE', KEYS[5], '-inf', '(' .. ARGV[7])
+for _, order_id in ipairs(expired) do
+    local courier_id = redis.call('HGET', KEYS[4], order_id)
+    if courier_id and redis.call('HINCRBY', KEYS[3], courier_id, -1) <= 0 then
+        redis.call('HDEL', KEYS[3], courier_id)
+    end
+    redis.call('HDEL', KEYS[4], order_id)
+    redis.call('ZREM', KEYS[5], order_id)
+end
+local assigned = redis.call('HGET', KEYS[4], ARGV[10])
+if assigned then
+    return assigned
+end
+-- couriers who stopped sharing their location leave the search set
+local stale = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[6])
+for _, courier_id in ipairs(stale) do
+    redis.call('ZREM', KEYS[1], courier_id)
+    redis.call('ZREM', KEYS[2], courier_id)
+end
+local count = tonumber(ARGV[4])
+local best, best_score
+while true do
+    local found = redis.call('GEOSEARCH', KEYS[1], 'FROMLONLAT', ARGV[1], ARGV[2], 'BYRADIUS', ARGV[3], 'km',
+                             'ASC', 'COUNT', count, 'WITHDIST')
+    for _, courier in ipairs(found) do
+        local courier_id, distance = courier[1], tonumber(courier[2])
+        local load = tonumber(redis.call('HGET', KEYS[3], courier_id) or 0)
+        if load < tonumber(ARGV[8]) then
+            local score = distance + load * tonumber(ARGV[9])
+            if not best_score or score < best_score then
+                best, best_score = courier_id, score
+            end
+        end
+    end
+    -- all the nearest couriers are busy, the search goes on with twice as many
+    if best or #found < count then
+        break
+    end
+    count = count * 2
+end
+if not best then
+    return false
+end
+redis.call('HINCRBY', KEYS[3], best, 1)
+redis.call('HSET', KEYS[4], ARGV[10], best)
+redis.call('ZADD', KEYS[5], ARGV[5], ARGV[10])
+return best
+'''
+
+# KEYS: active orders by courier, courier by order, assignment times. ARGV: order id
+RELEASE_SCRIPT = '''
+local courier_id = redis.call('HGET', KEYS[2], ARGV[1])
+if not courier_id then
+    return false
+end
+if redis.call('HINCRBY', KEYS[1], courier_id, -1) <= 0 then
+    redis.call('HDEL', KEYS[1], courier_id)
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return courier_id
+'''
+
+
+class CourierRegistry:
+    """
+    Couriers on shift: live positions in a redis GEO set and the number of active orders
+    of every courier. An order goes to the courier near the pizzeria with the lowest
+    `distance + active orders * load_penalty` among the `candidates` nearest ones, couriers
+    with `max_load` orders are skipped and the search is widened while it finds nobody else.
+    Couriers without a position update for `location_ttl` seconds are removed from the search.
+    The choice and the claim are one Lua script, so concurrent orders can't overload a courier,
+    and an order is assigned once. Orders not marked delivered stop counting after `order_ttl`.
+    All the keys of the scripts share the `{couriers}` hash tag, so they are in one slot of
+    a redis cluster.
+    """
+
+    couriers_key = 'couriers'
+    positions_key = '{couriers}:positions'
+    seen_key = '{couriers}:seen'
+    loads_key = '{couriers}:loads'
+    assignments_key = '{couriers}:assignments'
+    assigned_at_key = '{couriers}:assigned_at'
+
+    def __init__(self, redis_base, search_radius=10, candidates=20, max_load=3, load_penalty=2,
+                 location_ttl=900, order_ttl=3 * 3600):
+        self.redis_base = redis_base
+        self.search_radius = search_radius
+        self.candidates = candidates
+        self.max_load = max_load
+        self.load_penalty = load_penalty
+        self.location_ttl = location_ttl
+        self.order_ttl = order_ttl
+        self._assign = redis_base.register_script(ASSIGN_SCRIPT)
+        self._release = redis_base.register_script(RELEASE_SCRIPT)
+
+    def register(self, courier_ids):
+        courier_ids = [courier_id for courier_id in courier_ids if courier_id]
+        if courier_ids:
+            self.redis_base.sadd(self.couriers_key, *courier_ids)
+
+    def is_courier(self, courier_id):
+        return bool(self.redis_base.sismember(self.couriers_key, courier_id))
+
+    def update_location(self, courier_id, latitude, longitude):
+        pipeline = self.redis_base.pipeline()
+        pipeline.geoadd(self.positions_key, (longitude, latitude, courier_id))
+        pipeline.zadd(self.seen_key, {courier_id: time.time()})
+        pipeline.execute()
+
+    def leave(self, courier_id):
+        """Ends the shift of the courier: no new orders, the assigned ones stay with them"""
+        pipeline = self.redis_base.pipeline()
+        pipeline.zrem(self.positions_key, courier_id)
+        pipeline.zrem(self.seen_key, courier_id)
+        pipeline.execute()
+
+    def assign(self, order_id, coordinates):
+        """Returns the id of the courier the order is given to or None when nobody is available nearby"""
+        latitude, longitude = (float(coordinate) for coordinate in coordinates)
+        now = time.time()
+        keys = [self.positions_key, self.seen_key, self.loads_key, self.assignments_key, self.assigned_at_key]
+        args = [
+            longitude, latitude, self.search_radius, self.candidates, now, now - self.location_ttl,
+            now - self.order_ttl, self.max_load, self.load_penalty, order_id,
+        ]
+        courier_id = self._assign(keys=keys, args=args)
+        return int(courier_id) if courier_id else None
+
+    def get_courier(self, order_id):
+        """Returns the id of the courier the order is assigned to"""
+        courier_id = self.redis_base.hget(self.assignments_key, order_id)
+        return int(courier_id) if courier_id else None
+
+    def release(self, order_id):
+        """Marks the order delivered, returns the id of its courier"""
+        keys = [self.loads_key, self.assignments_key, self.assigned_at_key]
+        courier_id = self._release(keys=keys, args=[order_id])
+        return int(courier_id) if courier_id else None
+
+    def get_load(self, courier_id):
+        """Active orders of the courier, expired ones are counted until the next assignment"""
+        return int(self.redis_base.hget(self.loads_key, courier_id) or 0)
@@ -0,0 +1,253 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from functools import partial
+
+import redis
+from environs import Env
+from telegram.ext import ExtBot
+
+from elastic_api import MoltinClient, renew_token
+from send_scheduler import SendScheduler
+from token_manager import TokenManager
+
+logger = logging.getLogger(__name__)
+
+# ARGV: job id, due time, payload. A job id that is scheduled or running is left as it is
+SCHEDULE_SCRIPT = '''
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) or redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+return 1
+'''
+
+# ARGV: now, lease deadline, count. Jobs of expired leases are due again, then due jobs are leased
+CLAIM_SCRIPT = '''
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, job_id in ipairs(expired) do
+    redis.call('ZADD', KEYS[1], ARGV[1], job_id)
+end
+if #expired > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+end
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+local jobs = {}
+for _, job_id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('ZADD', KEYS[2], ARGV[2], job_id)
+    table.insert(jobs, job_id)
+    table.insert(jobs, redis.call('HGET', KEYS[3], job_id) or false)
+end
+return jobs
+'''
+
+# ARGV: job id, due time. Moves a leased job back to the schedule
+RESCHEDULE_SCRIPT = '''
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+return 1
+'''
+
+
+class DelayedJobs:
+    """
+    Durable delayed jobs in redis: a sorted set of job ids by due time and a hash of their
+    payloads, nothing is kept in the process. Workers of any number of processes claim due jobs
+    in batches with a Lua script, a claimed job is leased for `lease` seconds and becomes due
+    again if its worker doesn't finish it in time. Scheduling a job id that is already waiting
+    or running does nothing.
+    """
+
+    schedule_key = 'delayed_jobs'
+    leases_key = 'delayed_jobs:leases'
+    payloads_key = 'delayed_jobs:payloads'
+    dead_letters_key = 'delayed_jobs:dead'
+
+    def __init__(self, redis_base, lease=60):
+        self.redis_base = redis_base
+        self.lease = lease
+        self._schedule = redis_base.register_script(SCHEDULE_SCRIPT)
+        self._claim = redis_base.register_script(CLAIM_SCRIPT)
+        self._reschedule = redis_base.register_script(RESCHEDULE_SCRIPT)
+
+    def schedule(self, name, when, context=None, job_id=None):
+        """Runs job `name` with `context` in `when` seconds, returns the job id or None for a duplicate"""
+        job_id = job_id or uuid.uuid4().hex
+        payload = json.dumps({'name': name, 'context': context, 'attempts': 0}, ensure_ascii=False)
+        keys = [self.schedule_key, self.leases_key, self.payloads_key]
+        if not self._schedule(keys=keys, args=[job_id, time.time() + when, payload]):
+            return None
+        return job_id
+
+    def claim(self, count=100):
+        now = time.time()
+        keys = [self.schedule_key, self.leases_key, self.payloads_key]
+        response = self._claim(keys=keys, args=[now, now + self.lease, count])
+        jobs = []
+        for job_id, payload in zip(response[::2], response[1::2]):
+            if payload:
+                jobs.append((job_id, json.loads(payload)))
+            else:
+                # the payload of a finished job is gone
+                self.redis_base.zrem(self.leases_key, job_id)
+        return jobs
+
+    def done(self, job_id):
+        pipeline = self.redis_base.pipeline()
+        pipeline.zrem(self.leases_key, job_id)
+        pipeline.hdel(self.payloads_key, job_id)
+        pipeline.execute()
+
+    def reschedule(self, job_id, when, payload=None):
+        """Runs a claimed job again in `when` seconds, with an updated payload if it's given"""
+        if payload is not None:
+            self.redis_base.hset(self.payloads_key, job_id, json.dumps(payload, ensure_ascii=False))
+        return bool(self._reschedule(keys=[self.schedule_key, self.leases_key], args=[job_id, time.time() + when]))
+
+    def bury(self, job_id, payload):
+        self.redis_base.rpush(self.dead_letters_key, json.dumps(dict(payload, id=job_id), ensure_ascii=False))
+        self.done(job_id)
+
+    def stats(self):
+        pipeline = self.redis_base.pipeline()
+        pipeline.zcard(self.schedule_key)
+        pipeline.zcard(self.leases_key)
+        pipeline.zrange(self.schedule_key, 0, 0, withscores=True)
+        pipeline.llen(self.dead_letters_key)
+        waiting, running, first, dead = pipeline.execute()
+        return {
+            'waiting': waiting,
+            'running': running,
+            'overdue': max(0.0, time.time() - first[0][1]) if first else 0.0,
+            'dead': dead,
+        }
+
+
+class DelayedJobWorker:
+    """
+    Runs due jobs with `handlers[name](context)`. A handler may return the number of seconds
+    in which the job has to run again. A failed job is retried with backoff, after
+    `max_attempts` it's moved to dead letters.
+    """
+
+    def __init__(self, jobs, handlers, consumer=None, batch_size=100, poll_interval=0.5, max_attempts=5,
+                 backoff=5, max_backoff=300):
+        self.jobs = jobs
+        self.handlers = handlers
+        self.consumer = consumer or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.completed = 0
+        self.failed = 0
+
+    def handle(self, job_id, payload):
+        try:
+            next_run = self.handlers[payload['name']](payload['context'])
+        except Exception:
+            logger.exception('Delayed job %s %s failed', payload['name'], job_id)
+            self.failed += 1
+            payload['attempts'] += 1
+            if payload['attempts'] >= self.max_attempts:
+                self.jobs.bury(job_id, payload)
+            else:
+                delay = min(self.max_backoff, self.backoff * 2 ** (payload['attempts'] - 1))
+                self.jobs.reschedule(job_id, delay, payload)
+            return False
+
+        self.completed += 1
+        if next_run is None:
+            self.jobs.done(job_id)
+        else:
+            self.jobs.reschedule(job_id, next_run, dict(payload, attempts=0))
+        return True
+
+    def run_once(self):
+        jobs = self.jobs.claim(self.batch_size)
+        for job_id, payload in jobs:
+            self.handle(job_id, payload)
+        return len(jobs)
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            try:
+                if self.run_once() < self.batch_size:
+                    stop_event.wait(self.poll_interval)
+            except Exception:
+                logger.exception('Delayed job worker %s failed', self.consumer)
+                stop_event.wait(1)
+
+
+def send_notification(send_scheduler, chat_id, timeout=30):
+    text = "Приятного аппетита! *место для рекламы сообщение что делать если пицца не пришла"
+    # waits for the result, so a failed send fails the job and it's retried
+    send_scheduler.send('send_message', chat_id=chat_id, text=text, timeout=timeout)
+
+
+def get_job_handlers(send_scheduler, token_manager):
+    return {
+        'send_notification': partial(send_notification, send_scheduler),
+        'renew_token': partial(renew_token, token_manager),
+    }
+
+
+def start_job_workers(jobs, handlers, workers=1, **worker_kwargs):
+    stop_event = threading.Event()
+    job_workers = [DelayedJobWorker(jobs, handlers, **worker_kwargs) for _ in range(workers)]
+    threads = [
+        threading.Thread(target=worker.run, args=(stop_event,), name=f'delayed-job-worker-{number}', daemon=True)
+        for number, worker in enumerate(job_workers)
+    ]
+    for thread in threads:
+        thread.start()
+    return job_workers, threads, stop_event
+
+
+def stop_job_workers(threads, stop_event, timeout=10):
+    """Lets the workers finish their current jobs, an unfinished job runs again when its lease expires"""
+    stop_event.set()
+    for thread in threads:
+        thread.join(timeout)
+
+
+def main():
+    env = Env()
+    env.read_env()
+    logging.basicConfig(level=logging.INFO)
+
+    redis_base = redis.Redis(host=env.str('REDIS_HOST'),
+                             port=env.str('REDIS_PORT'),
+                             password=env.str('REDIS_PASSWORD'),
+                             decode_responses=True)
+    moltin = MoltinClient()
+    moltin.token_manager = TokenManager(redis_base, partial(moltin.get_client_auth,
+                                                            env.str('ELASTIC_CLIENT_SECRET'),
+                                                            env.str('ELASTIC_CLIENT_ID')))
+    send_scheduler = SendScheduler(ExtBot(env.str('TG_TOKEN'))).start()
+
+    jobs = DelayedJobs(redis_base)
+    jobs.schedule('renew_token', 0, job_id='renew_token')
+    _, threads, stop_event = start_job_workers(jobs,
+                                               get_job_handlers(send_scheduler, moltin.token_manager),
+                                               workers=env.int('DELAYED_JOB_WORKERS', 2))
+    try:
+        stop_event.wait()
+    except KeyboardInterrupt:
+        pass
+    stop_job_workers(threads, stop_event)
+    send_scheduler.stop()
+
+
+if __name__ == '__main__':
+    main()
+
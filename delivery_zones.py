@@ -0,0 +1,241 @@
+import json
+import logging
+import threading
+from collections import defaultdict, namedtuple
+from math import asin, cos, floor, pi, radians, sin, sqrt
+
+import requests
+from geopy.distance import distance as dist
+
+from geo_api import EARTH_RADIUS_KM, SPHERE_ERROR, PizzeriaIndex
+
+logger = logging.getLogger(__name__)
+
+KM_PER_DEGREE = pi * EARTH_RADIUS_KM / 180
+PIZZERIAS_KEY = 'pizzerias'
+# upper bounds of delivery distances in km and delivery fees in rubles
+DEFAULT_TIERS = ((0.5, 0), (3, 100), (20, 300))
+# tiers up to this distance in km are delivered by scooter, farther ones by car
+SCOOTER_MAX_DISTANCE = 3
+
+DeliveryQuote = namedtuple('DeliveryQuote', ['pizzeria', 'distance', 'fee', 'tier', 'max_distance'])
+
+
+def parse_tiers(tiers, default=DEFAULT_TIERS):
+    """Parses delivery tiers of a pizzeria written like '0.5:0, 3:100, 20:300'"""
+    if not tiers:
+        return default
+    parsed_tiers = []
+    for tier in str(tiers).split(','):
+        max_distance, fee = tier.split(':')
+        parsed_tiers.append((float(max_distance), int(fee)))
+    return tuple(sorted(parsed_tiers))
+
+
+def find_tier(tiers, distance):
+    for tier, (max_distance, _) in enumerate(tiers):
+        if distance < max_distance:
+            return tier
+    return None
+
+
+def get_haversine_distance(first_location, second_location):
+    first_latitude, first_longitude = (radians(float(coordinate)) for coordinate in first_location)
+    second_latitude, second_longitude = (radians(float(coordinate)) for coordinate in second_location)
+    a = (sin((second_latitude - first_latitude) / 2) ** 2
+         + cos(first_latitude) * cos(second_latitude) * sin((second_longitude - first_longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(a)))
+
+
+def get_pizzeria_id(pizzeria):
+    return pizzeria.get('id') or pizzeria['address']
+
+
+def load_pizzerias(moltin, redis_base, flow_slug):
+    """Fetches pizzerias from Moltin and keeps a copy in redis, the copy is used while Moltin is unavailable"""
+    try:
+        pizzerias = moltin.fetch_pizzerias_with_coordinates(flow_slug)
+    except requests.RequestException as error:
+        stored_pizzerias = redis_base.get(PIZZERIAS_KEY)
+        if not stored_pizzerias:
+            raise
+        logger.warning('Pizzerias are loaded from the redis copy: %s', error)
+        return [
+            dict(pizzeria, coordinates=tuple(pizzeria['coordinates']))
+            for pizzeria in json.loads(stored_pizzerias)
+        ]
+    redis_base.set(PIZZERIAS_KEY, json.dumps(pizzerias, ensure_ascii=False))
+    return pizzerias
+
+
+class DeliveryZones:
+    """
+    Delivery fee lookup on a grid of `cell_size` km cells. For every cell within delivery reach
+    of some pizzeria it's precomputed which pizzeria delivers there and for what fee, the distance
+    shown to the user is then a haversine one. A cell crossed by a tier or by the border between
+    two pizzerias keeps the pizzerias that may deliver there and is checked with exact geodesic
+    distances. A changed pizzeria rebuilds only the cells within its reach.
+    """
+
+    def __init__(self, pizzerias, cell_size=0.5, default_tiers=DEFAULT_TIERS, reference_latitude=None):
+        pizzerias = list(pizzerias)
+        if reference_latitude is None:
+            latitudes = [float(pizzeria['coordinates'][0]) for pizzeria in pizzerias]
+            reference_latitude = sum(latitudes) / len(latitudes) if latitudes else 55.75
+        self.cell_size = cell_size
+        self.default_tiers = default_tiers
+        self.latitude_step = cell_size / KM_PER_DEGREE
+        self.longitude_step = self.latitude_step / cos(radians(reference_latitude))
+        self._lock = threading.Lock()
+
+        pizzerias = {get_pizzeria_id(pizzeria): pizzeria for pizzeria in pizzerias}
+        tiers = {pizzeria_id: self._get_tiers(pizzeria) for pizzeria_id, pizzeria in pizzerias.items()}
+        self._state = (pizzerias, tiers, {}, {}, PizzeriaIndex(pizzerias.values()))
+        self._rebuild(pizzerias, tiers, self._get_regions(pizzerias.values(), tiers))
+
+    def _get_tiers(self, pizzeria):
+        return parse_tiers(pizzeria.get('delivery-tiers'), self.default_tiers)
+
+    def _get_cell(self, location):
+        latitude, longitude = (float(coordinate) for coordinate in location)
+        return floor(latitude / self.latitude_step), floor(longitude / self.longitude_step)
+
+    def _get_cell_center(self, cell):
+        row, column = cell
+        return (row + 0.5) * self.latitude_step, (column + 0.5) * self.longitude_step
+
+    def _get_cell_radius(self, cell):
+        row, _ = cell
+        equatorward_latitude = min(abs(row), abs(row + 1)) * self.latitude_step
+        width = self.longitude_step * KM_PER_DEGREE * cos(radians(equatorward_latitude))
+        return sqrt(self.cell_size ** 2 + width ** 2) / 2
+
+    def _get_reach_bounds(self, pizzeria, reach):
+        latitude, longitude = (float(coordinate) for coordinate in pizzeria['coordinates'])
+        latitude_reach = reach / KM_PER_DEGREE + self.latitude_step
+        max_latitude = min(89.0, abs(latitude) + latitude_reach)
+        longitude_reach = reach / (KM_PER_DEGREE * cos(radians(max_latitude))) + self.longitude_step
+        first_cell = self._get_cell((latitude - latitude_reach, longitude - longitude_reach))
+        last_cell = self._get_cell((latitude + latitude_reach, longitude + longitude_reach))
+        return first_cell, last_cell
+
+    def _classify(self, cell, candidates, tiers):
+        """Returns (pizzeria_id, fee, tier) when one pizzeria delivers to the whole cell for one fee"""
+        candidates.sort()
+        distance, pizzeria_id = candidates[0]
+        radius = self._get_cell_radius(cell) + distance * SPHERE_ERROR
+        pizzeria_tiers = tiers[pizzeria_id]
+        tier = find_tier(pizzeria_tiers, distance + radius)
+        if tier is None or find_tier(pizzeria_tiers, max(0.0, distance - radius)) != tier:
+            return None
+        if len(candidates) > 1 and candidates[1][0] * (1 - SPHERE_ERROR) - self._get_cell_radius(cell) <= distance + radius:
+            return None
+        return pizzeria_id, pizzeria_tiers[tier][1], tier
+
+    def _get_regions(self, pizzerias, tiers):
+        return [
+            self._get_reach_bounds(pizzeria, tiers[get_pizzeria_id(pizzeria)][-1][0])
+            for pizzeria in pizzerias
+        ]
+
+    def _rebuild(self, pizzerias, tiers, regions):
+        """Recomputes the cells of `regions` and swaps in the new state"""
+        affected_cells = set()
+        for (first_row, first_column), (last_row, last_column) in regions:
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    affected_cells.add((row, column))
+
+        candidates = defaultdict(list)
+        for pizzeria_id, pizzeria in pizzerias.items():
+            reach = tiers[pizzeria_id][-1][0]
+            (first_row, first_column), (last_row, last_column) = self._get_reach_bounds(pizzeria, reach)
+            if not any(first_row <= region_last[0] and region_first[0] <= last_row
+                       and first_column <= region_last[1] and region_first[1] <= last_column
+                       for region_first, region_last in regions):
+                continue
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    cell = (row, column)
+                    if cell not in affected_cells:
+                        continue
+                    distance = get_haversine_distance(self._get_cell_center(cell), pizzeria['coordinates'])
+                    if distance * (1 - SPHERE_ERROR) - self._get_cell_radius(cell) < reach:
+                        candidates[cell].append((distance, pizzeria_id))
+
+        _, _, zones, boundary_cells, _ = self._state
+        zones = dict(zones)
+        boundary_cells = dict(boundary_cells)
+        for cell in affected_cells:
+            zones.pop(cell, None)
+            boundary_cells.pop(cell, None)
+            if cell not in candidates:
+                continue
+            zone = self._classify(cell, candidates[cell], tiers)
+            if zone:
+                zones[cell] = zone
+            else:
+                boundary_cells[cell] = tuple(pizzeria_id for _, pizzeria_id in candidates[cell])
+        # quotes read the state without locking, so it's replaced at once
+        self._state = (pizzerias, tiers, zones, boundary_cells, PizzeriaIndex(pizzerias.values()))
+        return len(affected_cells)
+
+    def sync(self, pizzerias):
+        """Applies a fresh list of pizzerias, returns the number of changed ones"""
+        with self._lock:
+            old_pizzerias, old_tiers, _, _, _ = self._state
+            pizzerias = {get_pizzeria_id(pizzeria): pizzeria for pizzeria in pizzerias}
+            changed_ids = {
+                pizzeria_id for pizzeria_id in old_pizzerias.keys() | pizzerias.keys()
+                if old_pizzerias.get(pizzeria_id) != pizzerias.get(pizzeria_id)
+            }
+            if not changed_ids:
+                return 0
+
+            tiers = {pizzeria_id: self._get_tiers(pizzeria) for pizzeria_id, pizzeria in pizzerias.items()}
+            regions = self._get_regions(
+                [old_pizzerias[pizzeria_id] for pizzeria_id in changed_ids if pizzeria_id in old_pizzerias],
+                old_tiers,
+            )
+            regions += self._get_regions(
+                [pizzerias[pizzeria_id] for pizzeria_id in changed_ids if pizzeria_id in pizzerias],
+                tiers,
+            )
+            self._rebuild(pizzerias, tiers, regions)
+            return len(changed_ids)
+
+    def quote(self, user_location):
+        """
+        Returns DeliveryQuote with the pizzeria that delivers to the user and the fee.
+        When nobody delivers there, the quote has the nearest pizzeria and no fee,
+        without pizzerias at all None is returned.
+        """
+        pizzerias, tiers, zones, boundary_cells, index = self._state
+        cell = self._get_cell(user_location)
+
+        zone = zones.get(cell)
+        if zone:
+            pizzeria_id, fee, tier = zone
+            pizzeria = pizzerias[pizzeria_id]
+            distance = get_haversine_distance(pizzeria['coordinates'], user_location)
+            return DeliveryQuote(dict(pizzeria), distance, fee, tier, tiers[pizzeria_id][tier][0])
+
+        nearest = None
+        for pizzeria_id in boundary_cells.get(cell, ()):
+            pizzeria = pizzerias[pizzeria_id]
+            distance = dist(pizzeria['coordinates'], user_location).km
+            tier = find_tier(tiers[pizzeria_id], distance)
+            if tier is not None and (nearest is None or distance < nearest.distance):
+                max_distance, fee = tiers[pizzeria_id][tier]
+                nearest = DeliveryQuote(dict(pizzeria), distance, fee, tier, max_distance)
+        if nearest:
+            return nearest
+
+        nearest_pizzeria = index.nearest(user_location)
+        if not nearest_pizzeria:
+            return None
+        return DeliveryQuote(nearest_pizzeria, nearest_pizzeria['distance'], None, None, None)
+
+    def stats(self):
+        pizzerias, _, zones, boundary_cells, _ = self._state
+        return {'pizzerias': len(pizzerias), 'zone_cells': len(zones), 'boundary_cells': len(boundary_cells)}
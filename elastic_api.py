@@ -1,4 +1,18 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from bulk_import import BulkImporter, RateLimiter
+from metrics import get_endpoint, observe_upstream
+from resilience import MOLTIN_DEADLINES, CallPolicy, read_content
+
+MOLTIN_API_URL = 'https://api.moltin.com'
+MOLTIN_PAGE_LIMIT = 100
 
 
 def fetch_addresses():
@@ -17,556 +31,454 @@ def fetch_menu():
     return response.json()
 
 
-def get_client_auth(client_secret, client_id):
-    data = {
-        f'client_id': {client_id},
-        f'client_secret': {client_secret},
-        'grant_type': 'client_credentials'
-    }
-
-    response = requests.post('https://api.moltin.com/oauth/access_token',
-                             data=data)
-    response.raise_for_status()
-
-    return response.json()
-
-
-def add_product(token, product, num):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    json_data = {
-        'data': {
-            'type': 'product',
-            'name': f'{product["name"]}',
-            'slug': str(f'pizza-{num}'),
-            'sku': str(f'pizza-{num}'),
-            'description': f'{product["description"]}',
-            'manage_stock': False,
-            'price': [
-                {
-                    'amount': f'{product["price"]}',
-                    'currency': 'RUB',
-                    'includes_tax': True,
-                },
-            ],
-            'status': 'live',
-            'commodity_type': 'physical',
-        },
-    }
-
-    response = requests.post('https://api.moltin.com/v2/products',
-                             headers=headers,
-                             json=json_data)
-
-    response.raise_for_status()
-
-    return response.json()
-
-
-def get_all_products(token):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    response = requests.get('https://api.moltin.com/v2/products',
-                            headers=headers)
-    response.raise_for_status()
-
-    return response.json()
-
-
-def get_product_info(elastic_token, product_id):
-    headers = {
-        'Authorization': f'Bearer {elastic_token}',
-    }
-
-    response = requests.get(f'https://api.moltin.com/v2/products/{product_id}',
-                            headers=headers)
-    response.raise_for_status()
-
-    return response.json()
-
-
-def delete_product(token, product_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    response = requests.delete(f'https://api.moltin.com/v2/products/{product_id}',
-                               headers=headers)
-    response.raise_for_status()
-
-
-def delete_image(token, image_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    response = requests.delete(f'https://api.moltin.com/v2/files/{image_id}',
-                               headers=headers)
-    response.raise_for_status()
-
-
-def upload_image(token, image_url):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    files = {
-        'file_location': (None, f'{image_url}'),
-    }
-
-    response = requests.post('https://api.moltin.com/v2/files',
-                             headers=headers,
-                             files=files)
-    response.raise_for_status()
-
-    return response.json()
-
-
-def get_all_images(token):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    response = requests.get('https://api.moltin.com/v2/files',
-                            headers=headers)
-    response.raise_for_status()
-
-    return response.json()
-
-
-def bind_image_with_product(token, image_id, product_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    json_data = {
-        'data': {
-            'type': 'main_image',
-            'id': f'{image_id}',
-        },
-    }
-
-    response = requests.post(f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image',
-                             headers=headers,
-                             json=json_data)
-    response.raise_for_status()
-
-    return response.json()
-
-
-def create_currency(token, currency, default, enable):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    json_data = {
-        'data': {
-            'type': 'currency',
-            'code': currency,
-            'exchange_rate': 1,
-            'format': '{price}',
-            'decimal_point': '.',
-            'thousand_separator': ',',
-            'decimal_places': 2,
-            'default': default,
-            'enabled': enable,
-        },
-    }
-
-    response = requests.post('https://api.moltin.com/v2/currencies',
-                             headers=headers,
-                             json=json_data)
-    response.raise_for_status()
-
-    return response.json()
-
-
-def get_all_currencies(token):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    response = requests.get('https://api.moltin.com/v2/currencies',
-                            headers=headers)
-    response.raise_for_status()
-
-    return response.json()
+class MoltinClient:
+    """
+    Keeps one keep-alive session to the Moltin API, so connections (and TLS handshakes)
+    are reused between calls of all the bot workers. Every call has a deadline and goes
+    through the circuit breaker of `policy`, GETs are retried.
+    """
 
+    def __init__(self, token=None, base_url=MOLTIN_API_URL, pool_connections=2, pool_maxsize=16, rate_limiter=None,
+                 token_manager=None, policy=None):
+        self.base_url = base_url.rstrip('/')
+        self.rate_limiter = rate_limiter
+        self.token_manager = token_manager
+        self.policy = policy or CallPolicy('moltin', MOLTIN_DEADLINES)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.token = token
+
+    def close(self):
+        self.session.close()
+
+    def get_token(self):
+        if self.token_manager:
+            return self.token_manager.get_token()
+        return self.token
+
+    def refresh_token(self, stale_token):
+        """Returns a valid token after the API answered 401 to `stale_token`, or None if it can't be renewed"""
+        if not self.token_manager:
+            return None
+        return self.token_manager.refresh_after_unauthorized(stale_token)
+
+    def _send(self, method, path, token, headers, deadline, **kwargs):
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        request_headers = {'Authorization': f'Bearer {token}'} if token else {}
+        request_headers.update(headers or {})
+
+        endpoint = get_endpoint(method, path)
+
+        def send(timeout, deadline):
+            started_at = time.perf_counter()
+            try:
+                response = self.session.request(method, f'{self.base_url}{path}', headers=request_headers,
+                                                timeout=timeout, stream=True, **kwargs)
+                read_content(response, deadline)
+            except requests.RequestException:
+                observe_upstream('moltin', endpoint, 'error', started_at)
+                raise
+            observe_upstream('moltin', endpoint, response.status_code, started_at)
+            return response
+
+        return self.policy.call(method, path, send, deadline)
+
+    def _request(self, method, path, headers=None, authorized=True, **kwargs):
+        # the retry with a fresh token is the same call, so it has the same deadline
+        deadline = self.policy.start(path)
+        token = self.get_token() if authorized else None
+        response = self._send(method, path, token, headers, deadline, **kwargs)
+        if response.status_code == 401 and authorized:
+            fresh_token = self.refresh_token(token)
+            if fresh_token:
+                response = self._send(method, path, fresh_token, headers, deadline, **kwargs)
+        response.raise_for_status()
+
+        return response
+
+    def _get_page(self, path, limit, offset):
+        params = {
+            'page[limit]': limit,
+            'page[offset]': offset,
+        }
 
-def delete_currency(token, currency_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
+        return self._request('GET', path, params=params).json()
+
+    def iter_pages(self, path, limit=MOLTIN_PAGE_LIMIT, max_workers=4):
+        """
+        Yields items of a list endpoint page by page. The first page tells the total number of pages,
+        the rest are fetched concurrently, at most `max_workers` pages are held in memory at once.
+        """
+        first_page = self._get_page(path, limit, 0)
+        yield from first_page['data']
+
+        total_pages = first_page.get('meta', {}).get('page', {}).get('total', 1)
+        offsets = iter(range(limit, total_pages * limit, limit))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pages = deque(
+                executor.submit(self._get_page, path, limit, offset)
+                for offset in islice(offsets, max_workers)
+            )
+            while pages:
+                page = pages.popleft().result()
+                for offset in islice(offsets, 1):
+                    pages.append(executor.submit(self._get_page, path, limit, offset))
+                yield from page['data']
+
+    def iter_products(self):
+        return self.iter_pages('/v2/products')
+
+    def iter_images(self):
+        return self.iter_pages('/v2/files')
+
+    def iter_fields(self):
+        return self.iter_pages('/v2/fields')
+
+    def iter_entries(self, flow_slug):
+        return self.iter_pages(f'/v2/flows/{flow_slug}/entries')
+
+    def get_client_auth(self, client_secret, client_id):
+        data = {
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'grant_type': 'client_credentials'
+        }
 
-    response = requests.delete(f'https://api.moltin.com/v2/currencies/{currency_id}',
-                               headers=headers)
-    response.raise_for_status()
+        return self._request('POST', '/oauth/access_token', data=data, authorized=False).json()
+
+    def authenticate(self, client_secret, client_id):
+        elastic_auth = self.get_client_auth(client_secret, client_id)
+        self.token = elastic_auth.get('access_token')
+
+        return elastic_auth
+
+    def add_product(self, product, num):
+        json_data = {
+            'data': {
+                'type': 'product',
+                'name': f'{product["name"]}',
+                'slug': str(f'pizza-{num}'),
+                'sku': str(f'pizza-{num}'),
+                'description': f'{product["description"]}',
+                'manage_stock': False,
+                'price': [
+                    {
+                        'amount': f'{product["price"]}',
+                        'currency': 'RUB',
+                        'includes_tax': True,
+                    },
+                ],
+                'status': 'live',
+                'commodity_type': 'physical',
+            },
+        }
 
-    return response.json()
+        return self._request('POST', '/v2/products', json=json_data).json()
 
+    def get_all_products(self):
+        return {'data': list(self.iter_products())}
 
-def update_currency(token, currency_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
+    def get_product_by_slug(self, slug):
+        """Returns the product with `slug`, or None if there is no such product"""
+        params = {'filter': f'eq(slug,{slug})'}
+        products = self._request('GET', '/v2/products', params=params).json()['data']
+        return next(iter(products), None)
 
-    json_data = {
-        'data': {
-            'type': 'currency',
-            'exchange_rate': 1.0,
-            'format': '{price}',
-        },
-    }
+    def get_product_info(self, product_id):
+        return self._request('GET', f'/v2/products/{product_id}').json()
 
-    response = requests.put(f'https://api.moltin.com/v2/currencies/{currency_id}',
-                            headers=headers,
-                            json=json_data)
-    response.raise_for_status()
+    def delete_product(self, product_id):
+        self._request('DELETE', f'/v2/products/{product_id}')
 
-    return response.json()
+    def delete_image(self, image_id):
+        self._request('DELETE', f'/v2/files/{image_id}')
 
+    def upload_image(self, image_url):
+        files = {
+            'file_location': (None, f'{image_url}'),
+        }
 
-def create_flow(token, name, slug, description):
-    headers = {
-        'Authorization': f'{token}',
-    }
-
-    json_data = {
-        'data': {
-            'type': 'flow',
-            'name': name,
-            'slug': slug,
-            'description': description,
-            'enabled': True,
-        },
-    }
-
-    response = requests.post('https://api.moltin.com/v2/flows',
-                             headers=headers,
-                             json=json_data)
-    response.raise_for_status()
+        return self._request('POST', '/v2/files', files=files).json()
 
-    return response.json()
+    def get_all_images(self):
+        return {'data': list(self.iter_images())}
 
+    def bind_image_with_product(self, image_id, product_id):
+        json_data = {
+            'data': {
+                'type': 'main_image',
+                'id': f'{image_id}',
+            },
+        }
 
-def delete_flow(token, flow_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
+        return self._request('POST', f'/v2/products/{product_id}/relationships/main-image', json=json_data).json()
+
+    def create_currency(self, currency, default, enable):
+        json_data = {
+            'data': {
+                'type': 'currency',
+                'code': currency,
+                'exchange_rate': 1,
+                'format': '{price}',
+                'decimal_point': '.',
+                'thousand_separator': ',',
+                'decimal_places': 2,
+                'default': default,
+                'enabled': enable,
+            },
+        }
 
-    response = requests.delete(f'https://api.moltin.com/v2/flows/{flow_id}',
-                               headers=headers)
-    response.raise_for_status()
+        return self._request('POST', '/v2/currencies', json=json_data).json()
 
+    def get_all_currencies(self):
+        return self._request('GET', '/v2/currencies').json()
 
-def get_flow(token, flow_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
+    def delete_currency(self, currency_id):
+        return self._request('DELETE', f'/v2/currencies/{currency_id}').json()
 
-    response = requests.get(f'https://api.moltin.com/v2/flows/{flow_id}',
-                            headers=headers)
-    response.raise_for_status()
+    def update_currency(self, currency_id):
+        json_data = {
+            'data': {
+                'type': 'currency',
+                'exchange_rate': 1.0,
+                'format': '{price}',
+            },
+        }
 
-    return response.json()
+        return self._request('PUT', f'/v2/currencies/{currency_id}', json=json_data).json()
 
+    def create_flow(self, name, slug, description):
+        json_data = {
+            'data': {
+                'type': 'flow',
+                'name': name,
+                'slug': slug,
+                'description': description,
+                'enabled': True,
+            },
+        }
 
-def create_field(token, name, field_type, flow_id, description):
-    headers = {
-        'Authorization': f'{token}',
-    }
-
-    json_data = {
-        'data': {
-            'type': 'field',
-            'name': name,
-            'slug': f'{name}-field-slug',
-            'field_type': field_type,
-            'description': description,
-            'required': False,
-            'enabled': True,
-            'omit_null': False,
-            'relationships': {
-                'flow': {
-                    'data': {
-                        'type': 'flow',
-                        'id': f'{flow_id}',
+        return self._request('POST', '/v2/flows', json=json_data).json()
+
+    def delete_flow(self, flow_id):
+        self._request('DELETE', f'/v2/flows/{flow_id}')
+
+    def get_flow(self, flow_id):
+        return self._request('GET', f'/v2/flows/{flow_id}').json()
+
+    def create_field(self, name, field_type, flow_id, description):
+        json_data = {
+            'data': {
+                'type': 'field',
+                'name': name,
+                'slug': f'{name}-field-slug',
+                'field_type': field_type,
+                'description': description,
+                'required': False,
+                'enabled': True,
+                'omit_null': False,
+                'relationships': {
+                    'flow': {
+                        'data': {
+                            'type': 'flow',
+                            'id': f'{flow_id}',
+                        },
                     },
                 },
             },
-        },
-    }
-
-    response = requests.post('https://api.moltin.com/v2/fields',
-                             headers=headers,
-                             json=json_data)
-    response.raise_for_status()
-
-
-def get_all_fields(token):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    response = requests.get('https://api.moltin.com/v2/fields',
-                            headers=headers)
-    response.raise_for_status()
-
-    return response.json()
-
-
-def get_fields_by_flow(token, flow_slug):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    response = requests.get(f'https://api.moltin.com/v2/flows/{flow_slug}/fields',
-                            headers=headers)
-    response.raise_for_status()
-
-    return response.json()
-
-
-def create_entry(token, fields_slugs, values, flow_slug):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-    json_data = {
-        'data': {'type': 'entry'}
-    }
-    for slug, value in zip(fields_slugs, values):
-        json_data['data'].update({
-            slug: value
-        })
-    response = requests.post(f'https://api.moltin.com/v2/flows/{flow_slug}/entries',
-                             headers=headers,
-                             json=json_data)
-    response.raise_for_status()
-    return response.json()
-
-
-def update_entry(token, entry_id, field_slug, value, flow_slug):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    json_data = {
-        'data': {
-            'id': entry_id,
-            'type': 'entry',
-            field_slug: value}
-    }
-
-    response = requests.put(f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}',
-                            headers=headers,
-                            json=json_data)
-    print(response.json())
-    response.raise_for_status()
-
-    return response.json()
-
-
-def get_all_entries(token, flow_slug):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
-
-    params = {
-        'page': 100,
-    }
-
-    response = requests.get(f'https://api.moltin.com/v2/flows/{flow_slug}/entries',
-                            headers=headers,
-                            params=params)
-    response.raise_for_status()
-
-    return response.json()
-
+        }
 
-def get_flow_id_by_slug(token, flow_slug):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
+        self._request('POST', '/v2/fields', json=json_data)
 
-    response = requests.get(f'https://api.moltin.com/v2/flows/{flow_slug}/fields',
-                            headers=headers)
-    response.raise_for_status()
+    def get_all_fields(self):
+        return {'data': list(self.iter_fields())}
 
-    return next(iter(response.json().get('data'))).get('relationships')['flow']['data']['id']
+    def get_fields_by_flow(self, flow_slug):
+        return self._request('GET', f'/v2/flows/{flow_slug}/fields').json()
 
+    def create_entry(self, fields_slugs, values, flow_slug):
+        json_data = {
+            'data': {'type': 'entry'}
+        }
+        for slug, value in zip(fields_slugs, values):
+            json_data['data'].update({
+                slug: value
+            })
+
+        return self._request('POST', f'/v2/flows/{flow_slug}/entries', json=json_data).json()
+
+    def update_entry(self, entry_id, field_slug, value, flow_slug):
+        json_data = {
+            'data': {
+                'id': entry_id,
+                'type': 'entry',
+                field_slug: value}
+        }
 
-def get_image_link(elastic_token, product_image_id):
-    headers = {
-        f'Authorization': f'Bearer {elastic_token}',
-    }
+        return self._request('PUT', f'/v2/flows/{flow_slug}/entries/{entry_id}', json=json_data).json()
 
-    response = requests.get(f'https://api.moltin.com/v2/files/{product_image_id}',
-                            headers=headers)
-    response.raise_for_status()
-    image_link = response.json()['data']['link']['href']
+    def find_entry(self, flow_slug, field_slug, value):
+        """Returns the first entry of the flow with `value` in the field, or None"""
+        return next((entry for entry in self.iter_entries(flow_slug) if entry.get(field_slug) == value), None)
 
-    return image_link
+    def get_all_entries(self, flow_slug):
+        return {'data': list(self.iter_entries(flow_slug))}
 
+    def get_flow_id_by_slug(self, flow_slug):
+        response = self._request('GET', f'/v2/flows/{flow_slug}/fields')
 
-def add_addresses(client_secret, client_id):
-    token = get_client_auth(client_secret, client_id).get('access_token')
+        return next(iter(response.json().get('data'))).get('relationships')['flow']['data']['id']
 
-    fields = get_fields_by_flow(token, flow_slug='pizzeria')
-    fields_slugs = [field['slug'] for field in fields['data']]
-    addresses = fetch_addresses()
-    for address in addresses:
-        try:
-            values = [
-                address.get('address').get('full'),
-                address.get('alias'),
-                float(address.get('coordinates').get('lon')),
-                float(address.get('coordinates').get('lat')),
-            ]
-            create_entry(token, fields_slugs, values, flow_slug='pizzeria')
-        except Exception as e:
-            print(f'Something is going wrong {e}')
-
-
-def add_pizzas(client_secret, client_id):
-    token = get_client_auth(client_secret, client_id).get('access_token')
+    def get_image_link(self, product_image_id):
+        response = self._request('GET', f'/v2/files/{product_image_id}')
 
-    menu = fetch_menu()
-    for num, product in enumerate(menu):
-        try:
-            product_id = add_product(token, product, num)['data']['id']
-            img_id = upload_image(token, product['product_image']['url'])['data']['id']
-            bind_image_with_product(token, img_id, product_id)
-        except Exception as e:
-            print(f'Something is going wrong {e}')
-
-
-def add_product_to_cart(token, cart_id, product_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'X-MOLTIN-CURRENCY': 'RUB'
-    }
-
-    json_data = {
-        'data': {
-            'id': product_id,
-            'type': 'cart_item',
-            'quantity': 1,
-        },
-    }
-
-    response = requests.post(f'https://api.moltin.com/v2/carts/{cart_id}/items', headers=headers, json=json_data)
-    response.raise_for_status()
-
-    return response.json()
+        return response.json()['data']['link']['href']
 
-
-def remove_product_from_cart(token, cart_id, product_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json',
-    }
-    response = requests.delete(f'https://api.moltin.com/v2/carts/{cart_id}/items/{product_id}', headers=headers)
-    response.raise_for_status()
-
-    return response.json()
-
-
-def create_cart(token, tg_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json',
-    }
-    json_data = {
-        'data': {
-            'name': tg_id,
-            'description': f'cart of user {tg_id}',
+    def add_product_to_cart(self, cart_id, product_id, quantity=1):
+        headers = {
+            'X-MOLTIN-CURRENCY': 'RUB'
         }
-    }
-    response = requests.post('https://api.moltin.com/v2/carts', headers=headers, json=json_data)
-    response.raise_for_status()
-
-    return response.json()
 
+        json_data = {
+            'data': {
+                'id': product_id,
+                'type': 'cart_item',
+                'quantity': quantity,
+            },
+        }
 
-def get_cart(token, cart_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
+        return self._request('POST', f'/v2/carts/{cart_id}/items', headers=headers, json=json_data).json()
 
-    response = requests.get(f'https://api.moltin.com/v2/carts/{cart_id}/items', headers=headers)
-    response.raise_for_status()
+    def remove_product_from_cart(self, cart_id, product_id):
+        return self._request('DELETE', f'/v2/carts/{cart_id}/items/{product_id}').json()
 
-    return response.json()
+    def create_cart(self, tg_id):
+        json_data = {
+            'data': {
+                'name': tg_id,
+                'description': f'cart of user {tg_id}',
+            }
+        }
 
+        return self._request('POST', '/v2/carts', json=json_data).json()
 
-def get_cart_total_price(token, cart_id):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
+    def get_cart(self, cart_id):
+        return self._request('GET', f'/v2/carts/{cart_id}/items').json()
 
-    response = requests.get(f'https://api.moltin.com/v2/carts/{cart_id}', headers=headers)
-    response.raise_for_status()
+    def get_cart_total_price(self, cart_id):
+        return self._request('GET', f'/v2/carts/{cart_id}').json()
 
-    return response.json()
+    def create_customer(self, user_id, email):
+        json_data = {
+            'data': {
+                'type': 'customer',
+                'name': f'{user_id}',
+                'email': f'{email}',
+                'password': 'mysecretpassword',
+            },
+        }
 
+        return self._request('POST', '/v2/customers', json=json_data).json()
 
-def create_customer(token, user_id, email):
-    headers = {
-        'Authorization': f'Bearer {token}',
-    }
+    def check_customer(self, client_id):
+        return self._request('GET', f'/v2/customers/{client_id}').json()
 
-    json_data = {
-        'data': {
-            'type': 'customer',
-            'name': f'{user_id}',
-            'email': f'{email}',
-            'password': 'mysecretpassword',
-        },
-    }
+    def fetch_pizzerias_with_coordinates(self, flow_slug):
+        pizzerias_with_coordinates = []
+        for pizzeria in self.iter_entries(flow_slug):
+            pizzerias_with_coordinates.append({
+                'id': pizzeria['id'],
+                'address': pizzeria['address'],
+                'coordinates': (pizzeria['latitude'], pizzeria['longitude']),
+                'deliveryman-telegram-id': pizzeria['deliveryman-telegram-id'],
+                'delivery-tiers': pizzeria.get('delivery-tiers'),
+            })
+        return pizzerias_with_coordinates
 
-    response = requests.post('https://api.moltin.com/v2/customers', headers=headers, json=json_data)
-    response.raise_for_status()
 
-    return response.json()
+def import_address(client, fields_slugs, address, progress):
+    """
+    Creates a pizzeria entry. The POST may have been applied even if its answer was lost,
+    so a retry first looks the entry up by the alias of the pizzeria.
+    """
+    values = [
+        address.get('address').get('full'),
+        address.get('alias'),
+        float(address.get('coordinates').get('lon')),
+        float(address.get('coordinates').get('lat')),
+    ]
+    entry = None
+    if progress.get('entry_sent'):
+        entry = client.find_entry('pizzeria', fields_slugs[1], address.get('alias'))
+    if entry is None:
+        progress['entry_sent'] = True
+        entry = client.create_entry(fields_slugs, values, flow_slug='pizzeria')['data']
+    progress['entry_id'] = entry['id']
+
+
+def import_pizza(client, numbered_product, progress):
+    """
+    Creates a product with its image. A retry of a product that may exist already looks it up
+    by slug, and a 409 on the slug means the product was created by an earlier attempt.
+    """
+    num, product = numbered_product
+    if 'product_id' not in progress:
+        slug = f'pizza-{num}'
+        created = None
+        if progress.get('product_sent'):
+            created = client.get_product_by_slug(slug)
+        if created is None:
+            progress['product_sent'] = True
+            try:
+                created = client.add_product(product, num)['data']
+            except requests.HTTPError as error:
+                if error.response.status_code != 409:
+                    raise
+                created = client.get_product_by_slug(slug)
+                if created is None:
+                    raise
+        progress['product_id'] = created['id']
+    if 'image_id' not in progress:
+        progress['image_id'] = client.upload_image(product['product_image']['url'])['data']['id']
+    client.bind_image_with_product(progress['image_id'], progress['product_id'])
+
+
+def add_addresses(client_secret, client_id, checkpoint_path='addresses.checkpoint', workers=8, rate=20):
+    client = MoltinClient(rate_limiter=RateLimiter(rate))
+    client.authenticate(client_secret, client_id)
+
+    fields = client.get_fields_by_flow(flow_slug='pizzeria')
+    fields_slugs = [field['slug'] for field in fields['data']]
 
+    addresses = fetch_addresses()
+    importer = BulkImporter(checkpoint_path, workers=workers)
+    return importer.run(
+        ((str(address.get('id') or address.get('alias')), address) for address in addresses),
+        partial(import_address, client, fields_slugs),
+    )
 
-def check_customer(elastic_token, client_id):
-    headers = {
-        'Authorization': f'Bearer {elastic_token}',
-    }
 
-    response = requests.get(f'https://api.moltin.com/v2/customers/{client_id}', headers=headers)
-    response.raise_for_status()
+def add_pizzas(client_secret, client_id, checkpoint_path='pizzas.checkpoint', workers=8, rate=20):
+    client = MoltinClient(rate_limiter=RateLimiter(rate))
+    client.authenticate(client_secret, client_id)
 
-    return response.json()
+    menu = fetch_menu()
+    importer = BulkImporter(checkpoint_path, workers=workers)
+    return importer.run(
+        ((f'pizza-{num}', (num, product)) for num, product in enumerate(menu)),
+        partial(import_pizza, client),
+    )
 
 
-def renew_token(bot_context):
+def renew_token(token_manager, _=None):
     """
-    :param bot_context: this is a context object passed to the callback called by :class:`telegram.ext.Handler`
-    or by the :class:`telegram.ext.Dispatcher`
-    :return: None
+    Delayed job keeping the Moltin token fresh
+    :param token_manager: TokenManager of the Moltin client
+    :return: seconds until the job has to run again
     """
-    client_secret = bot_context.bot_data['client_secret']
-    client_id = bot_context.bot_data['client_id']
-    elastic_auth = get_client_auth(client_secret, client_id)
-    bot_context.bot_data['token'] = elastic_auth.get('access_token')
-    bot_context.bot_data['token_expires_in'] = elastic_auth.get('expires_in')
-    bot_context.job_queue.run_once(renew_token, when=bot_context.bot_data['token_expires_in'])
-
-
-def fetch_pizzerias_with_coordinates(token, flow_slug):
-    pizzerias = get_all_entries(token, flow_slug)['data']
-    pizzerias_with_coordinates = []
-    for pizzeria in pizzerias:
-        pizzerias_with_coordinates.append({
-            'address': pizzeria['address'],
-            'coordinates': (pizzeria['latitude'], pizzeria['longitude']),
-            'deliveryman-telegram-id': pizzeria['deliveryman-telegram-id']
-        })
-    return pizzerias_with_coordinates
-
+    token_manager.get_token()
+    return token_manager.seconds_until_refresh()
@@ -1,16 +1,72 @@
+import json
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from heapq import heappush, heappushpop
+from math import radians, sin, cos, asin, sqrt
+
 import requests
 from geopy.distance import distance as dist
 
+from metrics import observe_upstream
+from resilience import CONNECT_TIMEOUT, GEOCODER_DEADLINE, CallPolicy, read_content
+
+YANDEX_GEOCODER_URL = "https://geocode-maps.yandex.ru/1.x"
+EARTH_RADIUS_KM = 6371.0088
+# a spherical distance differs from the geodesic one on WGS-84 ellipsoid by less than 0.6%
+SPHERE_ERROR = 0.01
+
+ADDRESS_ABBREVIATIONS = {
+    'г': 'город',
+    'ул': 'улица',
+    'пр': 'проспект',
+    'пр-т': 'проспект',
+    'просп': 'проспект',
+    'пер': 'переулок',
+    'ш': 'шоссе',
+    'наб': 'набережная',
+    'пл': 'площадь',
+    'б-р': 'бульвар',
+    'бул': 'бульвар',
+    'мкр': 'микрорайон',
+    'д': 'дом',
+    'к': 'корпус',
+    'корп': 'корпус',
+    'стр': 'строение',
+    'кв': 'квартира',
+}
+
+
+def fetch_coordinates(apikey, address, geocoder_url=YANDEX_GEOCODER_URL, policy=None):
+    def send(timeout, deadline):
+        started_at = time.perf_counter()
+        try:
+            response = requests.get(geocoder_url, params={
+                "geocode": address,
+                "apikey": apikey,
+                "format": "json",
+            }, timeout=timeout, stream=True)
+            read_content(response, deadline)
+        except requests.RequestException:
+            observe_upstream('yandex', 'GET /1.x', 'error', started_at)
+            raise
+        observe_upstream('yandex', 'GET /1.x', response.status_code, started_at)
+        return response
 
-def fetch_coordinates(apikey, address):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(base_url, params={
-        "geocode": address,
-        "apikey": apikey,
-        "format": "json",
-    })
+    if policy:
+        response = policy.call('GET', '/1.x', send)
+    else:
+        response = send((CONNECT_TIMEOUT, GEOCODER_DEADLINE), time.monotonic() + GEOCODER_DEADLINE)
     response.raise_for_status()
-    found_places = response.json()['response']['GeoObjectCollection']['featureMember']
+
+    return parse_coordinates(response.json())
+
+
+def parse_coordinates(geocoder_response):
+    found_places = geocoder_response['response']['GeoObjectCollection']['featureMember']
 
     if not found_places:
         return None
@@ -20,17 +76,184 @@ def fetch_coordinates(apikey, address):
     return lat, lon
 
 
+def normalize_address(address):
+    address = address.lower().replace('ё', 'е')
+    words = re.findall(r'\w+(?:-\w+)*', address)
+    return ' '.join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words)
+
+
+class GeocodingCache:
+    """
+    Caches geocoder results by a normalized address: hot addresses are kept in an in-process LRU,
+    the rest in redis. "Not found" results are cached too, but for a shorter time.
+    Geocoder calls go through the deadline, retries and circuit breaker of `policy`.
+    """
+
+    key_prefix = 'geocode:'
+
+    def __init__(self, redis_base, apikey, ttl=30 * 24 * 3600, negative_ttl=3600, lru_size=1024,
+                 geocoder_url=YANDEX_GEOCODER_URL, policy=None):
+        self.redis_base = redis_base
+        self.apikey = apikey
+        self.geocoder_url = geocoder_url
+        self.policy = policy or CallPolicy('yandex', default_deadline=GEOCODER_DEADLINE)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lru_size = lru_size
+        self.hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_local(self, key):
+        with self._lock:
+            cached = self._lru.get(key)
+            if cached is None:
+                return None
+            expires_at, coordinates = cached
+            if expires_at < time.monotonic():
+                del self._lru[key]
+                return None
+            self._lru.move_to_end(key)
+            return cached
+
+    def _set_local(self, key, coordinates, ttl):
+        with self._lock:
+            self._lru[key] = time.monotonic() + ttl, coordinates
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def lookup(self, address):
+        """Returns (True, coordinates) for a cached address and (False, None) otherwise"""
+        key = normalize_address(address)
+        if not key:
+            return True, None
+
+        cached = self._get_local(key)
+        if cached:
+            self.hits += 1
+            return True, cached[1]
+
+        redis_key = f'{self.key_prefix}{key}'
+        stored = self.redis_base.get(redis_key)
+        if stored is not None:
+            self.hits += 1
+            coordinates = json.loads(stored)
+            coordinates = tuple(coordinates) if coordinates else None
+            ttl = self.redis_base.ttl(redis_key)
+            self._set_local(key, coordinates, ttl if ttl > 0 else self.negative_ttl)
+            return True, coordinates
+
+        self.misses += 1
+        return False, None
+
+    def remember(self, address, coordinates):
+        key = normalize_address(address)
+        ttl = self.ttl if coordinates else self.negative_ttl
+        self.redis_base.set(f'{self.key_prefix}{key}', json.dumps(coordinates), ex=ttl)
+        self._set_local(key, coordinates, ttl)
+
+    def fetch_coordinates(self, address):
+        found, coordinates = self.lookup(address)
+        if not found:
+            coordinates = fetch_coordinates(self.apikey, address, self.geocoder_url, self.policy)
+            self.remember(address, coordinates)
+        return coordinates
+
+
 def get_distance(pizzeria):
     return pizzeria['distance']
 
 
 def show_nearest_pizzeria(pizzerias, user_location):
-
-    for pizzeria in pizzerias:
-        distance = dist(
-            pizzeria['coordinates'], user_location,
-        ).km
-        pizzeria['distance'] = distance
-    nearest_pizzeria = min(pizzerias, key=get_distance)
+    pizzerias_with_distance = [
+        dict(pizzeria, distance=dist(pizzeria['coordinates'], user_location).km)
+        for pizzeria in pizzerias
+    ]
+    nearest_pizzeria = min(pizzerias_with_distance, key=get_distance)
 
     return nearest_pizzeria
+
+
+class PizzeriaIndex:
+    """
+    Nearest pizzeria lookup. Coordinates are kept in arrays sorted by latitude, so a query
+    sweeps only a latitude band around the user, prefilters sites by the haversine distance
+    and confirms the few candidates left with an exact geodesic distance.
+    """
+
+    def __init__(self, pizzerias):
+        pizzerias = list(pizzerias)
+        positions = sorted(range(len(pizzerias)), key=lambda position: float(pizzerias[position]['coordinates'][0]))
+        pizzerias = [pizzerias[position] for position in positions]
+        self.pizzerias = tuple(pizzerias)
+        self._positions = array('l', positions)
+        self._latitudes = array('d', (radians(float(pizzeria['coordinates'][0])) for pizzeria in pizzerias))
+        self._longitudes = array('d', (radians(float(pizzeria['coordinates'][1])) for pizzeria in pizzerias))
+        self._latitudes_cos = array('d', (cos(latitude) for latitude in self._latitudes))
+
+    def __len__(self):
+        return len(self.pizzerias)
+
+    def _haversine(self, index, latitude, longitude, latitude_cos):
+        half_dlat = (self._latitudes[index] - latitude) / 2
+        half_dlon = (self._longitudes[index] - longitude) / 2
+        a = sin(half_dlat) ** 2 + latitude_cos * self._latitudes_cos[index] * sin(half_dlon) ** 2
+        return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(a)))
+
+    def _find_candidates(self, latitude, longitude, k):
+        latitude_cos = cos(latitude)
+        candidates = []
+        nearest_heap = []
+        upper_bound = float('inf')
+
+        lower = bisect_left(self._latitudes, latitude) - 1
+        upper = lower + 1
+        while lower >= 0 or upper < len(self._latitudes):
+            lower_gap = latitude - self._latitudes[lower] if lower >= 0 else float('inf')
+            upper_gap = self._latitudes[upper] - latitude if upper < len(self._latitudes) else float('inf')
+            if lower_gap <= upper_gap:
+                index, gap = lower, lower_gap
+                lower -= 1
+            else:
+                index, gap = upper, upper_gap
+                upper += 1
+
+            if EARTH_RADIUS_KM * gap * (1 - SPHERE_ERROR) > upper_bound:
+                break
+
+            distance = self._haversine(index, latitude, longitude, latitude_cos)
+            if distance * (1 - SPHERE_ERROR) > upper_bound:
+                continue
+            candidates.append((distance, index))
+
+            if len(nearest_heap) < k:
+                heappush(nearest_heap, -distance)
+            else:
+                heappushpop(nearest_heap, -distance)
+            if len(nearest_heap) == k:
+                upper_bound = -nearest_heap[0] * (1 + SPHERE_ERROR)
+
+        return [index for distance, index in candidates if distance * (1 - SPHERE_ERROR) <= upper_bound]
+
+    def nearest_k(self, user_location, k):
+        if not self.pizzerias:
+            return []
+        latitude, longitude = (radians(float(coordinate)) for coordinate in user_location)
+
+        candidates = self._find_candidates(latitude, longitude, k)
+        pizzerias = sorted(
+            (dist(self.pizzerias[index]['coordinates'], user_location).km, self._positions[index], index)
+            for index in candidates
+        )
+        return [
+            dict(self.pizzerias[index], distance=distance)
+            for distance, _, index in pizzerias[:k]
+        ]
+
+    def nearest(self, user_location):
+        nearest_pizzerias = self.nearest_k(user_location, 1)
+        if not nearest_pizzerias:
+            return None
+        return nearest_pizzerias[0]
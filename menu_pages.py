@@ -0,0 +1,51 @@
+import threading
+
+from more_itertools import chunked
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from bot_tools import build_menu
+
+
+class MenuPages:
+    """
+    Splits the catalog into pages and builds their keyboards once per catalog version.
+    The keyboards are shared by all users, a user session keeps only the page index.
+    """
+
+    text = 'Смотри, какая пицца!'
+
+    def __init__(self, catalog, page_size=3):
+        self.catalog = catalog
+        self.page_size = page_size
+        self._pages = []
+        self._pages_version = None
+        self._lock = threading.Lock()
+        self.footer_buttons = [
+            [InlineKeyboardButton('Назад', callback_data='Назад')],
+            [InlineKeyboardButton('Вперед', callback_data='Вперед')],
+            [InlineKeyboardButton('Корзина', callback_data='Корзина')],
+        ]
+
+    def _build_page(self, products_pack):
+        keyboard = build_menu(
+            [InlineKeyboardButton(product.get('name'),
+                                  callback_data=product.get('id')) for product in products_pack],
+            n_cols=3,
+            footer_buttons=self.footer_buttons,
+        )
+        return InlineKeyboardMarkup(keyboard)
+
+    def _get_pages(self):
+        products = self.catalog.get_all_products()
+        with self._lock:
+            if self._pages_version != self.catalog.version or not self._pages:
+                self._pages = [self._build_page(products_pack)
+                               for products_pack in chunked(products, self.page_size)] or [self._build_page([])]
+                self._pages_version = self.catalog.version
+            return self._pages
+
+    def get_page(self, page_index):
+        """Returns the page index clamped to the current catalog and the keyboard of the page"""
+        pages = self._get_pages()
+        page_index = max(0, min(page_index, len(pages) - 1))
+        return page_index, pages[page_index]
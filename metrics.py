@@ -0,0 +1,197 @@
+import re
+import threading
+import time
+from functools import wraps
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from resilience import BREAKER_STATES
+
+HANDLER_SECONDS = Histogram(
+    'bot_handler_seconds',
+    'Time spent in conversation handlers',
+    ['state', 'handler'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors',
+    'Conversation handlers that raised an exception',
+    ['state', 'handler'],
+)
+UPSTREAM_SECONDS = Histogram(
+    'bot_upstream_request_seconds',
+    'Time of requests to Moltin, the Yandex geocoder and Telegram',
+    ['service', 'endpoint', 'status'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+SESSION_BYTES = Histogram(
+    'bot_session_bytes',
+    'Size of user sessions written to redis',
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096),
+)
+CMS_FLUSH_LAG_SECONDS = Histogram(
+    'bot_cms_flush_lag_seconds',
+    'Time from buffering a CMS entry to creating it in Moltin',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900),
+)
+
+# ids in request paths are replaced so that every endpoint is a single label value
+PATH_ID = re.compile(r'/(?:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+)(?=/|$)')
+
+
+def get_endpoint(method, path):
+    return f'{method} {PATH_ID.sub("/:id", path)}'
+
+
+def observe_upstream(service, endpoint, status, started_at):
+    UPSTREAM_SECONDS.labels(service, endpoint, str(status)).observe(time.perf_counter() - started_at)
+
+
+class BotMetrics:
+    """
+    Prometheus collector of the bot. Conversation handlers are timed by state and name,
+    queue depths, worker utilization, cache hit ratios and circuit breaker states are read
+    from the services in bot_data when Prometheus scrapes /metrics.
+    """
+
+    def __init__(self, dispatcher, registry=REGISTRY):
+        self.dispatcher = dispatcher
+        self.registry = registry
+        self.handlers_in_progress = 0
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def instrument_handler(self, state, callback):
+        handler_seconds = HANDLER_SECONDS.labels(state, callback.__name__)
+        handler_errors = HANDLER_ERRORS.labels(state, callback.__name__)
+
+        @wraps(callback)
+        def instrumented(update, context):
+            with self._lock:
+                self.handlers_in_progress += 1
+            started_at = time.perf_counter()
+            try:
+                return callback(update, context)
+            except Exception:
+                handler_errors.inc()
+                raise
+            finally:
+                handler_seconds.observe(time.perf_counter() - started_at)
+                with self._lock:
+                    self.handlers_in_progress -= 1
+
+        return instrumented
+
+    def instrument_conversation(self, conversation):
+        handler_groups = [('ENTRY', conversation.entry_points), ('FALLBACK', conversation.fallbacks)]
+        handler_groups += [(state.name, handlers) for state, handlers in conversation.states.items()]
+        for state, handlers in handler_groups:
+            for handler in handlers:
+                handler.callback = self.instrument_handler(state, handler.callback)
+        return conversation
+
+    def serve(self, headers, body):
+        return 200, {'Content-Type': CONTENT_TYPE_LATEST}, generate_latest(self.registry)
+
+    def collect(self):
+        bot_data = self.dispatcher.bot_data
+        workers = self.dispatcher.workers
+
+        yield GaugeMetricFamily('bot_update_queue_depth', 'Updates waiting for the dispatcher',
+                                value=self.dispatcher.update_queue.qsize())
+        yield GaugeMetricFamily('bot_handlers_in_progress', 'Conversation handlers running now',
+                                value=self.handlers_in_progress)
+        yield GaugeMetricFamily('bot_worker_utilization', 'Share of dispatcher workers busy with handlers',
+                                value=self.handlers_in_progress / workers if workers else 0.0)
+
+        hits = CounterMetricFamily('bot_cache_hits', 'Cache lookups answered from the cache', labels=['cache'])
+        misses = CounterMetricFamily('bot_cache_misses', 'Cache lookups that went upstream', labels=['cache'])
+        hit_ratio = GaugeMetricFamily('bot_cache_hit_ratio', 'Share of cache lookups answered from the cache',
+                                      labels=['cache'])
+        for name in ('catalog', 'geocoder'):
+            cache = bot_data.get(name)
+            if cache is None:
+                continue
+            lookups = cache.hits + cache.misses
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+            hit_ratio.add_metric([name], cache.hits / lookups if lookups else 0.0)
+        yield hits
+        yield misses
+        yield hit_ratio
+
+        send_scheduler = bot_data.get('send_scheduler')
+        if send_scheduler:
+            depth = GaugeMetricFamily('bot_send_queue_depth', 'Telegram calls waiting to be sent',
+                                      labels=['priority'])
+            wait = GaugeMetricFamily('bot_send_queue_average_wait_seconds',
+                                     'Average time Telegram calls waited in the send queue', labels=['priority'])
+            for priority, priority_stats in send_scheduler.stats().items():
+                if not isinstance(priority_stats, dict):
+                    continue
+                depth.add_metric([priority], priority_stats['queue_depth'])
+                wait.add_metric([priority], priority_stats['average_wait'])
+            yield depth
+            yield wait
+
+        breaker_state = GaugeMetricFamily('bot_circuit_breaker_state',
+                                          'Current state of the circuit breaker of a service',
+                                          labels=['service', 'state'])
+        breaker_rejected = CounterMetricFamily('bot_circuit_breaker_rejected',
+                                               'Calls failed at once by an open circuit breaker',
+                                               labels=['service'])
+        for name in ('moltin', 'geocoder'):
+            client = bot_data.get(name)
+            if client is None:
+                continue
+            breaker = client.policy.breaker
+            for state in BREAKER_STATES:
+                breaker_state.add_metric([breaker.name, state], 1 if breaker.state == state else 0)
+            breaker_rejected.add_metric([breaker.name], breaker.rejected)
+        yield breaker_state
+        yield breaker_rejected
+
+        cart_queue = bot_data.get('cart_queue')
+        if cart_queue:
+            yield CounterMetricFamily('bot_cart_taps', '"Add to cart" taps', value=cart_queue.taps)
+            yield CounterMetricFamily('bot_cart_writes', 'Cart writes sent to Moltin', value=cart_queue.requests)
+        cms_buffer = bot_data.get('cms_buffer')
+        if cms_buffer:
+            cms_stats = cms_buffer.stats()
+            yield GaugeMetricFamily('bot_cms_buffer_pending', 'CMS entries waiting to be written to Moltin',
+                                    value=cms_stats['pending'])
+            yield GaugeMetricFamily('bot_cms_buffer_oldest_age_seconds', 'Age of the oldest unwritten CMS entry',
+                                    value=cms_stats['oldest_age'])
+            yield CounterMetricFamily('bot_cms_entries_written', 'CMS entries written to Moltin',
+                                      value=cms_stats['written'])
+            yield CounterMetricFamily('bot_cms_entry_failures', 'Failed attempts to write a CMS entry',
+                                      value=cms_stats['failures'])
+            yield CounterMetricFamily('bot_cms_entries_dead', 'CMS entries rejected by Moltin',
+                                      value=cms_stats['dead'])
+        delayed_jobs = bot_data.get('delayed_jobs')
+        if delayed_jobs:
+            jobs_stats = delayed_jobs.stats()
+            yield GaugeMetricFamily('bot_delayed_jobs_waiting', 'Delayed jobs waiting for their time',
+                                    value=jobs_stats['waiting'])
+            yield GaugeMetricFamily('bot_delayed_jobs_running', 'Delayed jobs claimed by workers',
+                                    value=jobs_stats['running'])
+            yield GaugeMetricFamily('bot_delayed_jobs_overdue_seconds', 'How late the most overdue delayed job is',
+                                    value=jobs_stats['overdue'])
+            yield GaugeMetricFamily('bot_delayed_jobs_dead', 'Delayed jobs moved to dead letters',
+                                    value=jobs_stats['dead'])
+        persistence = self.dispatcher.persistence
+        if persistence and hasattr(persistence, 'stats'):
+            session_stats = persistence.stats()
+            yield GaugeMetricFamily('bot_sessions', 'User sessions held by this process',
+                                    value=session_stats['sessions'])
+            yield GaugeMetricFamily('bot_session_average_bytes', 'Average size of the sessions held by this process',
+                                    value=session_stats['average_session_bytes'])
+            yield CounterMetricFamily('bot_session_writes', 'User sessions written to redis',
+                                      value=session_stats['session_writes'])
+            yield CounterMetricFamily('bot_session_skipped_writes', 'Unchanged user sessions not written to redis',
+                                      value=session_stats['skipped_writes'])
+        cart_mirror = bot_data.get('cart_mirror')
+        if cart_mirror:
+            yield CounterMetricFamily('bot_cart_mirror_reloads', 'Carts reloaded from Moltin',
+                                      value=cart_mirror.reloads)
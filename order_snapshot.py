@@ -0,0 +1,59 @@
+import base64
+import hashlib
+import hmac
+from collections import namedtuple
+
+# Telegram limits the invoice payload to 128 bytes
+MAX_PAYLOAD_BYTES = 128
+SIGNATURE_BYTES = 12
+ITEMS_HASH_BYTES = 8
+
+OrderSnapshot = namedtuple('OrderSnapshot', ['cart_id', 'items_hash', 'total', 'delivery_fee'])
+
+
+class InvalidSnapshot(ValueError):
+    pass
+
+
+def encode_bytes(raw_bytes):
+    return base64.urlsafe_b64encode(raw_bytes).rstrip(b'=').decode()
+
+
+def get_items_hash(items):
+    """Short hash of the products and quantities of cart items, it doesn't depend on their order"""
+    lines = sorted(f'{item["product_id"]}*{item["quantity"]}' for item in items)
+    return encode_bytes(hashlib.blake2b('|'.join(lines).encode(), digest_size=ITEMS_HASH_BYTES).digest())
+
+
+class OrderSigner:
+    """
+    Puts the order into the invoice payload as `cart_id:items_hash:total:fee:signature`.
+    The signature is an HMAC of the snapshot and the customer id, so pre-checkout checks
+    the order without Moltin and a payload can't be forged or paid by another customer.
+    """
+
+    def __init__(self, secret):
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+
+    def _sign(self, user_id, snapshot):
+        message = f'{user_id}:{snapshot}'.encode()
+        return encode_bytes(hmac.new(self.secret, message, hashlib.sha256).digest()[:SIGNATURE_BYTES])
+
+    def sign(self, user_id, cart_id, items, total, delivery_fee):
+        snapshot = f'{cart_id}:{get_items_hash(items)}:{int(total)}:{int(delivery_fee)}'
+        payload = f'{snapshot}:{self._sign(user_id, snapshot)}'
+        if len(payload.encode()) > MAX_PAYLOAD_BYTES:
+            raise ValueError(f'Invoice payload of cart {cart_id} is longer than {MAX_PAYLOAD_BYTES} bytes')
+        return payload
+
+    def verify(self, user_id, payload):
+        """Returns OrderSnapshot of a payload signed for the customer, raises InvalidSnapshot otherwise"""
+        snapshot, _, signature = payload.rpartition(':')
+        if not snapshot or not hmac.compare_digest(signature, self._sign(user_id, snapshot)):
+            raise InvalidSnapshot('Invoice payload signature is invalid')
+        # a payload signed with the same key by another version of the bot may have another layout
+        try:
+            cart_id, items_hash, total, delivery_fee = snapshot.rsplit(':', 3)
+            return OrderSnapshot(cart_id, items_hash, int(total), int(delivery_fee))
+        except ValueError:
+            raise InvalidSnapshot('Invoice payload is malformed')
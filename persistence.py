@@ -0,0 +1,195 @@
+import json
+import threading
+from collections import defaultdict
+from enum import Enum
+from functools import partial
+
+from telegram.ext import BasePersistence, ConversationHandler
+from telegram.ext.utils.promise import Promise
+
+from metrics import SESSION_BYTES
+
+SESSION_KEYS = {
+    'menu_page': 'p',
+    'cart_id': 'c',
+    'product_id': 'i',
+    'order_price': 'o',
+    'email': 'e',
+    'coordinates': 'g',
+    'nearest_pizzeria': 'n',
+    'delivery_price': 'f',
+    'delivery_type': 't',
+}
+SESSION_FIELDS = {short_key: key for key, short_key in SESSION_KEYS.items()}
+
+
+def encode_session(user_data):
+    session = {SESSION_KEYS.get(key, key): value for key, value in user_data.items() if value is not None}
+    return json.dumps(session, ensure_ascii=False, separators=(',', ':'))
+
+
+def decode_session(encoded_session):
+    session = json.loads(encoded_session)
+    return {SESSION_FIELDS.get(short_key, short_key): value for short_key, value in session.items()}
+
+
+def is_pending(state):
+    return isinstance(state, tuple) and len(state) == 2 and isinstance(state[1], Promise)
+
+
+class RedisConversations(dict):
+    """
+    Conversation states of one ConversationHandler. `get` re-reads the state of the key from redis,
+    so an update sees the state written by any replica. A state of a handler still running in
+    this process is kept as it is.
+    """
+
+    def __init__(self, persistence, name, conversations):
+        super().__init__(conversations)
+        self.persistence = persistence
+        self.name = name
+
+    def get(self, key, default=None):
+        state = super().get(key)
+        if not is_pending(state):
+            state = self.persistence.refresh_conversation(self.name, key)
+            if state is None:
+                self.pop(key, None)
+            else:
+                self[key] = state
+        return default if state is None else state
+
+
+class RedisPersistence(BasePersistence):
+    """
+    Keeps conversation states and user_data in redis. A user session is stored as compact json
+    with one-letter keys and is written only when it has changed since the last write.
+    Conversation states and sessions are read from redis before every update of the user, so
+    replicas share them and a process keeps only the sessions of users it has served.
+    """
+
+    def __init__(self, redis_base, states, prefix='bot'):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.redis_base = redis_base
+        self.states = states
+        self.sessions_key = f'{prefix}:sessions'
+        self.conversations_prefix = f'{prefix}:conversations:'
+        self.session_writes = 0
+        self.skipped_writes = 0
+        self._written_sessions = {}
+        self._conversations = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get_user_data(self):
+        # sessions are loaded by refresh_user_data on the first update of every user
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        # states are loaded by RedisConversations.get when an update of the conversation comes
+        self._conversations[name] = {}
+        return RedisConversations(self, name, {})
+
+    def _encode_state(self, state):
+        if isinstance(state, Enum):
+            return state.name
+        return json.dumps(state)
+
+    def _decode_state(self, state):
+        if state in self.states.__members__:
+            return self.states[state]
+        return json.loads(state)
+
+    def refresh_conversation(self, name, key):
+        state = self.redis_base.hget(f'{self.conversations_prefix}{name}', json.dumps(key))
+        state = None if state is None else self._decode_state(state)
+        with self._lock:
+            conversations = self._conversations.setdefault(name, {})
+            if state is None:
+                conversations.pop(key, None)
+            else:
+                conversations[key] = state
+        return state
+
+    def update_conversation(self, name, key, new_state):
+        if is_pending(new_state):
+            promise = new_state[1]
+            while is_pending(new_state):
+                # ConversationHandler passes the state before the handler wrapped twice
+                new_state = new_state[0]
+            with self._lock:
+                self._pending[(name, key)] = promise
+            promise.add_done_callback(partial(self._resolve_conversation, name, key, promise))
+        self._write_conversation(name, key, new_state)
+
+    def _resolve_conversation(self, name, key, promise, new_state):
+        """Stores the state returned by a handler run with run_async as soon as it finishes"""
+        with self._lock:
+            if self._pending.get((name, key)) is not promise:
+                # a newer update of the conversation has been handled already
+                return
+            del self._pending[(name, key)]
+        if new_state is None:
+            return
+        self._write_conversation(name, key, None if new_state == ConversationHandler.END else new_state)
+
+    def _write_conversation(self, name, key, new_state):
+        with self._lock:
+            conversations = self._conversations.setdefault(name, {})
+            if conversations.get(key) == new_state:
+                return
+            if new_state is None:
+                conversations.pop(key, None)
+            else:
+                conversations[key] = new_state
+        redis_key = f'{self.conversations_prefix}{name}'
+        encoded_key = json.dumps(key)
+        if new_state is None:
+            self.redis_base.hdel(redis_key, encoded_key)
+        else:
+            self.redis_base.hset(redis_key, encoded_key, self._encode_state(new_state))
+
+    def refresh_user_data(self, user_id, user_data):
+        """Replaces user_data with the session written by another replica since this one read or wrote it"""
+        encoded_session = self.redis_base.hget(self.sessions_key, user_id)
+        with self._lock:
+            if encoded_session is None or self._written_sessions.get(user_id) == encoded_session:
+                return
+            self._written_sessions[user_id] = encoded_session
+        user_data.clear()
+        user_data.update(decode_session(encoded_session))
+
+    def update_user_data(self, user_id, data):
+        encoded_session = encode_session(data)
+        with self._lock:
+            if self._written_sessions.get(user_id) == encoded_session:
+                self.skipped_writes += 1
+                return
+            self._written_sessions[user_id] = encoded_session
+            self.session_writes += 1
+        SESSION_BYTES.observe(len(encoded_session.encode()))
+        self.redis_base.hset(self.sessions_key, user_id, encoded_session)
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def session_size(self, user_id):
+        return len(self._written_sessions.get(user_id, '').encode())
+
+    def stats(self):
+        sizes = [len(encoded_session.encode()) for encoded_session in self._written_sessions.values()]
+        return {
+            'sessions': len(sizes),
+            'session_writes': self.session_writes,
+            'skipped_writes': self.skipped_writes,
+            'average_session_bytes': sum(sizes) / len(sizes) if sizes else 0,
+        }
@@ -0,0 +1,70 @@
+import threading
+from collections import namedtuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from bot_tools import format_product_description
+
+ProductCard = namedtuple('ProductCard', ['photo', 'caption', 'reply_markup'])
+
+
+class ProductCardStore:
+    """
+    Builds captions and keyboards of product cards once per catalog version and remembers
+    file_id of the photos sent to Telegram, so a photo is uploaded from Moltin only once.
+    File ids are kept in redis to be shared between bot replicas and survive restarts.
+    """
+
+    file_ids_key = 'product_photo_file_ids'
+
+    def __init__(self, catalog, redis_base):
+        self.catalog = catalog
+        self.redis_base = redis_base
+        self._cards = {}
+        self._cards_version = None
+        self._file_ids = {}
+        self._lock = threading.Lock()
+        self.reply_markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton('В меню', callback_data='В меню'),
+            InlineKeyboardButton('Добавить в корзину', callback_data='Добавить в корзину'),
+            InlineKeyboardButton('Корзина', callback_data='Корзина')
+        ]])
+
+    def _build_cards(self):
+        return {
+            product['id']: format_product_description({'data': product})
+            for product in self.catalog.get_all_products()
+        }
+
+    def _get_file_id(self, image_link):
+        file_id = self._file_ids.get(image_link)
+        if file_id is None:
+            file_id = self.redis_base.hget(self.file_ids_key, image_link)
+            if file_id:
+                self._file_ids[image_link] = file_id
+        return file_id
+
+    def get_card(self, product_id):
+        with self._lock:
+            if self._cards_version != self.catalog.version or not self._cards:
+                self._cards = self._build_cards()
+                self._cards_version = self.catalog.version
+            caption = self._cards.get(product_id)
+
+        if caption is None:
+            caption = format_product_description(self.catalog.get_product_info(product_id))
+
+        image_link = self.catalog.get_image_link(product_id)
+        photo = self._get_file_id(image_link) or image_link
+
+        return ProductCard(photo, caption, self.reply_markup)
+
+    def remember_file_id(self, product_id, message):
+        if not message or not message.photo:
+            return
+        image_link = self.catalog.get_image_link(product_id)
+        if self._file_ids.get(image_link):
+            return
+        file_id = message.photo[-1].file_id
+        self._file_ids[image_link] = file_id
+        self.redis_base.hset(self.file_ids_key, image_link, file_id)
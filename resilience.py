@@ -0,0 +1,267 @@
+import heapq
+import itertools
+import logging
+import random
+import socket
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+BREAKER_STATES = (CLOSED, HALF_OPEN, OPEN)
+
+# seconds a whole call may take, retries included, by path prefix
+MOLTIN_DEADLINES = {
+    '/oauth/access_token': 10,
+    '/v2/carts': 4,
+    '/v2/products': 8,
+    '/v2/files': 8,
+    '/v2/flows': 10,
+}
+MOLTIN_DEADLINE = 8
+GEOCODER_DEADLINE = 5
+CONNECT_TIMEOUT = 3.05
+
+RETRIABLE_STATUSES = {429, 500, 502, 503, 504}
+UPSTREAM_ERRORS = (requests.RequestException,)
+# errors of a call the service didn't complete
+SERVICE_FAILURES = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of calling a service while its circuit breaker is open"""
+
+
+class Watchdog:
+    """
+    One thread for the deadlines of all calls: runs a callback when its deadline comes unless
+    it was cancelled before. Callbacks run under the lock, so nothing runs after `cancel` returns.
+    """
+
+    def __init__(self):
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, deadline, callback):
+        """Runs `callback` at the `time.monotonic()` deadline, returns the handle for `cancel`"""
+        handle = [deadline, next(self._sequence), callback]
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='deadline-watchdog', daemon=True)
+                self._thread.start()
+            heapq.heappush(self._deadlines, handle)
+            if self._deadlines[0] is handle:
+                self._condition.notify()
+        return handle
+
+    def cancel(self, handle):
+        with self._condition:
+            handle[2] = None
+
+    def _run(self):
+        with self._condition:
+            while True:
+                while self._deadlines and self._deadlines[0][2] is None:
+                    heapq.heappop(self._deadlines)
+                if not self._deadlines:
+                    self._condition.wait()
+                    continue
+                time_left = self._deadlines[0][0] - time.monotonic()
+                if time_left > 0:
+                    self._condition.wait(time_left)
+                    continue
+                _, _, callback = heapq.heappop(self._deadlines)
+                try:
+                    callback()
+                except Exception:
+                    logger.exception('Deadline callback failed')
+
+
+watchdog = Watchdog()
+
+
+def read_content(response, deadline):
+    """
+    Reads the body of a response requested with `stream=True` by the `time.monotonic()` deadline.
+    The read timeout of requests limits every socket read rather than the whole body, so a body
+    still being read at the deadline is cut off by the watchdog shutting the socket down.
+    """
+    connection = getattr(response.raw, '_connection', None)
+    original_response = getattr(response.raw, '_original_response', None)
+    try:
+        # the socket the body is read from, of a keep-alive and of a closing connection alike
+        sock = original_response.fp.raw._sock
+    except AttributeError:
+        sock = None
+    expired = threading.Event()
+
+    def expire():
+        # a fully read connection is back in the pool and may already serve another call
+        if response.raw._connection is not connection or original_response.isclosed():
+            return
+        expired.set()
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    handle = None
+    if sock:
+        handle = watchdog.schedule(deadline, expire)
+    elif original_response is not None and not original_response.isclosed():
+        logger.warning('Socket of %s is not found, its body is read without the deadline', response.url)
+    try:
+        response.content
+    except Exception:
+        if not expired.is_set():
+            response.close()
+            raise
+    finally:
+        if handle:
+            watchdog.cancel(handle)
+    if expired.is_set():
+        response.close()
+        raise requests.ReadTimeout(f'{response.url} was not read before the deadline', response=response)
+    return response
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` failed calls in a row, then calls fail at once without touching
+    the service. In `reset_timeout` seconds one probe call is let through: its success closes
+    the breaker, its failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f'{self.name} is unavailable, circuit breaker is open')
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.warning('%s circuit breaker is closed', self.name)
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_ignored(self):
+        """Ends a call that failed for reasons of its own, the next call may probe the service"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.warning('%s circuit breaker is open after %s failures', self.name, self.failures)
+                    self.opened += 1
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def stats(self):
+        return {'state': self.state, 'failures': self.failures, 'opened': self.opened, 'rejected': self.rejected}
+
+
+class CallPolicy:
+    """
+    Deadline, retries and circuit breaker of the calls to one service. A call may take at most
+    the deadline of its path, idempotent GETs are retried with jittered exponential backoff
+    while the deadline allows. Connection errors, timeouts and 429/5xx answers count as failures
+    of the service, any other answer as a success. Other errors raised by the call count as neither.
+    """
+
+    def __init__(self, name, deadlines=None, default_deadline=MOLTIN_DEADLINE, attempts=3, backoff=0.2,
+                 max_backoff=2, breaker=None):
+        self.name = name
+        self.deadlines = sorted((deadlines or {}).items(), key=lambda item: len(item[0]), reverse=True)
+        self.default_deadline = default_deadline
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker(name)
+
+    def get_deadline(self, path):
+        for prefix, deadline in self.deadlines:
+            if path.startswith(prefix):
+                return deadline
+        return self.default_deadline
+
+    def _get_delay(self, attempt):
+        return min(self.max_backoff, self.backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+    def start(self, path):
+        """Returns the `time.monotonic()` deadline of a call to `path` starting now"""
+        return time.monotonic() + self.get_deadline(path)
+
+    def _next_delay(self, attempt, attempts, deadline):
+        """Returns the pause before the next attempt or None when there is no time or attempts left"""
+        if attempt == attempts:
+            return None
+        delay = self._get_delay(attempt)
+        if time.monotonic() + delay + CONNECT_TIMEOUT >= deadline:
+            return None
+        return delay
+
+    def call(self, method, path, send, deadline=None):
+        """
+        Calls `send(timeout, deadline)` returning a requests response read with `read_content`
+        by the deadline, retries it if the policy allows. A call made of several requests
+        passes the deadline from `start` to all of them.
+        """
+        attempts = self.attempts if method == 'GET' else 1
+        deadline = deadline or self.start(path)
+        for attempt in range(1, attempts + 1):
+            time_left = deadline - time.monotonic()
+            if time_left <= 0:
+                raise requests.Timeout(f'{self.name} {method} {path} is past its deadline')
+            self.breaker.before_call()
+            timeout = (min(CONNECT_TIMEOUT, time_left), time_left)
+            try:
+                response = send(timeout, deadline)
+            except SERVICE_FAILURES:
+                self.breaker.record_failure()
+                delay = self._next_delay(attempt, attempts, deadline)
+                if delay is None:
+                    raise
+            except Exception:
+                self.breaker.record_ignored()
+                raise
+            else:
+                if response.status_code not in RETRIABLE_STATUSES:
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+                delay = self._next_delay(attempt, attempts, deadline)
+                if delay is None:
+                    return response
+            time.sleep(delay)
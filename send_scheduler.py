@@ -0,0 +1,224 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram.error import RetryAfter
+
+from bulk_import import RateLimiter
+from metrics import observe_upstream
+
+logger = logging.getLogger(__name__)
+
+URGENT = 0
+NORMAL = 1
+COSMETIC = 2
+PRIORITY_NAMES = {URGENT: 'urgent', NORMAL: 'normal', COSMETIC: 'cosmetic'}
+
+SendRequest = namedtuple('SendRequest', ['priority', 'seq', 'chat_id', 'method', 'kwargs', 'future', 'queued_at'])
+
+
+class SendScheduler:
+    """
+    Sends everything the bot says to Telegram through one scheduler.
+    Calls are let through by token buckets: `global_rate` per second for the whole bot and
+    `chat_rate` per second (with bursts up to `chat_burst`) for each chat, one call to a chat
+    at a time. Urgent calls (invoices, couriers) go before normal answers and those go before
+    menu cosmetics, both within a chat and between chats; calls of the same priority to one chat
+    are sent in the order they were queued. A chat held by its own limiter waits aside, so it costs
+    nothing to the others, but an urgent call is not held by the limiter of its chat. When Telegram answers with retry_after, sending is paused
+    for that time and the call is queued again. Handlers don't wait for sending unless they need
+    the result.
+    """
+
+    def __init__(self, bot, global_rate=30, chat_rate=1, chat_burst=5, workers=8, chat_idle_ttl=60):
+        self.bot = bot
+        self.global_limiter = RateLimiter(global_rate, burst=1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_idle_ttl = chat_idle_ttl
+        self.sent = Counter()
+        self.failed = Counter()
+        self.retried = 0
+        self.dispatched = Counter()
+        self.wait_total = Counter()
+        self.wait_max = Counter()
+        self._chat_queues = {}
+        self._queued = 0
+        self._ready = []
+        self._ready_keys = {}
+        self._waiting = []
+        self._waiting_chats = set()
+        self._seq = itertools.count()
+        self._chat_limiters = {}
+        self._chat_last_used = {}
+        self._in_flight = set()
+        self._paused_until = 0
+        self._running = False
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='send-scheduler')
+        self._thread = threading.Thread(target=self._run, name='send-scheduler', daemon=True)
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+        return self
+
+    def join(self, timeout=None):
+        """Waits until everything queued has been sent, returns False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._queued and not self._in_flight, timeout)
+
+    def stop(self, timeout=10):
+        self.join(timeout)
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        self._executor.shutdown()
+
+    def submit(self, method, priority=NORMAL, **kwargs):
+        """Queues a call of a Bot method, e.g. submit('send_message', chat_id=1, text='...')"""
+        future = Future()
+        request = SendRequest(priority, next(self._seq), kwargs.get('chat_id'), method, kwargs, future,
+                              time.monotonic())
+        with self._condition:
+            heapq.heappush(self._chat_queues.setdefault(request.chat_id, []), request)
+            self._queued += 1
+            self._schedule_chat(request.chat_id)
+            self._condition.notify_all()
+        return future
+
+    def send(self, method, priority=NORMAL, timeout=None, **kwargs):
+        """Queues a call and waits for its result"""
+        return self.submit(method, priority=priority, **kwargs).result(timeout)
+
+    def _get_chat_limiter(self, chat_id):
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self._chat_limiters[chat_id] = RateLimiter(self.chat_rate, self.chat_burst)
+        self._chat_last_used[chat_id] = time.monotonic()
+        return limiter
+
+    def _forget_idle_chats(self):
+        idle_since = time.monotonic() - self.chat_idle_ttl
+        for chat_id, last_used in list(self._chat_last_used.items()):
+            if last_used < idle_since and chat_id not in self._in_flight and chat_id not in self._chat_queues:
+                del self._chat_last_used[chat_id]
+                del self._chat_limiters[chat_id]
+
+    def _schedule_chat(self, chat_id):
+        """Puts a chat with queued calls in the ready queue, or aside until its limiter lets it send"""
+        chat_queue = self._chat_queues.get(chat_id)
+        if not chat_queue or chat_id in self._in_flight:
+            return
+        if chat_queue[0].priority != URGENT:
+            if chat_id in self._waiting_chats:
+                return
+            chat_wait = self._get_chat_limiter(chat_id).wait_time()
+            if chat_wait:
+                self._waiting_chats.add(chat_id)
+                heapq.heappush(self._waiting, (time.monotonic() + chat_wait, chat_id))
+                return
+        key = chat_queue[0][:2]
+        if self._ready_keys.get(chat_id) != key:
+            # an outdated entry of the chat stays in the heap and is skipped when it comes up
+            self._ready_keys[chat_id] = key
+            heapq.heappush(self._ready, (*key, chat_id))
+
+    def _pick(self):
+        """Takes the most urgent call of the most urgent chat allowed to send now, otherwise returns how long to wait"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return None, self._paused_until - now
+        while self._waiting and self._waiting[0][0] <= now:
+            _, chat_id = heapq.heappop(self._waiting)
+            self._waiting_chats.discard(chat_id)
+            self._schedule_chat(chat_id)
+        while self._ready and self._ready_keys.get(self._ready[0][2]) != self._ready[0][:2]:
+            heapq.heappop(self._ready)
+        if not self._ready:
+            return None, self._waiting[0][0] - now if self._waiting else None
+        global_wait = self.global_limiter.wait_time()
+        if global_wait:
+            return None, global_wait
+
+        _, _, chat_id = heapq.heappop(self._ready)
+        del self._ready_keys[chat_id]
+        chat_queue = self._chat_queues[chat_id]
+        request = heapq.heappop(chat_queue)
+        if not chat_queue:
+            del self._chat_queues[chat_id]
+        self._queued -= 1
+
+        self.global_limiter.try_acquire()
+        self._get_chat_limiter(chat_id).try_acquire()
+        self._in_flight.add(chat_id)
+        return request, None
+
+    def _run(self):
+        forgotten_at = time.monotonic()
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                request, wait = self._pick()
+                if request is None:
+                    self._condition.wait(wait)
+                    continue
+                if time.monotonic() - forgotten_at > self.chat_idle_ttl:
+                    self._forget_idle_chats()
+                    forgotten_at = time.monotonic()
+
+            waited = time.monotonic() - request.queued_at
+            self.dispatched[request.priority] += 1
+            self.wait_total[request.priority] += waited
+            self.wait_max[request.priority] = max(self.wait_max[request.priority], waited)
+            self._executor.submit(self._send, request)
+
+    def _send(self, request):
+        started_at = time.perf_counter()
+        try:
+            result = getattr(self.bot, request.method)(**request.kwargs)
+        except RetryAfter as error:
+            observe_upstream('telegram', request.method, 429, started_at)
+            logger.warning('Telegram asked to retry after %s s', error.retry_after)
+            with self._condition:
+                self.retried += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + error.retry_after)
+                # the call keeps its priority and seq, so it goes back to its place in the chat
+                heapq.heappush(self._chat_queues.setdefault(request.chat_id, []), request)
+                self._queued += 1
+            return
+        except Exception as error:
+            observe_upstream('telegram', request.method, 'error', started_at)
+            logger.warning('%s to chat %s failed: %s', request.method, request.chat_id, error)
+            self.failed[request.priority] += 1
+            request.future.set_exception(error)
+        else:
+            observe_upstream('telegram', request.method, 200, started_at)
+            self.sent[request.priority] += 1
+            request.future.set_result(result)
+        finally:
+            with self._condition:
+                self._in_flight.discard(request.chat_id)
+                self._schedule_chat(request.chat_id)
+                self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            depth = Counter(request.priority for chat_queue in self._chat_queues.values() for request in chat_queue)
+        stats = {'retried': self.retried, 'paused': max(0.0, self._paused_until - time.monotonic())}
+        for priority, name in PRIORITY_NAMES.items():
+            dispatched = self.dispatched[priority]
+            stats[name] = {
+                'queue_depth': depth[priority],
+                'sent': self.sent[priority],
+                'failed': self.failed[priority],
+                'average_wait': self.wait_total[priority] / dispatched if dispatched else 0.0,
+                'max_wait': self.wait_max[priority],
+            }
+        return stats
@@ -0,0 +1,108 @@
+from functools import partial
+
+import pytest
+import requests
+
+from bulk_import import BulkImporter
+from elastic_api import import_address, import_pizza
+
+FIELDS_SLUGS = ['address', 'alias', 'longitude', 'latitude']
+
+
+def conflict():
+    response = requests.Response()
+    response.status_code = 409
+    return requests.HTTPError(response=response)
+
+
+class FakeMoltin:
+    """Applies every POST, but loses the answer of the first one"""
+
+    def __init__(self):
+        self.products = {}
+        self.entries = []
+        self.answers_lost = 1
+        self.bound = {}
+
+    def _answer(self, data):
+        if self.answers_lost:
+            self.answers_lost -= 1
+            raise requests.ConnectionError('answer lost')
+        return {'data': data}
+
+    def add_product(self, product, num):
+        slug = f'pizza-{num}'
+        if slug in self.products:
+            raise conflict()
+        self.products[slug] = {'id': f'product-{num}', 'slug': slug}
+        return self._answer(self.products[slug])
+
+    def get_product_by_slug(self, slug):
+        return self.products.get(slug)
+
+    def upload_image(self, image_url):
+        return {'data': {'id': f'image-{image_url}'}}
+
+    def bind_image_with_product(self, image_id, product_id):
+        self.bound[product_id] = image_id
+
+    def create_entry(self, fields_slugs, values, flow_slug):
+        entry = dict(zip(fields_slugs, values), id=f'entry-{len(self.entries)}')
+        self.entries.append(entry)
+        return self._answer(entry)
+
+    def find_entry(self, flow_slug, field_slug, value):
+        return next((entry for entry in self.entries if entry.get(field_slug) == value), None)
+
+
+def run(tmp_path, items, task):
+    importer = BulkImporter(str(tmp_path / 'import.checkpoint'), workers=1, backoff=0)
+    return importer.run(items, task)
+
+
+def test_pizza_created_by_a_lost_post_is_not_created_again(tmp_path):
+    client = FakeMoltin()
+    product = {'product_image': {'url': 'margherita.jpg'}}
+
+    [result] = run(tmp_path, [('pizza-1', (1, product))], partial(import_pizza, client))
+
+    assert result.status == 'done'
+    assert list(client.products) == ['pizza-1']
+    assert client.bound == {'product-1': 'image-margherita.jpg'}
+
+
+def test_pizza_conflicting_on_slug_counts_as_created():
+    client = FakeMoltin()
+    client.answers_lost = 0
+    client.products['pizza-1'] = {'id': 'product-1', 'slug': 'pizza-1'}
+    progress = {}
+
+    import_pizza(client, (1, {'product_image': {'url': 'margherita.jpg'}}), progress)
+
+    assert progress['product_id'] == 'product-1'
+
+
+def test_pizza_conflict_without_a_product_is_raised():
+    client = FakeMoltin()
+
+    def add_product(product, num):
+        raise conflict()
+
+    client.add_product = add_product
+
+    with pytest.raises(requests.HTTPError):
+        import_pizza(client, (1, {'product_image': {'url': 'margherita.jpg'}}), {})
+
+
+def test_entry_created_by_a_lost_post_is_not_created_again(tmp_path):
+    client = FakeMoltin()
+    address = {
+        'alias': 'Афимолл',
+        'address': {'full': 'Москва, Пресненская набережная, 2'},
+        'coordinates': {'lon': '37.539', 'lat': '55.749'},
+    }
+
+    [result] = run(tmp_path, [('Афимолл', address)], partial(import_address, client, FIELDS_SLUGS))
+
+    assert result.status == 'done'
+    assert len(client.entries) == 1
@@ -0,0 +1,154 @@
+import threading
+
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from cart_mirror import MirrorNotUpdated
+from cart_queue import CartWriteQueue
+
+CART_ID = 'cart-1'
+
+
+class FakeCartMirror:
+    def __init__(self, errors=(), applied_on_error=False):
+        self.errors = list(errors)
+        self.applied_on_error = applied_on_error
+        self.quantities = {}
+        self.adds = []
+        self.reloads = 0
+        self.invalidated = []
+        self._lock = threading.Lock()
+
+    def _mirror(self):
+        items = [{'product_id': product_id, 'quantity': quantity} for product_id, quantity in self.quantities.items()]
+        return {'items': items}
+
+    def peek(self, cart_id):
+        return self._mirror()
+
+    def add(self, cart_id, product_id, quantity=1):
+        with self._lock:
+            self.adds.append((cart_id, product_id, quantity))
+            error = self.errors.pop(0) if self.errors else None
+            if error is None or isinstance(error, MirrorNotUpdated) or self.applied_on_error:
+                self.quantities[product_id] = self.quantities.get(product_id, 0) + quantity
+        if error is not None:
+            raise error
+        return self._mirror()
+
+    def reload(self, cart_id):
+        self.reloads += 1
+        return self._mirror()
+
+    def invalidate(self, cart_id):
+        self.invalidated.append(cart_id)
+
+
+def get_http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+def get_refused_error():
+    reason = NewConnectionError(None, 'Connection refused')
+    return requests.ConnectionError(MaxRetryError(None, '/v2/carts', reason))
+
+
+def run_queue(cart_mirror, taps, **kwargs):
+    dropped = []
+    queue = CartWriteQueue(cart_mirror, window=0.05, backoff=0,
+                           on_dropped=lambda *args: dropped.append(args), **kwargs).start()
+    for cart_id, product_id in taps:
+        queue.add(cart_id, product_id, chat_id=42)
+    for cart_id in {cart_id for cart_id, _ in taps}:
+        assert queue.flush(cart_id, timeout=5)
+    queue.close()
+    return queue, dropped
+
+
+def test_taps_within_window_are_merged_per_product():
+    cart_mirror = FakeCartMirror()
+    taps = [(CART_ID, 'pepperoni'), (CART_ID, 'margherita'), (CART_ID, 'pepperoni'), (CART_ID, 'pepperoni')]
+
+    queue, dropped = run_queue(cart_mirror, taps)
+
+    assert cart_mirror.adds == [(CART_ID, 'pepperoni', 3), (CART_ID, 'margherita', 1)]
+    assert cart_mirror.quantities == {'pepperoni': 3, 'margherita': 1}
+    assert queue.taps == 4
+    assert queue.requests == 2
+    assert not dropped
+
+
+def test_carts_are_not_merged_together():
+    cart_mirror = FakeCartMirror()
+
+    run_queue(cart_mirror, [(CART_ID, 'pepperoni'), ('cart-2', 'pepperoni')])
+
+    assert sorted(cart_mirror.adds) == [(CART_ID, 'pepperoni', 1), ('cart-2', 'pepperoni', 1)]
+
+
+def test_taps_after_flush_go_in_a_new_request():
+    cart_mirror = FakeCartMirror()
+    queue = CartWriteQueue(cart_mirror, window=0.05, backoff=0).start()
+
+    queue.add(CART_ID, 'pepperoni')
+    assert queue.flush(CART_ID, timeout=5)
+    queue.add(CART_ID, 'pepperoni')
+    assert queue.flush(CART_ID, timeout=5)
+    queue.close()
+
+    assert cart_mirror.adds == [(CART_ID, 'pepperoni', 1), (CART_ID, 'pepperoni', 1)]
+    assert not queue.is_pending(CART_ID)
+
+
+def test_request_not_sent_is_retried():
+    cart_mirror = FakeCartMirror(errors=[get_refused_error(), get_http_error(503)])
+
+    queue, dropped = run_queue(cart_mirror, [(CART_ID, 'pepperoni'), (CART_ID, 'pepperoni')])
+
+    assert cart_mirror.adds == [(CART_ID, 'pepperoni', 2)] * 3
+    assert cart_mirror.quantities == {'pepperoni': 2}
+    assert not dropped
+
+
+def test_addition_dropped_after_last_attempt_is_reported():
+    cart_mirror = FakeCartMirror(errors=[requests.ConnectTimeout()] * 3)
+
+    queue, dropped = run_queue(cart_mirror, [(CART_ID, 'pepperoni')], attempts=3)
+
+    assert len(cart_mirror.adds) == 3
+    assert dropped == [(42, 'pepperoni', 1)]
+    assert queue.failed == 1
+
+
+def test_applied_request_is_not_sent_again():
+    cart_mirror = FakeCartMirror(errors=[requests.ReadTimeout()], applied_on_error=True)
+
+    queue, dropped = run_queue(cart_mirror, [(CART_ID, 'pepperoni'), (CART_ID, 'pepperoni')])
+
+    assert cart_mirror.adds == [(CART_ID, 'pepperoni', 2)]
+    assert cart_mirror.reloads == 1
+    assert cart_mirror.quantities == {'pepperoni': 2}
+    assert not dropped
+
+
+def test_unapplied_request_with_unknown_outcome_is_reported():
+    cart_mirror = FakeCartMirror(errors=[get_http_error(500)])
+
+    queue, dropped = run_queue(cart_mirror, [(CART_ID, 'pepperoni')])
+
+    assert cart_mirror.adds == [(CART_ID, 'pepperoni', 1)]
+    assert cart_mirror.reloads == 1
+    assert dropped == [(42, 'pepperoni', 1)]
+
+
+def test_failed_mirror_update_is_not_sent_again():
+    cart_mirror = FakeCartMirror(errors=[MirrorNotUpdated(CART_ID)])
+
+    queue, dropped = run_queue(cart_mirror, [(CART_ID, 'pepperoni')])
+
+    assert cart_mirror.adds == [(CART_ID, 'pepperoni', 1)]
+    assert cart_mirror.invalidated == [CART_ID]
+    assert cart_mirror.quantities == {'pepperoni': 1}
+    assert not dropped
@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+from bot import is_cart_changed
+from order_snapshot import MAX_PAYLOAD_BYTES, InvalidSnapshot, OrderSigner, OrderSnapshot, get_items_hash
+
+USER_ID = 42
+CART_ID = 'cart-1'
+ITEMS = [{'product_id': 'pepperoni', 'quantity': 2}, {'product_id': 'margherita', 'quantity': 1}]
+
+
+def test_signed_payload_is_verified():
+    signer = OrderSigner('secret')
+
+    payload = signer.sign(USER_ID, CART_ID, ITEMS, 1500, 100)
+
+    assert len(payload.encode()) <= MAX_PAYLOAD_BYTES
+    assert signer.verify(USER_ID, payload) == OrderSnapshot(CART_ID, get_items_hash(ITEMS), 1500, 100)
+
+
+@pytest.mark.parametrize('user_id, secret', [(USER_ID + 1, 'secret'), (USER_ID, 'another secret')])
+def test_payload_of_another_customer_or_key_is_rejected(user_id, secret):
+    payload = OrderSigner('secret').sign(USER_ID, CART_ID, ITEMS, 1500, 100)
+
+    with pytest.raises(InvalidSnapshot):
+        OrderSigner(secret).verify(user_id, payload)
+
+
+@pytest.mark.parametrize('payload', ['', 'no separators', f'{CART_ID}:hash:1500:100:forged'])
+def test_forged_payload_is_rejected(payload):
+    with pytest.raises(InvalidSnapshot):
+        OrderSigner('secret').verify(USER_ID, payload)
+
+
+def test_tampered_total_is_rejected():
+    signer = OrderSigner('secret')
+    cart_id, items_hash, _, delivery_fee, signature = signer.sign(USER_ID, CART_ID, ITEMS, 1500, 100).split(':')
+
+    with pytest.raises(InvalidSnapshot):
+        signer.verify(USER_ID, f'{cart_id}:{items_hash}:1:{delivery_fee}:{signature}')
+
+
+@pytest.mark.parametrize('snapshot', ['cart-1:hash:1500', 'cart-1:hash:total:100'])
+def test_malformed_payload_with_valid_signature_is_rejected(snapshot):
+    signer = OrderSigner('secret')
+    payload = f'{snapshot}:{signer._sign(USER_ID, snapshot)}'
+
+    with pytest.raises(InvalidSnapshot):
+        signer.verify(USER_ID, payload)
+
+
+def test_items_hash_ignores_item_order_but_not_quantities():
+    changed_items = [{'product_id': 'pepperoni', 'quantity': 3}, {'product_id': 'margherita', 'quantity': 1}]
+
+    assert get_items_hash(ITEMS) == get_items_hash(list(reversed(ITEMS)))
+    assert get_items_hash(ITEMS) != get_items_hash(changed_items)
+
+
+def get_context(items=None, pending=False):
+    cart_queue = SimpleNamespace(is_pending=lambda cart_id: pending)
+    cart_mirror = SimpleNamespace(peek=lambda cart_id: {'items': items} if items is not None else None)
+    return SimpleNamespace(bot_data={'cart_queue': cart_queue, 'cart_mirror': cart_mirror})
+
+
+@pytest.mark.parametrize('context, changed', [
+    (get_context(ITEMS), False),
+    (get_context(ITEMS[:1]), True),
+    (get_context(ITEMS, pending=True), True),
+    (get_context(), True),
+])
+def test_cart_is_checked_against_the_snapshot(context, changed):
+    order = OrderSigner('secret').verify(USER_ID, OrderSigner('secret').sign(USER_ID, CART_ID, ITEMS, 1500, 100))
+
+    assert is_cart_changed(context, order) == changed
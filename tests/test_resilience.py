@@ -0,0 +1,175 @@
+import threading
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from elastic_api import MoltinClient
+from resilience import CLOSED, HALF_OPEN, OPEN, CallPolicy, CircuitBreaker, CircuitOpenError, Watchdog, read_content
+
+
+class SlowBodyHandler(BaseHTTPRequestHandler):
+    """Answers at once, then sends the body a byte at a time, each byte within the read timeout"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"data": []}'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            for byte in body:
+                self.wfile.write(bytes([byte]))
+                self.wfile.flush()
+                time.sleep(0.1)
+        except ConnectionError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def slow_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowBodyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+def open_breaker(reset_timeout=0):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=reset_timeout)
+    breaker.before_call()
+    breaker.record_failure()
+    return breaker
+
+
+def test_unexpected_error_of_a_probe_does_not_close_the_breaker():
+    policy = CallPolicy('test', breaker=open_breaker())
+
+    def send(timeout, deadline):
+        raise ValueError('bug in the caller')
+
+    with pytest.raises(ValueError):
+        policy.call('GET', '/', send)
+
+    assert policy.breaker.state == HALF_OPEN
+    # the probe is released, the next call may probe the service again
+    policy.breaker.before_call()
+
+
+def test_unexpected_error_does_not_reset_failures():
+    breaker = CircuitBreaker('test', failure_threshold=2)
+    policy = CallPolicy('test', attempts=1, breaker=breaker)
+
+    def fail(timeout, deadline):
+        raise requests.ConnectionError()
+
+    def crash(timeout, deadline):
+        raise ValueError()
+
+    for send in (fail, crash, fail):
+        with pytest.raises((requests.ConnectionError, ValueError)):
+            policy.call('GET', '/', send)
+
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_completed_probe_closes_the_breaker():
+    breaker = open_breaker()
+    response = requests.Response()
+    response.status_code = 404
+
+    assert CallPolicy('test', breaker=breaker).call('GET', '/', lambda timeout, deadline: response) is response
+    assert breaker.state == CLOSED
+
+
+def test_slow_body_is_cut_at_the_deadline(slow_server):
+    started_at = time.monotonic()
+    deadline = started_at + 0.5
+    response = requests.get(slow_server, timeout=(1, 1), stream=True)
+
+    with pytest.raises(requests.RequestException):
+        read_content(response, deadline)
+
+    assert time.monotonic() - started_at < 0.8
+
+
+def test_connection_cut_at_the_deadline_is_not_reused(slow_server):
+    session = requests.Session()
+    with pytest.raises(requests.RequestException):
+        read_content(session.get(slow_server, timeout=(1, 1), stream=True), time.monotonic() + 0.3)
+
+    for _ in range(2):
+        response = read_content(session.get(slow_server, timeout=(1, 1), stream=True), time.monotonic() + 5)
+        assert response.json() == {'data': []}
+
+
+def test_connect_timeout_is_cut_to_the_time_left():
+    timeouts = []
+    response = requests.Response()
+    response.status_code = 200
+
+    def send(timeout, deadline):
+        timeouts.append(timeout)
+        return response
+
+    CallPolicy('test').call('GET', '/', send, deadline=time.monotonic() + 1)
+
+    connect_timeout, read_timeout = timeouts[0]
+    assert connect_timeout <= 1 and read_timeout <= 1
+
+
+def test_call_past_its_deadline_is_not_sent():
+    def send(timeout, deadline):
+        raise AssertionError('the call is sent')
+
+    with pytest.raises(requests.Timeout):
+        CallPolicy('test').call('GET', '/', send, deadline=time.monotonic() - 1)
+
+
+class RecordingPolicy:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.deadlines = []
+
+    def start(self, path):
+        return time.monotonic() + 5
+
+    def call(self, method, path, send, deadline=None):
+        self.deadlines.append(deadline)
+        response = requests.Response()
+        response.status_code = self.statuses.pop(0)
+        return response
+
+
+def test_retry_with_a_fresh_token_keeps_the_deadline():
+    policy = RecordingPolicy([401, 200])
+    token_manager = SimpleNamespace(get_token=lambda: 'stale', refresh_after_unauthorized=lambda token: 'fresh')
+    moltin = MoltinClient(token_manager=token_manager, policy=policy)
+
+    moltin._request('GET', '/v2/carts/cart-1')
+
+    assert len(policy.deadlines) == 2
+    assert policy.deadlines[0] == policy.deadlines[1]
+
+
+def test_watchdog_runs_only_callbacks_not_cancelled():
+    watchdog = Watchdog()
+    fired = []
+    cancelled = watchdog.schedule(time.monotonic() + 0.05, lambda: fired.append('cancelled'))
+    for name, delay in (('late', 0.1), ('early', 0.05)):
+        watchdog.schedule(time.monotonic() + delay, partial(fired.append, name))
+    watchdog.cancel(cancelled)
+
+    time.sleep(0.3)
+
+    assert fired == ['early', 'late']
@@ -0,0 +1,104 @@
+import threading
+import time
+
+from telegram.error import RetryAfter
+
+from send_scheduler import COSMETIC, NORMAL, URGENT, SendScheduler
+
+
+class FakeBot:
+    def __init__(self, retry_after_texts=()):
+        self.retry_after_texts = set(retry_after_texts)
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self._lock:
+            if text in self.retry_after_texts:
+                self.retry_after_texts.discard(text)
+                raise RetryAfter(0.1)
+            self.sent.append((chat_id, text))
+        return text
+
+    send_invoice = send_message
+
+
+def get_texts(bot, chat_id):
+    return [text for sent_chat_id, text in bot.sent if sent_chat_id == chat_id]
+
+
+def test_calls_to_one_chat_go_by_priority_then_in_their_order():
+    bot = FakeBot()
+    scheduler = SendScheduler(bot, global_rate=1000, chat_rate=1000, chat_burst=10)
+    scheduler.submit('send_message', priority=COSMETIC, chat_id=1, text='menu')
+    scheduler.submit('send_message', priority=NORMAL, chat_id=1, text='preparing')
+    scheduler.submit('send_message', priority=NORMAL, chat_id=1, text='ready')
+    scheduler.submit('send_invoice', priority=URGENT, chat_id=1, text='invoice')
+
+    scheduler.start()
+    assert scheduler.join(5)
+    scheduler.stop()
+
+    assert get_texts(bot, 1) == ['invoice', 'preparing', 'ready', 'menu']
+
+
+def test_urgent_call_is_not_held_by_the_limiter_of_its_chat():
+    bot = FakeBot()
+    scheduler = SendScheduler(bot, global_rate=1000, chat_rate=1, chat_burst=1)
+    for number in range(3):
+        scheduler.submit('send_message', chat_id=1, text=f'busy {number}')
+
+    scheduler.start()
+    time.sleep(0.1)
+    scheduler.submit('send_invoice', priority=URGENT, chat_id=1, text='invoice')
+    time.sleep(0.2)
+    sent = get_texts(bot, 1)
+    scheduler.stop(timeout=0)
+
+    assert sent == ['busy 0', 'invoice']
+
+
+def test_urgent_chat_goes_before_others():
+    bot = FakeBot()
+    scheduler = SendScheduler(bot, global_rate=1000, chat_rate=1000, chat_burst=10, workers=1)
+    for chat_id in range(10):
+        scheduler.submit('send_message', priority=COSMETIC, chat_id=chat_id, text='menu')
+    scheduler.submit('send_invoice', priority=URGENT, chat_id=99, text='invoice')
+
+    scheduler.start()
+    assert scheduler.join(5)
+    scheduler.stop()
+
+    assert bot.sent[0] == (99, 'invoice')
+    assert len(bot.sent) == 11
+
+
+def test_chat_held_by_its_limiter_does_not_block_others():
+    bot = FakeBot()
+    scheduler = SendScheduler(bot, global_rate=1000, chat_rate=1, chat_burst=1)
+    for number in range(3):
+        scheduler.submit('send_message', chat_id=1, text=f'busy {number}')
+    scheduler.submit('send_message', chat_id=2, text='other')
+
+    scheduler.start()
+    time.sleep(0.3)
+    sent = list(bot.sent)
+    scheduler.stop(timeout=0)
+
+    assert (2, 'other') in sent
+    assert get_texts(bot, 1)[:1] == ['busy 0']
+    assert len([chat_id for chat_id, _ in sent if chat_id == 1]) == 1
+
+
+def test_call_retried_after_flood_control_keeps_its_place_in_the_chat():
+    bot = FakeBot(retry_after_texts={'first'})
+    scheduler = SendScheduler(bot, global_rate=1000, chat_rate=1000, chat_burst=10)
+    scheduler.submit('send_message', chat_id=1, text='first')
+    scheduler.submit('send_message', chat_id=1, text='second')
+
+    scheduler.start()
+    assert scheduler.join(5)
+    scheduler.stop()
+
+    assert get_texts(bot, 1) == ['first', 'second']
+    assert scheduler.retried == 1
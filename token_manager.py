@@ -0,0 +1,82 @@
+import json
+import random
+import threading
+import time
+
+
+class TokenManager:
+    """
+    Shares one Moltin access token between all threads and bot replicas.
+    The token is refreshed `refresh_margin` seconds (plus random jitter) before it expires.
+    Only one process mints a new token under a redis lock, the others read it from redis,
+    and inside a process concurrent refreshes wait for a single one.
+    """
+
+    token_key = 'moltin_token'
+    lock_key = 'moltin_token_lock'
+
+    def __init__(self, redis_base, fetch_auth, refresh_margin=300, jitter=60, lock_timeout=30):
+        self.redis_base = redis_base
+        self.fetch_auth = fetch_auth
+        self.refresh_margin = refresh_margin
+        self.jitter = jitter
+        self.lock_timeout = lock_timeout
+        self.minted = 0
+        self._token = None
+        self._expires_at = 0
+        self._refresh_at = 0
+        self._lock = threading.Lock()
+
+    def _adopt(self, token, expires_at):
+        self._token = token
+        self._expires_at = expires_at
+        refresh_at = expires_at - self.refresh_margin - random.uniform(0, self.jitter)
+        self._refresh_at = max(refresh_at, time.time() + (expires_at - time.time()) / 2)
+
+    def _is_usable(self, expires_at):
+        return time.time() < expires_at - self.refresh_margin
+
+    def _read_shared(self):
+        shared = self.redis_base.get(self.token_key)
+        if not shared:
+            return None, 0
+        shared = json.loads(shared)
+        return shared['token'], shared['expires_at']
+
+    def _mint(self):
+        elastic_auth = self.fetch_auth()
+        token = elastic_auth['access_token']
+        expires_in = int(elastic_auth['expires_in'])
+        expires_at = time.time() + expires_in
+        self.redis_base.set(self.token_key, json.dumps({'token': token, 'expires_at': expires_at}), ex=expires_in)
+        self.minted += 1
+        return token, expires_at
+
+    def _refresh(self, stale_token):
+        with self._lock:
+            if self._token != stale_token and self._is_usable(self._expires_at):
+                return self._token
+
+            token, expires_at = self._read_shared()
+            if token and token != stale_token and self._is_usable(expires_at):
+                self._adopt(token, expires_at)
+                return token
+
+            with self.redis_base.lock(self.lock_key, timeout=self.lock_timeout, blocking_timeout=self.lock_timeout):
+                token, expires_at = self._read_shared()
+                if not token or token == stale_token or not self._is_usable(expires_at):
+                    token, expires_at = self._mint()
+            self._adopt(token, expires_at)
+            return token
+
+    def get_token(self):
+        token = self._token
+        if token and time.time() < self._refresh_at:
+            return token
+        return self._refresh(token)
+
+    def refresh_after_unauthorized(self, stale_token):
+        return self._refresh(stale_token)
+
+    def seconds_until_refresh(self):
+        return max(0.0, self._refresh_at - time.time())
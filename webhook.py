@@ -0,0 +1,123 @@
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+class BotRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        callback = self.server.routes.get((self.command, urlsplit(self.path).path))
+        if callback:
+            status, headers, payload = callback(self.headers, body)
+        else:
+            status, headers, payload = 404, {}, b''
+
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = _handle
+
+
+class BotHTTPServer(ThreadingHTTPServer):
+    """Serves the published port: Telegram webhook and service endpoints are registered as routes"""
+
+    daemon_threads = True
+
+    def __init__(self, address):
+        self.routes = {}
+        super().__init__(address, BotRequestHandler)
+        self._thread = threading.Thread(target=self.serve_forever, name='http-server', daemon=True)
+
+    def route(self, method, path, callback):
+        self.routes[(method, path)] = callback
+
+    def start(self):
+        self._thread.start()
+        return self
+
+
+def get_webhook_secret(token):
+    """Secret token of the webhook derived from the bot token, so every replica sets the same one"""
+    return hmac.new(token.encode(), b'webhook', hashlib.sha256).hexdigest()
+
+
+class WebhookIntake:
+    """
+    Puts updates sent by Telegram into the bounded update queue of the dispatcher.
+    When the queue is full the update is refused with 429, Telegram delivers it again later.
+    With `secret_token` requests without the same X-Telegram-Bot-Api-Secret-Token header are refused.
+    """
+
+    secret_header = 'X-Telegram-Bot-Api-Secret-Token'
+
+    def __init__(self, bot, update_queue, retry_after=1, secret_token=None):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.retry_after = retry_after
+        self.secret_token = secret_token
+        self.accepted = 0
+        self.rejected = 0
+        self.forbidden = 0
+
+    def _is_authorized(self, headers):
+        if not self.secret_token:
+            return True
+        return hmac.compare_digest(headers.get(self.secret_header, '').encode(), self.secret_token.encode())
+
+    def __call__(self, headers, body):
+        if not self._is_authorized(headers):
+            self.forbidden += 1
+            return 403, {}, b''
+
+        try:
+            data = json.loads(body)
+            update = Update.de_json(data, self.bot) if isinstance(data, dict) else None
+        except (ValueError, TypeError, KeyError):
+            update = None
+        if update is None:
+            logger.warning('Malformed webhook update')
+            return 400, {}, b''
+
+        try:
+            self.update_queue.put_nowait(update)
+        except queue.Full:
+            self.rejected += 1
+            return 429, {'Retry-After': str(self.retry_after)}, b''
+
+        self.accepted += 1
+        return 200, {}, b''
+
+
+def start_webhook(updater, http_server, url_path, webhook_url, max_connections=40, secret_token=None):
+    intake = WebhookIntake(updater.bot, updater.update_queue, secret_token=secret_token)
+    http_server.route('POST', f'/{url_path}', intake)
+
+    updater.job_queue.start()
+    dispatcher_thread = threading.Thread(target=updater.dispatcher.start, name='dispatcher', daemon=True)
+    dispatcher_thread.start()
+    updater.bot.set_webhook(url=f'{webhook_url}/{url_path}',
+                            max_connections=max_connections,
+                            api_kwargs={'secret_token': secret_token} if secret_token else None)
+    # lets Updater.idle() and Updater.stop() shut the dispatcher down
+    updater.running = True